@@ -2,7 +2,7 @@
 """
 Convenience wrapper for running alppb directly from source tree.
 """
-from alppb.alppb import main
+from alppb.cli import main
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 """
 alppb.__main__: executed when alppb directory is called as script
 """
-from .alppb import main
+from .cli import main
 
 
 main()
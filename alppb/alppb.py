@@ -6,13 +6,39 @@ Builds Python modules on Amazon Linux using AWS CodeBuild and downloads them.
 __author__ = "Josh Campbell"
 __version__ = "0.2.0"
 __license__ = "MIT"
-import argparse
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+import time
 from botocore.exceptions import NoRegionError
-from .__version__ import __version__
+from . import cache
+from . import clients
 from . import codebuild
+from . import errors
+from . import history
 from . import iam
+from . import layers
+from . import local
+from . import logs
+from . import metadata
 from . import s3
+from . import serve
+from . import tasks
+from . import timing
+# The entry point lives in cli.py so --help and --version skip boto3. It is
+# re-exported here for existing imports of alppb.alppb.main.
+from .cli import main
+
+NO_REGION_MESSAGE = (
+    "boto3 cannot find a default profile to use. Try running `aws "
+    "configure`. To see how boto3 loads configuration, see: "
+    "https://boto3.amazonaws.com/v1/documentation/api/latest/guide/"
+    "configuration.html#configuring-credentials")
+
+# Buildspec options that name the artifacts rather than change the build.
+NAMING_OPTIONS = ('artifact_suffix',)
 
 
 def check_for_boto_credentials():
@@ -24,19 +50,54 @@ def check_for_boto_credentials():
 
     Returns
     -------
+
+    Raises
+    ------
+    errors.CredentialsError
+        If no credentials were found.
     """
-    session = boto3.Session()
+    session = clients.get_session()
     credentials = session.get_credentials()
     if credentials is None:
-        print("ERROR: AWS credentials not detected. "
-              "Is awscli installed and configued? "
-              "Does ~/.aws/credentials exist?")
-        exit(1)
+        raise errors.CredentialsError(
+            "AWS credentials not detected. Is awscli installed and "
+            "configued? Does ~/.aws/credentials exist?")
+
+
+def validate_region(region):
+    """
+    Checks that the region is one AWS CodeBuild is available in. This is
+    done after parsing arguments so the CLI doesn't load boto3 and its
+    endpoint data for -h and -v.
+
+    Parameters
+    ----------
+    region : str
+        The region passed with --region, or None to let boto3 decide.
+
+    Returns
+    -------
+
+    Raises
+    ------
+    errors.RegionError
+        If CodeBuild is not available in the region.
+    """
+    if region is None:
+        return
+    regions = metadata.lookup('regions', 'codebuild')
+    if regions is None or region not in regions:
+        regions = clients.get_session().get_available_regions('codebuild')
+        metadata.store('regions', 'codebuild', regions)
+    if region not in regions:
+        raise errors.RegionError(
+            "{} is not a region AWS CodeBuild is available in. "
+            "Choose from: {}".format(region, ", ".join(regions)))
 
 
 def create_client(service, region):
     """
-    Creates a boto3 client object for the specified service.
+    Gets the shared boto3 client object for the specified service.
 
     Parameters
     ----------
@@ -48,21 +109,23 @@ def create_client(service, region):
     botocore.client.service
         See https://boto3.amazonaws.com/v1/documentation/api/latest/guide
         /clients.html for more information.
+
+    Raises
+    ------
+    errors.RegionError
+        If boto3 cannot determine a region.
     """
     print("Creating boto3 client for {}...".format(service))
     try:
-        return boto3.client(service, region_name=region)
+        return clients.get_client(service, region)
     except NoRegionError:
-        print("ERROR: boto3 cannot find a default profile to use. Try running "
-              "`aws configure`. To see how boto3 loads configuration, see: "
-              "https://boto3.amazonaws.com/v1/documentation/api/latest/guide/"
-              "configuration.html#configuring-credentials")
-        exit(1)
+        raise errors.RegionError(NO_REGION_MESSAGE)
 
 
 def create_resource(service, region):
     """
-    Creates a boto3 resource object for the specified service.
+    Gets the shared boto3 resource object for the specified service. It
+    shares its connection pool with the client from create_client().
 
     Parameters
     ----------
@@ -74,103 +137,1453 @@ def create_resource(service, region):
     boto3.resources.factory.service.ServiceResource
         See https://boto3.amazonaws.com/v1/documentation/api/latest/guide
         /resources.html for more information.
+
+    Raises
+    ------
+    errors.RegionError
+        If boto3 cannot determine a region.
     """
     print("Creating boto3 resource for {}...".format(service))
     try:
-        return boto3.resource(service, region_name=region)
+        return clients.get_resource(service, region)
     except NoRegionError:
-        print("ERROR: boto3 cannot find a default profile to use. Try running "
-              "`aws configure`. To see how boto3 loads configuration, see: "
-              "https://boto3.amazonaws.com/v1/documentation/api/latest/guide/"
-              "configuration.html#configuring-credentials")
-        exit(1)
+        raise errors.RegionError(NO_REGION_MESSAGE)
+
+
+def package_artifact(package, buildspec_options=None):
+    """
+    Determines the file name of the artifact a package is built into.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package to build.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec(), e.g.
+        archive_format, plus the artifact_suffix of builds for several
+        Python versions.
+
+    Returns
+    -------
+    str
+        File name of the artifact, e.g. "alppb-requests.tar.xz".
+    """
+    buildspec_options = buildspec_options or {}
+    return codebuild.artifact_name(
+        package, buildspec_options.get('archive_format', 'zip'),
+        buildspec_options.get('artifact_suffix', ''))
+
+
+def buildspec_arguments(buildspec_options=None):
+    """
+    Drops the options that only name artifacts, leaving the keyword
+    arguments for codebuild.generate_buildspec().
+
+    Parameters
+    ----------
+    buildspec_options : dict
+        Options of the Buildspec and its artifact names.
+
+    Returns
+    -------
+    dict
+        The keyword arguments.
+    """
+    return {option: value
+            for option, value in (buildspec_options or {}).items()
+            if option not in NAMING_OPTIONS}
 
 
-def parse_args():
-    """ Setup ArgumentParser """
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument("package",
-                        help="The PyPi package you want to build on "
-                             "Amazon Linux.",
-                        type=str)
-
-    parser.add_argument("bucket",
-                        help="Name of the S3 bucket to use. This bucket "
-                             "temporarily stores the build artifact and is "
-                             "used AWS CodeBuild.",
-                        type=str)
-
-    parser.add_argument("-r", "--region",
-                        choices=boto3.session.Session().get_available_regions(
-                            'codebuild'),
-                        help="The AWS region to use for building the package. "
-                             "This region must match the region that the "
-                             "specified S3 bucket exists in.",
-                        type=str)
-
-    parser.add_argument("-p", "--python",
-                        choices=["2.7", "3.6", "3.7"],
-                        help="The Python version to use. Defaults to 3.6 if "
-                             "not specified.",
-                        type=str)
-
-    parser.add_argument("-v", "--version",
-                        action='version',
-                        help="Prints the version of alppb you are using.",
-                        version="alppb {}".format(__version__))
-
-    return parser.parse_args()
-
-
-def main():
-    """ Main entry point of the app """
-    # Parse args and get values used in functions below.
-    args = parse_args()
-    package = args.package
+def delivered_name(artifact, delivery=None):
+    """
+    Determines the file name an artifact ends up with locally, which is a
+    zip if delivery converts tars.
+
+    Parameters
+    ----------
+    artifact : str
+        File name of the artifact in S3. See package_artifact().
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact().
+
+    Returns
+    -------
+    str
+        The local file name.
+    """
+    if (delivery or {}).get('to_zip'):
+        return s3.zip_path(artifact)
+    return artifact
+
+
+def suffix_of(name):
+    """ The archive suffix of an artifact name, e.g. ".tar.xz". """
+    for archive_format in codebuild.ARCHIVE_FORMATS:
+        if name.endswith('.' + archive_format):
+            return '.' + archive_format
+    return '.zip'
+
+
+def package_buildspec(package, py_version, buildspec_options=None):
+    """
+    Generates the Buildspec that builds one package into its own artifact.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec(), e.g.
+        wheelhouse.
+
+    Returns
+    -------
+    str
+        The Buildspec in YAML.
+    """
+    return codebuild.generate_buildspec(package, py_version,
+                                        package_artifact(package,
+                                                         buildspec_options),
+                                        **buildspec_arguments(
+                                            buildspec_options))
+
+
+def batch_buildspec(packages, py_version, buildspec_options=None):
+    """
+    Generates the Buildspec for one build of one or more packages, each
+    into its own artifact.
+
+    Parameters
+    ----------
+    packages : list
+        Names of the PyPi packages to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+
+    Returns
+    -------
+    str
+        The Buildspec in YAML.
+    """
+    if len(packages) == 1:
+        return package_buildspec(packages[0], py_version, buildspec_options)
+    return codebuild.generate_batch_buildspec(
+        packages, py_version,
+        [package_artifact(package, buildspec_options)
+         for package in packages],
+        **buildspec_arguments(buildspec_options))
+
+
+def plan_batch(packages, plans=None):
+    """
+    Combines the plans of the packages built together. The batch runs on
+    the largest compute type any of them was planned for.
+
+    Parameters
+    ----------
+    packages : list
+        Names of the PyPi packages built in one build.
+    plans : dict
+        The plans of each package. See plan_builds().
+
+    Returns
+    -------
+    dict
+        The "compute_type" and "expected_duration" of the build, either of
+        which may be missing.
+    """
+    batch = [(plans or {}).get(package, {}) for package in packages]
+    if len(batch) == 1:
+        return batch[0]
+    plan = {}
+    compute_types = [entry['compute_type'] for entry in batch
+                     if entry.get('compute_type') in history.COMPUTE_TYPES]
+    if compute_types:
+        plan['compute_type'] = max(compute_types,
+                                   key=history.COMPUTE_TYPES.index)
+    durations = [entry.get('expected_duration') for entry in batch]
+    if None not in durations:
+        plan['expected_duration'] = sum(durations)
+    return plan
+
+
+def artifact_cache_key(package, py_version, buildspec_options=None,
+                       image=None):
+    """
+    Computes the cache key of the artifact for a package from the same
+    image and Buildspec the build would use.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec(), e.g.
+        wheelhouse.
+    image : str
+        What the package is built on, see CodeBuildBackend.image(). Defaults
+        to the CodeBuild image.
+
+    Returns
+    -------
+    str
+        The cache key. See cache.cache_key().
+    """
+    # No version builds for 3.6, so both share their artifacts.
+    py_version = py_version or "3.6"
+    return cache.cache_key(
+        package, py_version, image or codebuild.determine_image(py_version),
+        package_buildspec(package, py_version, buildspec_options))
+
+
+def restore_cached(s3_resource, s3_client, bucket, package, py_version,
+                   cache_dir, max_cache_bytes, delivery=None,
+                   buildspec_options=None, publish=None, image=None):
+    """
+    Restores the artifact for a package from the local cache or, failing
+    that, from the cache prefix in the S3 bucket.
+
+    Parameters
+    ----------
+    s3_resource : boto3.resources.factory.s3.ServiceResource
+        A boto3 Resource interface for S3.
+    s3_client : botocore.client.S3
+        A boto3 client for S3, or None to only use the local cache.
+    bucket : str
+        Name of the bucket the S3 cache lives in.
+    package : str
+        Name of the PyPi package to restore.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    cache_dir : str
+        Path of the local cache directory.
+    max_cache_bytes : int
+        The maximum total size of the local cache.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact(), e.g. output_dir to
+        extract the artifact instead of downloading the zip.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+    publish : callable
+        Optional function called with the package, bucket and S3 key of its
+        artifact to publish it, e.g. as a Lambda layer.
+    image : str
+        What the package is built on, see CodeBuildBackend.image(). Defaults
+        to the CodeBuild image.
+
+    Returns
+    -------
+    bool
+        True on a cache hit, False if the package needs to be built.
+    """
+    delivery = delivery or {}
+    artifact = package_artifact(package, buildspec_options)
+    # The local cache holds what is delivered, e.g. a zip converted from a
+    # tar, and the S3 cache what was built.
+    local = delivered_name(artifact, delivery)
+    key = artifact_cache_key(package, py_version, buildspec_options, image)
+    in_s3 = False
+    if publish is not None:
+        # Artifacts are published from S3, so only the S3 cache will do.
+        in_s3 = cache.lookup_s3(s3_client, bucket, key, suffix_of(artifact))
+        if not in_s3:
+            return False
+        publish(package, bucket, cache.s3_key(key, suffix_of(artifact)))
+        if not delivery.get('download', True):
+            return True
+    path = cache.lookup_local(cache_dir, key, suffix_of(local))
+    if path is not None:
+        print(">>{} found in local cache...".format(package))
+        if delivery.get('output_dir') is None:
+            shutil.copyfile(path, local)
+        else:
+            s3.extract_local(path, delivery['output_dir'])
+        return True
+    if s3_client is None:
+        return False
+    if in_s3 or cache.lookup_s3(s3_client, bucket, key, suffix_of(artifact)):
+        print(">>{} found in S3 cache...".format(package))
+        path = s3.deliver_artifact(s3_resource, bucket,
+                                   cache.s3_key(key, suffix_of(artifact)),
+                                   artifact, **delivery)
+        # Extracted artifacts never exist as a local file to cache.
+        if delivery.get('output_dir') is None:
+            cache.store_local(cache_dir, key, path, max_cache_bytes,
+                              suffix_of(local))
+        return True
+    return False
+
+
+def restore_from_cache(s3_resource, s3_client, bucket, packages, py_version,
+                       cache_dir, max_cache_bytes, concurrency, delivery=None,
+                       buildspec_options=None, publish=None, image=None):
+    """
+    Restores as many artifacts as possible from the cache, checking several
+    packages at once.
+
+    Parameters
+    ----------
+    s3_resource : boto3.resources.factory.s3.ServiceResource
+        A boto3 Resource interface for S3.
+    s3_client : botocore.client.S3
+        A boto3 client for S3, or None to only use the local cache.
+    bucket : str
+        Name of the bucket the S3 cache lives in.
+    packages : list
+        Names of the PyPi packages to restore.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    cache_dir : str
+        Path of the local cache directory.
+    max_cache_bytes : int
+        The maximum total size of the local cache.
+    concurrency : int
+        The maximum number of packages to check at the same time.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact(), e.g. output_dir to
+        extract the artifact instead of downloading the zip.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+    publish : callable
+        Optional function called with the package, bucket and S3 key of its
+        artifact to publish it, e.g. as a Lambda layer.
+    image : str
+        What the package is built on, see CodeBuildBackend.image(). Defaults
+        to the CodeBuild image.
+
+    Returns
+    -------
+    dict
+        Maps each package that was restored to True.
+    """
+    print("Checking the artifact cache...")
+
+    def restore(package):
+        """ Treats any error looking up the cache as a miss. """
+        try:
+            return restore_cached(s3_resource, s3_client, bucket, package,
+                                  py_version, cache_dir, max_cache_bytes,
+                                  delivery, buildspec_options, publish,
+                                  image)
+        except Exception as err:  # pylint: disable=broad-except
+            print(">>Cache lookup for {} failed: {}".format(package, err))
+            return False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        hits = dict(zip(packages, executor.map(restore, packages)))
+    return {package: True for package, hit in hits.items() if hit}
+
+
+def fetch_artifact(s3_resource, s3_client, bucket, prefix, package,
+                   py_version=None, cache_dir=None,
+                   max_cache_bytes=cache.DEFAULT_MAX_BYTES, delivery=None,
+                   buildspec_options=None, publish=None):
+    """
+    Delivers the artifact of a finished build and removes it from S3. When
+    a cache directory is given the artifact is also stored in the S3 and
+    local caches first.
+
+    Parameters
+    ----------
+    s3_resource : boto3.resources.factory.s3.ServiceResource
+        A boto3 Resource interface for S3.
+    s3_client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the build artifact was put in.
+    prefix : str
+        The S3 prefix of the build's artifacts, see
+        codebuild.artifact_prefix().
+    package : str
+        Name of the PyPi package that was built.
+    py_version : str
+        Python version the package was built for.
+    cache_dir : str
+        Path of the local cache directory, or None to skip caching.
+    max_cache_bytes : int
+        The maximum total size of the local cache.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact(), e.g. output_dir to
+        extract the artifact instead of downloading the zip.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+    publish : callable
+        Optional function called with the package, bucket and S3 key of its
+        artifact to publish it, e.g. as a Lambda layer.
+
+    Returns
+    -------
+    """
+    delivery = delivery or {}
+    artifact = package_artifact(package, buildspec_options)
+    key = '{}/{}'.format(prefix, artifact)
+    try:
+        if publish is not None:
+            publish(package, bucket, key)
+        path = s3.deliver_artifact(s3_resource, bucket, key, artifact,
+                                   **delivery)
+        if cache_dir is not None:
+            cached_key = artifact_cache_key(package, py_version,
+                                            buildspec_options)
+            cache.store_s3(s3_client, bucket, cached_key, key,
+                           suffix_of(artifact))
+            # Extracted artifacts never exist as a local file to cache.
+            if path is not None and delivery.get('output_dir') is None:
+                cache.store_local(cache_dir, cached_key, path,
+                                  max_cache_bytes, suffix_of(path))
+    finally:
+        s3.delete_artifact(s3_client, bucket, key)
+
+
+def unique_artifacts(packages, buildspec_options=None):
+    """
+    Finds packages with the same artifact name as an earlier one, e.g.
+    "lxml>=4.2" after "lxml==4.2". Both would be delivered to the same file
+    and cache key, so only the first one can be built.
+
+    Parameters
+    ----------
+    packages : list
+        Names of the PyPi packages to build.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+
+    Returns
+    -------
+    tuple
+        The packages to build, without repeats, and a dict mapping each
+        package left out to the one it clashes with.
+    """
+    artifacts = {}
+    clashes = {}
+    for package in packages:
+        artifact = package_artifact(package, buildspec_options)
+        first = artifacts.setdefault(artifact, package)
+        if first != package:
+            print("ERROR: {} and {} both build {}, skipping {}".format(
+                first, package, artifact, package))
+            clashes[package] = first
+    return list(artifacts.values()), clashes
+
+
+def build_packages(codebuild_client, s3_resource, s3_client, bucket, packages,
+                   py_version, concurrency, cache_dir=None,
+                   max_cache_bytes=cache.DEFAULT_MAX_BYTES, delivery=None,
+                   logs_client=None, fatal_patterns=None,
+                   buildspec_options=None, plans=None, on_finished=None,
+                   publish=None, batch_size=1, image=None,
+                   **poller_options):
+    """
+    Builds several packages as concurrent CodeBuild builds. At most
+    `concurrency` builds run at the same time, and all of them are polled
+    together with one batch_get_builds call per tick. Artifacts are
+    downloaded in the background as soon as their build succeeds, and a new
+    build is started whenever one finishes. With a batch_size above 1,
+    packages share builds so provisioning is paid once per batch.
+
+    Parameters
+    ----------
+    codebuild_client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+    s3_resource : boto3.resources.factory.s3.ServiceResource
+        A boto3 Resource interface for S3.
+    s3_client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the build artifacts will be put in.
+    packages : list
+        Names of the PyPi packages to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    concurrency : int
+        The maximum number of builds to run at the same time.
+    cache_dir : str
+        Path of the local cache directory successful builds are stored in,
+        or None to skip caching.
+    max_cache_bytes : int
+        The maximum total size of the local cache.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact(), e.g. output_dir to
+        extract the artifact instead of downloading the zip.
+    logs_client : botocore.client.CloudWatchLogs
+        A boto3 client for CloudWatch Logs. If given, the logs of running
+        builds are tailed, builds are stopped as soon as a fatal error is
+        logged and the last log lines of failed builds are printed.
+    fatal_patterns : list
+        Regular expressions that mark a log line as fatal. Defaults to
+        logs.DEFAULT_FATAL_PATTERNS.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+    plans : dict
+        Optional map of packages to a dict with the "compute_type" to build
+        them on and their "expected_duration" in seconds.
+    on_finished : callable
+        Optional function called with the package and the build, as
+        returned by batch_get_builds, whenever a build finishes.
+    publish : callable
+        Optional function called with the package, bucket and S3 key of its
+        artifact to publish it, e.g. as a Lambda layer.
+    batch_size : int
+        The number of packages built together in one build. Each still gets
+        its own artifact, and a package that fails doesn't fail the others.
+    image : str
+        Optional Docker image to build in instead of the project's.
+    poller_options
+        Passed through to codebuild.BuildPoller.
+
+    Returns
+    -------
+    dict
+        Maps each package to True if it was built, False otherwise.
+    """
+    to_build, clashes = unique_artifacts(packages, buildspec_options)
+    results = dict.fromkeys(clashes, False)
+    batches = [to_build[start:start + max(1, batch_size)]
+               for start in range(0, len(to_build), max(1, batch_size))]
+    queue = list(batches)
+    builds = {}
+    downloads = {}
+    stopped = set()
+    tailer = None
+    if logs_client is not None:
+        tailer = logs.LogTailer(logs_client, fatal_patterns,
+                                counters=logs.PIP_CACHE_COUNTERS,
+                                captures=logs.PRUNE_CAPTURES)
+
+    def tail_logs(build):
+        """ Stops a running build as soon as it logs a fatal error. """
+        build_id = build.get('id')
+        if build.get('buildStatus') != 'IN_PROGRESS' or build_id in stopped:
+            return
+        try:
+            line = tailer.check(build)
+        except Exception as err:  # pylint: disable=broad-except
+            print(">>Could not read the logs of {}: {}".format(build_id, err))
+            if tailer.denied:
+                print(">>Not tailing the logs of any build, pass "
+                      "--no-log-tail to skip this")
+            return
+        # A package of a batch failing doesn't stop the others.
+        if line is not None and len(builds[build_id]) == 1:
+            print("ERROR: {} logged a fatal error: {}".format(
+                builds[build_id][0], line))
+            stopped.add(build_id)
+            codebuild.stop_build(codebuild_client, build_id)
+
+    poller = codebuild.BuildPoller(
+        codebuild_client, on_poll=tail_logs if tailer else None,
+        **poller_options)
+
+    def start_next():
+        """ Starts queued builds until the concurrency limit is reached. """
+        while queue and len(poller.pending) < concurrency:
+            batch = queue.pop(0)
+            label = ", ".join(batch)
+            buildspec = batch_buildspec(batch, py_version, buildspec_options)
+            plan = plan_batch(batch, plans)
+            try:
+                build_id = codebuild.start_build(
+                    codebuild_client, buildspec, plan.get('compute_type'),
+                    image, bucket)
+            except Exception as err:  # pylint: disable=broad-except
+                print("ERROR: {} failed to start: {}".format(label, err))
+                results.update((package, False) for package in batch)
+                continue
+            builds[build_id] = batch
+            poller.track(build_id, plan.get('expected_duration'))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        print("Submitting build jobs for {} package(s)...".format(
+            len(to_build)))
+        if len(batches) < len(to_build):
+            print(">>Packing them into {} build(s)...".format(len(batches)))
+        start_next()
+        try:
+            for build in poller.changes():
+                codebuild.print_build_change(build)
+                status = str(build.get('buildStatus'))
+                if status not in codebuild.BuildPoller.TERMINAL_STATUSES:
+                    continue
+                batch = builds[build.get('id')]
+                print_build_report(", ".join(batch), build, tailer)
+                timing.add_build(build, ", ".join(batch))
+                # The durations of a batch say nothing about one package.
+                if on_finished is not None and len(batch) == 1:
+                    on_finished(batch[0], build)
+                if status == 'SUCCEEDED':
+                    # Each package of a batch has its own artifact, so they
+                    # are delivered and cached like separate builds.
+                    for package in batch:
+                        downloads[package] = executor.submit(
+                            fetch_artifact, s3_resource, s3_client, bucket,
+                            codebuild.artifact_prefix(build), package,
+                            py_version, cache_dir, max_cache_bytes,
+                            delivery, buildspec_options, publish)
+                else:
+                    print("ERROR: {} did not build, status is: {}. Check the "
+                          "AWS console for more information on {}".format(
+                              ", ".join(batch), status, build.get('id')))
+                    if tailer is not None:
+                        print_log_tail(tailer, build)
+                    results.update((package, False) for package in batch)
+                start_next()
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR: Polling builds failed: {}".format(err))
+            for batch in builds.values():
+                for package in batch:
+                    results.setdefault(package, False)
+
+        for package, future in downloads.items():
+            try:
+                future.result()
+                results[package] = True
+            except Exception as err:  # pylint: disable=broad-except
+                print("ERROR: {} failed to download: {}".format(package, err))
+                results[package] = False
+
+    for batch in queue:
+        results.update((package, False) for package in batch)
+    return {package: results[package] for package in packages}
+
+
+class CodeBuildBackend(object):
+    """
+    Builds packages as AWS CodeBuild builds and delivers their artifacts
+    from S3. The IAM Role and CodeBuild project must exist already.
+
+    Every backend has an image() method naming what packages are built on,
+    which is part of their cache key, and a build() method that builds and
+    delivers packages and returns which of them were built.
+    """
+
+    def __init__(self, codebuild_client, s3_resource, s3_client, bucket,
+                 logs_client=None, fatal_patterns=None, plans=None,
+                 publish=None, batch_size=1):
+        """
+        Parameters
+        ----------
+        codebuild_client : botocore.client.CodeBuild
+            A boto3 client for CodeBuild.
+        s3_resource : boto3.resources.factory.s3.ServiceResource
+            A boto3 Resource interface for S3.
+        s3_client : botocore.client.S3
+            A boto3 client for S3.
+        bucket : str
+            Name of the bucket the build artifacts are put in.
+        logs_client : botocore.client.CloudWatchLogs
+            Optional client to tail build logs with.
+        fatal_patterns : list
+            Regular expressions that stop a build when a log line matches.
+        plans : dict
+            Optional compute type and expected duration per package. See
+            plan_builds().
+        publish : callable
+            Optional function to publish each artifact with.
+        batch_size : int
+            The number of packages built together in one build.
+        """
+        self.codebuild_client = codebuild_client
+        self.s3_resource = s3_resource
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.logs_client = logs_client
+        self.fatal_patterns = fatal_patterns
+        self.plans = plans
+        self.publish = publish
+        self.batch_size = batch_size
+
+    def image(self, py_version):
+        """ The Docker image CodeBuild builds in. """
+        return codebuild.determine_image(py_version)
+
+    def build(self, packages, py_version, concurrency, cache_dir=None,
+              max_cache_bytes=cache.DEFAULT_MAX_BYTES, delivery=None,
+              buildspec_options=None, on_finished=None):
+        """
+        Builds and delivers packages. See build_packages().
+
+        Parameters
+        ----------
+        packages : list
+            Names of the PyPi packages to build.
+        py_version : str
+            Python version being used. Must be one of "2.7", "3.6", or "3.7"
+        concurrency : int
+            The maximum number of builds to run at the same time.
+        cache_dir : str
+            Path of the local cache directory, or None to skip caching.
+        max_cache_bytes : int
+            The maximum total size of the local cache.
+        delivery : dict
+            Keyword arguments for s3.deliver_artifact().
+        buildspec_options : dict
+            Keyword arguments for codebuild.generate_buildspec().
+        on_finished : callable
+            Optional function called with the package and the build, as
+            returned by batch_get_builds, whenever a build finishes.
+
+        Returns
+        -------
+        dict
+            Maps each package to True if it was built, False otherwise.
+        """
+        return build_packages(
+            self.codebuild_client, self.s3_resource, self.s3_client,
+            self.bucket, packages, py_version, concurrency, cache_dir,
+            max_cache_bytes, delivery, self.logs_client, self.fatal_patterns,
+            buildspec_options, self.plans, on_finished, self.publish,
+            self.batch_size, self.image(py_version))
+
+
+class LocalBackend(object):
+    """
+    Builds packages on this machine with the same Buildspecs CodeBuild would
+    run, skipping CodeBuild's queueing and provisioning. Artifacts are
+    delivered to the same paths as CodeBuild's. See CodeBuildBackend for
+    the interface.
+    """
+
+    def __init__(self, runtime="docker"):
+        """
+        Parameters
+        ----------
+        runtime : str
+            One of local.RUNTIMES to build in the alppb images, or "process"
+            to build with the Python running alppb.
+        """
+        self.runtime = runtime
+
+    def image(self, py_version):
+        """ The alppb image, or the host for process builds. """
+        if self.runtime == "process":
+            # Host builds must never share cache entries with image builds.
+            return "process"
+        return codebuild.determine_image(py_version)
+
+    def build(self, packages, py_version, concurrency, cache_dir=None,
+              max_cache_bytes=cache.DEFAULT_MAX_BYTES, delivery=None,
+              buildspec_options=None, on_finished=None):
+        """
+        Builds and delivers packages, at most `concurrency` at a time.
+
+        Parameters
+        ----------
+        packages : list
+            Names of the PyPi packages to build.
+        py_version : str
+            Python version being used. Must be one of "2.7", "3.6", or "3.7"
+        concurrency : int
+            The maximum number of builds to run at the same time.
+        cache_dir : str
+            Path of the local cache directory, or None to skip caching.
+        max_cache_bytes : int
+            The maximum total size of the local cache.
+        delivery : dict
+            Keyword arguments for local.deliver_file().
+        buildspec_options : dict
+            Keyword arguments for codebuild.generate_buildspec().
+        on_finished : callable
+            Unused, local builds have no CodeBuild build to report.
+
+        Returns
+        -------
+        dict
+            Maps each package to True if it was built, False otherwise.
+        """
+        # pylint: disable=unused-argument
+        delivery = delivery or {}
+        runtime = None if self.runtime == "process" else self.runtime
+        image = self.image(py_version)
+
+        def build_one(package):
+            """ Builds, delivers and caches one package. """
+            buildspec = package_buildspec(package, py_version,
+                                          buildspec_options)
+            artifact = package_artifact(package, buildspec_options)
+            work_dir = tempfile.mkdtemp(prefix="alppb-")
+            try:
+                print(">>Building {} locally...".format(package))
+                start = time.monotonic()
+                built = local.run_build(buildspec, artifact, work_dir,
+                                        runtime, image)
+                lines = local.read_log(work_dir)
+                if built is None:
+                    print("ERROR: {} did not build".format(package))
+                    for line in lines[-10:]:
+                        print(">>  {}".format(line))
+                    return False
+                print(">>{} took {:.0f}s".format(
+                    package, time.monotonic() - start))
+                path = local.deliver_file(built, artifact, **delivery)
+                if cache_dir is not None and path is not None and \
+                        delivery.get('output_dir') is None:
+                    cache.store_local(
+                        cache_dir, artifact_cache_key(
+                            package, py_version, buildspec_options, image),
+                        path, max_cache_bytes, suffix_of(path))
+                return True
+            except Exception as err:  # pylint: disable=broad-except
+                print("ERROR: {} failed: {}".format(package, err))
+                return False
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return dict(zip(packages, executor.map(build_one, packages)))
+
+
+def plan_builds(packages, py_version, compute_type, overrides, history_data,
+                policy='time'):
+    """
+    Decides which compute type each package is built on.
+
+    Parameters
+    ----------
+    packages : list
+        Names of the PyPi packages to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    compute_type : str
+        A compute type for every package, or "auto" to pick one per package
+        from the build history.
+    overrides : dict
+        Maps packages to a compute type that wins over compute_type.
+    history_data : dict
+        The build history from history.load().
+    policy : str
+        "time" or "cost", see history.choose_compute_type().
+
+    Returns
+    -------
+    dict
+        Maps each package to a dict with its "compute_type" and its
+        "expected_duration" in seconds (None if unknown).
+    """
+    plans = {}
+    for package in packages:
+        chosen = overrides.get(package, compute_type)
+        if chosen == 'auto':
+            chosen, _ = history.choose_compute_type(
+                history_data, package, py_version, policy)
+            print(">>{} will be built on {}...".format(package, chosen))
+        plans[package] = {
+            'compute_type': chosen,
+            'expected_duration': history.estimate_duration(
+                history_data, package, py_version, chosen),
+        }
+    return plans
+
+
+def print_build_report(package, build, tailer=None):
+    """
+    Prints how long each phase of a finished build took and, if its logs
+    were tailed, how many dependencies came from pip's cache, how many had
+    to be compiled and how many bytes pruning saved.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package that was built.
+    build : dict
+        The build as returned by batch_get_builds.
+    tailer : logs.LogTailer
+        The tailer that has been following the build's logs, if any.
+
+    Returns
+    -------
+    """
+    phases = codebuild.phase_durations(build)
+    report = ", ".join("{} {}s".format(phase, seconds)
+                       for phase, seconds in phases.items())
+    if tailer is not None:
+        try:
+            tailer.fetch(build)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        counts = tailer.counts(build.get('id'))
+        report += "; pip cache: {} cached, {} compiled".format(
+            counts.get('cached', 0), counts.get('compiled', 0))
+        pruned = tailer.captured(build.get('id')).get('pruned')
+        if pruned is not None:
+            saved, total = (int(value) for value in pruned)
+            report += "; pruned {:.1f} of {:.1f} MB ({:.0%})".format(
+                saved / 1024 ** 2, total / 1024 ** 2, saved / max(1, total))
+    print(">>{} took {}s ({})".format(
+        package, sum(seconds for seconds in phases.values()), report))
+
+
+def print_log_tail(tailer, build):
+    """
+    Prints the last log lines of a build that did not succeed.
+
+    Parameters
+    ----------
+    tailer : logs.LogTailer
+        The tailer that has been following the build's logs.
+    build : dict
+        The build as returned by batch_get_builds.
+
+    Returns
+    -------
+    """
+    try:
+        tailer.fetch(build)
+    except Exception:  # pylint: disable=broad-except
+        pass
+    lines = tailer.recent(build.get('id'))
+    if lines:
+        print(">>Last {} log lines of {}:".format(len(lines), build.get('id')))
+        for line in lines:
+            print(">>  {}".format(line))
+
+
+def print_summary(results, output_dir=None, buildspec_options=None,
+                  delivery=None, layer_arns=None, py_version=None):
+    """
+    Prints which builds passed and which failed.
+
+    Parameters
+    ----------
+    results : dict
+        Maps each package to True if it was built, False otherwise.
+    output_dir : str
+        Directory the artifacts were extracted into, or None if they were
+        downloaded.
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec(), which name
+        the artifacts.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact().
+    layer_arns : dict
+        Maps packages published as Lambda layers to the layer version ARN.
+    py_version : str
+        The Python version the packages were built for, if several were.
+
+    Returns
+    -------
+    """
+    print("Build summary{}:".format(
+        " for Python {}".format(py_version) if py_version else ""))
+    for package, passed in results.items():
+        outputs = []
+        if passed and (delivery or {}).get('download', True):
+            outputs.append(output_dir or delivered_name(
+                package_artifact(package, buildspec_options), delivery))
+        if passed and package in (layer_arns or {}):
+            outputs.append(layer_arns[package])
+        print(">>{} {}{}".format(
+            "PASSED" if passed else "FAILED", package,
+            " -> {}".format(", ".join(outputs)) if outputs else ""))
+
+
+def enable_metadata(args):
+    """ Turns the metadata cache on unless --no-metadata-cache was given """
+    if not args.no_metadata_cache:
+        metadata.enable(args.metadata_file)
+
+
+def cleanup_tasks(iam_client, codebuild_client, owned):
+    """
+    Plans deleting the role and project this run created, see
+    tasks.run_tasks(). Both are kept while builds of other runs use them.
+
+    Parameters
+    ----------
+    iam_client : botocore.client.iam
+        A boto3 client for IAM.
+    codebuild_client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+    owned : set
+        'role' and/or 'project' if this run created them.
+
+    Returns
+    -------
+    dict
+        The cleanup tasks.
+    """
+    if not owned:
+        return {}
+
+    def check_in_use(done):
+        """ Finds builds of other runs still on the project. """
+        in_use = codebuild.project_in_use(codebuild_client)
+        if in_use:
+            print(">>Other builds are using alppbBuilder, keeping it and "
+                  "alppbBuilderRole for `alppb teardown`...")
+        return in_use
+
+    cleanup = {'in_use': (check_in_use, [])}
+    if 'project' in owned:
+        cleanup['delete_project'] = (
+            lambda done: done['in_use'] or
+            codebuild.delete_build_project(codebuild_client), ['in_use'])
+    if 'role' in owned:
+        cleanup['delete_role'] = (
+            lambda done: done['in_use'] or
+            iam.delete_role_if_exists(iam_client), ['in_use'])
+    return cleanup
+
+
+def teardown(args):
+    """ Deletes the resources kept by --warm """
+    print("Starting alppb teardown...")
+    enable_metadata(args)
+    validate_region(args.region)
+    check_for_boto_credentials()
+
+    iam_client = create_client('iam', args.region)
+    codebuild_client = create_client('codebuild', args.region)
+
+    codebuild.delete_build_project(codebuild_client)
+    iam.delete_role_if_exists(iam_client)
+
+    print("SUCCESS")
+    exit(0)
+
+
+def run_server(args):
+    """ Serves build requests until interrupted """
     bucket = args.bucket
-    # If region is None boto3 will determine the region to use. See more at,
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide
-    # /configuration.html#configuring-credentials
     region = args.region
     py_version = args.python
+    # Artifacts are delivered in a directory of their own later on, so
+    # relative paths have to be resolved first.
+    for option in ('socket', 'cache_dir', 'metadata_file'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    cache_dir = args.cache_dir or cache.default_cache_dir()
+    max_cache_bytes = args.cache_size * 1024 ** 2
+    buildspec_options = {}
 
-    print("Starting alppb...")
+    print("Starting alppb serve...")
+    enable_metadata(args)
+    validate_region(region)
     check_for_boto_credentials()
-
-    # Create boto3 clients/resources used below.
     iam_client = create_client('iam', region)
     codebuild_client = create_client('codebuild', region)
-    s3_resource = create_resource('s3', region)
     s3_client = create_client('s3', region)
+    s3_resource = create_resource('s3', region)
+    check_bucket_region(s3_client, codebuild_client, bucket, [])
+    # Without --warm, only what this server created is deleted on exit.
+    owned = set()
+    if args.warm:
+        role = iam.ensure_role(iam_client, bucket)
+        codebuild.ensure_build_project(codebuild_client, role)
+    else:
+        role, created = iam.create_role(iam_client, bucket)
+        if created:
+            owned.add('role')
+        if codebuild.create_build_project(codebuild_client, role):
+            owned.add('project')
+    backend = CodeBuildBackend(codebuild_client, s3_resource, s3_client,
+                               bucket)
+    # Artifacts are delivered here before they are moved into the cache.
+    os.chdir(tempfile.mkdtemp(prefix="alppb-serve-"))
+    # Packages with the same artifact name, e.g. "lxml==4.2" and
+    # "lxml>=4.2", share a key in S3, so they are built one after another.
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def build_one(package):
+        """ Builds a package into the cache and returns its path. """
+        artifact = package_artifact(package, buildspec_options)
+        key = artifact_cache_key(package, py_version, buildspec_options)
+        path = cache.local_path(cache_dir, key, suffix_of(artifact))
+        with locks_lock:
+            lock = locks.setdefault(artifact, threading.Lock())
+        with lock:
+            if cache.lookup_local(cache_dir, key, suffix_of(artifact)):
+                return {'package': package, 'status': 'SUCCEEDED',
+                        'artifact': path}
+            built = restore_cached(s3_resource, s3_client, bucket, package,
+                                   py_version, cache_dir, max_cache_bytes,
+                                   None, buildspec_options) or \
+                backend.build([package], py_version, 1, cache_dir,
+                              max_cache_bytes, None,
+                              buildspec_options)[package]
+            if os.path.exists(artifact):
+                os.remove(artifact)
+        return {'package': package,
+                'status': 'SUCCEEDED' if built else 'FAILED',
+                'artifact': path if built else None}
+
+    def resolve(body):
+        """ Checks a request and keys it by its artifact. """
+        package = body.get('package') if isinstance(body, dict) else None
+        if not isinstance(package, str) or not package.strip():
+            raise ValueError("Expected {\"package\": \"<name>\"}")
+        if body.get('python', py_version) != py_version:
+            raise ValueError("This server builds for Python {}".format(
+                py_version or "3.6"))
+        return (artifact_cache_key(package, py_version, buildspec_options),
+                package)
+
+    service = serve.BuildService(build_one, args.concurrency)
+    server = serve.create_server(serve.make_handler(service, resolve),
+                                 args.host, args.port, args.socket)
+    print(">>Listening on {}".format(
+        args.socket or "http://{}:{}".format(args.host, args.port)))
+    serve.stop_on_sigterm()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping alppb serve...")
+    finally:
+        server.server_close()
+        service.shutdown()
+        if not args.warm:
+            tasks.run_tasks("Cleanup", cleanup_tasks(
+                iam_client, codebuild_client, owned), {}, keep_going=True)
+    exit(0)
+
 
-    # Check if S3 bucket is in the same region as target CodeBuild region.
+def check_bucket_region(s3_client, codebuild_client, bucket, packages):
+    """
+    Checks that the S3 bucket is in the same region as the target
+    CodeBuild region.
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        A boto3 client for S3.
+    codebuild_client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+    bucket : str
+        Name of the bucket the build artifacts will be put in.
+    packages : list
+        Names of the PyPi packages being built, used in the error message.
+
+    Returns
+    -------
+    str
+        Region of the bucket.
+
+    Raises
+    ------
+    errors.RegionError
+        If the regions differ.
+    """
     bucket_region = s3.bucket_region(s3_client, bucket)
     codebuild_region = codebuild_client._client_config.__dict__\
         .get('_user_provided_options').get('region_name')
     if bucket_region != codebuild_region:
-        print("ERROR: Bucket and CodeBuild project must be in the same "
-              "region. Bucket is in {}, but the region being used for "
-              "CodeBuild is {}. Recommended Action: Set the --region flag "
-              "to {}. e.g. `alppb {} {} --region {}`".format(
-                bucket_region, codebuild_region, bucket_region, package,
-                bucket, bucket_region))
+        raise errors.RegionError(
+            "Bucket and CodeBuild project must be in the same region. "
+            "Bucket is in {}, but the region being used for CodeBuild is "
+            "{}. Recommended Action: Set the --region flag to {}. e.g. "
+            "`alppb {} {} --region {}`".format(
+                bucket_region, codebuild_region, bucket_region,
+                " ".join(packages), bucket, bucket_region))
+    return bucket_region
+
+
+def version_settings(args, py_version, matrix=False):
+    """
+    Works out the Buildspec options and delivery of the builds for one
+    Python version.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The parsed arguments of the build command.
+    py_version : str
+        Python version being built for, or None for the default.
+    matrix : bool
+        True if several Python versions are built in one run. Their
+        artifacts are then named, and extracted, apart.
+
+    Returns
+    -------
+    dict
+        The "buildspec_options" and "delivery" of the version.
+    """
+    buildspec_options = {
+        'wheelhouse': (codebuild.wheelhouse_uri(args.bucket, py_version)
+                       if args.wheelhouse else None),
+        'pip_cache': args.build_cache is not None,
+        'archive_format': args.format,
+        'compression_level': args.compression_level,
+        'layer': args.layer,
+        'prune': (codebuild.prune_rules(args.slim_exclude, args.slim_include,
+                                        args.strip, args.precompile)
+                  if args.slim else None),
+    }
+    output_dir = args.output_dir
+    if matrix:
+        buildspec_options['artifact_suffix'] = '-py{}'.format(py_version)
+        if output_dir is not None:
+            output_dir = os.path.join(output_dir,
+                                      'python{}'.format(py_version))
+    delivery = {
+        'output_dir': output_dir,
+        'config': s3.transfer_config(args.part_size, args.transfer_threads),
+        'progress': args.progress,
+        'to_zip': args.to_zip,
+        'download': args.download,
+    }
+    return {'buildspec_options': buildspec_options, 'delivery': delivery}
+
+
+def build(args):
+    """ Builds, downloads and cleans up after the requested packages """
+    # Duplicates would race for the same artifact key, so build each once.
+    packages = list(dict.fromkeys(args.package))
+    bucket = args.bucket
+    # If region is None boto3 will determine the region to use. See more at,
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide
+    # /configuration.html#configuring-credentials
+    region = args.region
+    # Every version shares the setup and cleanup, and builds concurrently.
+    versions = args.python or [None]
+    matrix = len(versions) > 1
+    settings = {py_version: version_settings(args, py_version, matrix)
+                for py_version in versions}
+    cache_dir = None if args.no_cache else \
+        args.cache_dir or cache.default_cache_dir()
+    max_cache_bytes = args.cache_size * 1024 ** 2
+
+    if args.backend != 'codebuild':
+        build_locally(args, packages, versions, cache_dir, max_cache_bytes,
+                      settings)
+
+    print("Starting alppb...")
+    enable_metadata(args)
+    validate_region(region)
+    check_for_boto_credentials()
+    # Each concurrent download uses several connections of the shared S3
+    # client, so size the pool for the build and transfer concurrency.
+    clients.configure(max_pool_connections=max(
+        clients.DEFAULT_OPTIONS['max_pool_connections'],
+        args.concurrency * args.transfer_threads))
+
+    def restore(done):
+        """ Restores what it can of every version from the cache. """
+        return {py_version: restore_from_cache(
+            done['s3_resource'], done['s3_client'], bucket, packages,
+            py_version, cache_dir, max_cache_bytes, args.concurrency,
+            settings[py_version]['delivery'],
+            settings[py_version]['buildspec_options'], publish[py_version])
+                for py_version in versions}
+
+    # Setup steps run as soon as the steps they depend on are done, so
+    # independent AWS calls overlap. `done` holds the finished steps, and
+    # `owned` the resources this run created, which cleanup deletes.
+    owned = set()
+
+    def all_cached(done):
+        """ True if the cache had every package of every version. """
+        return all(len(done['cached'][py_version]) == len(packages)
+                   for py_version in versions)
+
+    def create_role(done):
+        """ Creates the role if any package still needs building. """
+        if all_cached(done):
+            return None
+        if args.warm:
+            return iam.ensure_role(done['iam_client'], bucket)
+        role, created = iam.create_role(done['iam_client'], bucket)
+        if created:
+            owned.add('role')
+        return role
+
+    def create_project(done):
+        """ Creates the project if any package still needs building. """
+        if done['role'] is None:
+            return False
+        # The project is generic, every build brings its own Buildspec,
+        # image and artifact settings.
+        project_cache = codebuild.project_cache(args.build_cache, bucket)
+        if args.warm:
+            codebuild.ensure_build_project(done['codebuild_client'],
+                                           done['role'], project_cache)
+        elif codebuild.create_build_project(done['codebuild_client'],
+                                            done['role'], project_cache):
+            owned.add('project')
+        if args.invalidate_build_cache:
+            codebuild.invalidate_cache(done['codebuild_client'])
+        return True
+
+    layer_arns = {py_version: {} for py_version in versions}
+
+    def layer_publisher(py_version):
+        """ Publishes artifacts in S3 as Lambda layer versions. """
+        def publish_layer(package, bucket, key):
+            """ Publishes an artifact in S3 as a Lambda layer version. """
+            layer_arns[py_version][package] = layers.publish_layer(
+                done['lambda_client'], bucket, key, package, py_version)
+        return publish_layer
+
+    publish = {py_version: layer_publisher(py_version) if args.layer
+               else None for py_version in versions}
+
+    setup = {
+        'iam_client': (lambda done: create_client('iam', region), []),
+        'codebuild_client': (
+            lambda done: create_client('codebuild', region), []),
+        's3_client': (lambda done: create_client('s3', region), []),
+        's3_resource': (lambda done: create_resource('s3', region), []),
+        'logs_client': (
+            lambda done: create_client('logs', region)
+            if args.tail_logs else None, []),
+        'lambda_client': (
+            lambda done: create_client('lambda', region)
+            if args.layer else None, []),
+        'bucket_region': (
+            lambda done: check_bucket_region(done['s3_client'],
+                                             done['codebuild_client'],
+                                             bucket, packages),
+            ['s3_client', 'codebuild_client']),
+        # Artifacts built before with the same inputs don't need CodeBuild.
+        'cached': (
+            lambda done: restore(done) if cache_dir is not None
+            else {py_version: {} for py_version in versions},
+            ['bucket_region', 's3_resource', 'lambda_client']),
+        # Create alppb resources, or reuse them if they were kept by --warm,
+        # once the cache shows they are needed.
+        'role': (create_role, ['iam_client', 'cached']),
+        'project': (create_project, ['role', 'codebuild_client']),
+    }
+
+    history_path = args.history_file or history.default_history_path()
+    history_data = history.load(history_path)
+    plans = {py_version: plan_builds(packages, py_version, args.compute_type,
+                                     dict(args.compute_override or []),
+                                     history_data, args.compute_policy)
+             for py_version in versions}
+    history_lock = threading.Lock()
+
+    def history_recorder(py_version):
+        """ Remembers how long successful builds took. """
+        def record_history(package, build):
+            """ Records a successful build of the package. """
+            if build.get('buildStatus') == 'SUCCEEDED':
+                with history_lock:
+                    history.record(history_data, package, py_version, build)
+        return record_history
+
+    done = {}
+    try:
+        tasks.run_tasks("Setup", setup, done)
+        results = {py_version: dict(done['cached'][py_version])
+                   for py_version in versions}
+
+        def build_version(py_version):
+            """ Builds and downloads the artifacts of one version. """
+            to_build = [package for package in packages
+                        if package not in results[py_version]]
+            if not to_build:
+                return
+            backend = CodeBuildBackend(
+                done['codebuild_client'], done['s3_resource'],
+                done['s3_client'], bucket, done['logs_client'],
+                logs.DEFAULT_FATAL_PATTERNS + (args.fail_pattern or []),
+                plans[py_version], publish[py_version], args.batch_size)
+            # The versions split the concurrency between them.
+            results[py_version].update(backend.build(
+                to_build, py_version,
+                max(1, args.concurrency // len(versions)), cache_dir,
+                max_cache_bytes, settings[py_version]['delivery'],
+                settings[py_version]['buildspec_options'],
+                history_recorder(py_version)))
+
+        if any(len(results[py_version]) < len(packages)
+               for py_version in versions):
+            with timing.phase("Build"):
+                with ThreadPoolExecutor(max_workers=len(versions)) as pool:
+                    list(pool.map(build_version, versions))
+            try:
+                history.save(history_path, history_data)
+            except OSError as err:
+                print(">>Could not save the build history: {}".format(err))
+    except Exception:
+        # A cached answer may be what failed, so the next run asks AWS.
+        metadata.forget()
+        raise
+    finally:
+        # Cleanup phase. Runs even if setup or a build failed. Warm
+        # resources, and those of other runs, are kept until
+        # `alppb teardown`.
+        if not args.warm:
+            tasks.run_tasks("Cleanup", cleanup_tasks(
+                done.get('iam_client'), done.get('codebuild_client'), owned),
+                {}, keep_going=True)
+
+    if not all(all(results[py_version].get(package, False)
+                   for package in packages) for py_version in versions):
+        metadata.forget()
+    finish([dict(settings[py_version], layer_arns=layer_arns[py_version],
+                 results={package: results[py_version][package]
+                          for package in packages},
+                 output_dir=settings[py_version]['delivery']['output_dir'],
+                 py_version=py_version if matrix else None)
+            for py_version in versions])
+
+
+def build_locally(args, packages, versions, cache_dir, max_cache_bytes,
+                  settings):
+    """ Builds the requested packages with a LocalBackend """
+    print("Starting alppb with the {} backend...".format(args.backend))
+    if args.backend in local.RUNTIMES and shutil.which(args.backend) is None:
+        print("ERROR: {} was not found. Install it or use --backend process."
+              .format(args.backend))
         exit(1)
+    backend = LocalBackend(args.backend)
+    summaries = []
+    # Local builds share this machine, so versions are built in turn.
+    for py_version in versions:
+        buildspec_options = settings[py_version]['buildspec_options']
+        delivery = settings[py_version]['delivery']
+        results = {}
+        if cache_dir is not None:
+            with timing.phase("Setup"):
+                results = restore_from_cache(
+                    None, None, None, packages, py_version, cache_dir,
+                    max_cache_bytes, args.concurrency, delivery,
+                    buildspec_options, image=backend.image(py_version))
+        to_build = [package for package in packages
+                    if package not in results]
+        if to_build:
+            with timing.phase("Build"):
+                results.update(backend.build(
+                    to_build, py_version, args.concurrency, cache_dir,
+                    max_cache_bytes, delivery, buildspec_options))
+        summaries.append({
+            'results': {package: results[package] for package in packages},
+            'output_dir': delivery['output_dir'],
+            'buildspec_options': buildspec_options,
+            'delivery': delivery,
+            'py_version': py_version if len(versions) > 1 else None,
+        })
+    finish(summaries)
 
-    # Create alppb resources.
-    role = iam.create_role(iam_client, bucket)
-    buildspec = codebuild.generate_buildspec(package, py_version)
-    codebuild.create_build_project(codebuild_client, role, bucket, buildspec,
-                                   codebuild.determine_image(py_version))
-    codebuild.build_artifact(codebuild_client)
 
-    # Download the artifact.
-    s3.download_artifact(s3_resource, bucket)
+def finish(summaries):
+    """
+    Prints the summaries and exits, with status 1 if any build failed.
 
-    # Cleanup phase.
-    codebuild.delete_build_project(codebuild_client)
-    iam.delete_role(iam_client)
-    s3.delete_artifact(s3_client, bucket)
+    Parameters
+    ----------
+    summaries : list
+        Keyword arguments for print_summary(), one dict per Python version
+        that was built.
+
+    Returns
+    -------
+    """
+    results = []
+    for summary in summaries:
+        print_summary(**summary)
+        results.extend(summary['results'].values())
+    if not all(results):
+        print("ERROR: {} of {} builds failed".format(
+            results.count(False), len(results)))
+        exit(1)
 
     print("SUCCESS")
     exit(0)
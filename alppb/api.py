@@ -0,0 +1,518 @@
+"""
+A Python API for embedding alppb, e.g. in deploy pipelines. abuild() builds
+packages on an asyncio event loop: boto3 calls run on a small thread pool
+shared by every build, and waiting for CodeBuild is an asyncio sleep, so
+many builds and downloads share one loop without a thread per build.
+build() is the blocking version. Both return BuildResult objects and raise
+the exceptions in alppb.errors instead of exiting.
+
+    from alppb.api import abuild
+    results = await abuild(["lxml", "requests"], "my-bucket")
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import threading
+import time
+import weakref
+from . import alppb as core
+from . import cache
+from . import codebuild
+from . import errors
+from . import iam
+from . import layers
+from . import tasks
+from . import timing
+
+# Threads running blocking boto3 calls for every build in the process.
+MAX_WORKERS = 16
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+_LEASES = weakref.WeakKeyDictionary()
+
+
+def executor():
+    """
+    Gets the thread pool blocking boto3 calls run on, creating it on first
+    use.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    concurrent.futures.ThreadPoolExecutor
+        The shared pool.
+    """
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                           thread_name_prefix="alppb")
+        return _EXECUTOR
+
+
+class BuildResult(object):
+    """ The outcome of building one package. """
+
+    def __init__(self, package, succeeded, artifact=None, build_id=None,
+                 cached=False, layer_arn=None, phases=None, seconds=None,
+                 error=None):
+        """
+        Parameters
+        ----------
+        package : str
+            Name of the PyPi package.
+        succeeded : bool
+            True if the package was built, or restored from the cache, and
+            delivered.
+        artifact : str
+            Absolute path of the delivered zip, or of the directory it was
+            extracted into. None if nothing was delivered.
+        build_id : str
+            ID of the CodeBuild build, None for cached packages.
+        cached : bool
+            True if the artifact came from the cache.
+        layer_arn : str
+            ARN of the Lambda layer version it was published as, if any.
+        phases : dict
+            Seconds each CodeBuild phase took, e.g. {"BUILD": 42}.
+        seconds : float
+            Seconds from the start of the call until the package was done.
+        error : str
+            Why the package failed, if it did.
+        """
+        self.package = package
+        self.succeeded = succeeded
+        self.artifact = artifact
+        self.build_id = build_id
+        self.cached = cached
+        self.layer_arn = layer_arn
+        self.phases = phases or {}
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        return "BuildResult({!r}, succeeded={!r}, artifact={!r})".format(
+            self.package, self.succeeded, self.artifact)
+
+
+class ProjectLease(object):
+    """
+    Shares the IAM Role and CodeBuild project between abuild() calls
+    running at the same time on one event loop. The first call creates
+    them and the last one deletes those it created, unless they are kept
+    warm. Calls that need a different role, e.g. for another bucket, wait
+    until it is free.
+    """
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.users = 0
+        self.key = None
+        # Filled in by setup with the resources it created.
+        self.owned = set()
+
+    async def acquire(self, key, setup, teardown):
+        """
+        Waits until the project for key can be used.
+
+        Parameters
+        ----------
+        key : tuple
+            Identifies the role and project, e.g. their region and bucket.
+        setup : coroutine function
+            Creates the role and project, adding those it created to the
+            set it is called with. Only awaited by the first user.
+        teardown : coroutine function
+            Deletes the role and project in the set it is called with.
+            Awaited if setup fails.
+
+        Returns
+        -------
+        """
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.users == 0 or self.key == key)
+            if self.users == 0:
+                self.owned = set()
+                try:
+                    await setup(self.owned)
+                except Exception:
+                    # Setup may fail after creating the role, so undo it
+                    # like the last user would have.
+                    await teardown(self.owned)
+                    raise
+                self.key = key
+            self.users += 1
+
+    async def release(self, teardown):
+        """
+        Stops using the project.
+
+        Parameters
+        ----------
+        teardown : coroutine function
+            Deletes the role and project in the set it is called with. Only
+            awaited by the last user.
+
+        Returns
+        -------
+        """
+        async with self.condition:
+            self.users -= 1
+            if self.users == 0:
+                self.key = None
+                try:
+                    await teardown(self.owned)
+                finally:
+                    self.condition.notify_all()
+
+
+def project_lease(loop):
+    """ The ProjectLease of an event loop. """
+    if loop not in _LEASES:
+        _LEASES[loop] = ProjectLease()
+    return _LEASES[loop]
+
+
+async def abuild(packages, bucket, region=None, python="3.6", concurrency=4,
+                 output_dir=None, use_cache=True, cache_dir=None,
+                 cache_size=2048, warm=False, archive_format="zip",
+                 compression_level=None, slim=False, wheelhouse=False,
+                 layer=False, to_zip=False, compute_type=None,
+                 raise_on_failure=True, **poller_options):
+    """
+    Builds packages with AWS CodeBuild and delivers them to the current
+    directory, like the alppb command.
+
+    Parameters
+    ----------
+    packages : str or list
+        Name of the PyPi package to build, or a list of them.
+    bucket : str
+        Name of an existing S3 bucket in the build's region.
+    region : str
+        The AWS region to build in, or None to let boto3 decide.
+    python : str
+        Python version to build for. One of "2.7", "3.6", or "3.7".
+    concurrency : int
+        The maximum number of builds to run at the same time.
+    output_dir : str
+        Directory to extract the artifacts into instead of downloading the
+        zips.
+    use_cache : bool
+        If False, always build, without reading or writing the cache.
+    cache_dir : str
+        Directory built artifacts are cached in. Defaults to
+        cache.default_cache_dir().
+    cache_size : int
+        The maximum size of the local cache in MB.
+    warm : bool
+        If True, keep the IAM Role and CodeBuild project for later builds.
+    archive_format : str
+        One of codebuild.ARCHIVE_FORMATS.
+    compression_level : int
+        Compression level from 0 to 9.
+    slim : bool
+        If True, prune tests, docs and debug symbols before zipping.
+    wheelhouse : bool
+        If True, reuse and share wheels through the bucket.
+    layer : bool
+        If True, publish each artifact as an AWS Lambda layer version.
+    to_zip : bool
+        If True, convert downloaded tars to zips.
+    compute_type : str
+        The CodeBuild compute type to build on.
+    raise_on_failure : bool
+        If False, failed packages are only reported in the results.
+    poller_options
+        Passed through to codebuild.BuildPoller, e.g. min_delay.
+
+    Returns
+    -------
+    BuildResult or dict
+        The result of the package, or a dict of results by package when a
+        list was given.
+
+    Raises
+    ------
+    errors.CredentialsError, errors.RegionError, errors.BucketError
+        If the build can't start.
+    errors.BuildError
+        If raise_on_failure is True and any package failed. Its results
+        attribute has every result.
+    """
+    single = isinstance(packages, str)
+    packages = list(dict.fromkeys([packages] if single else packages))
+    # get_running_loop() needs Python 3.7.
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+
+    def call(function, *args, **kwargs):
+        """ Runs a blocking function on the shared thread pool. """
+        return loop.run_in_executor(
+            executor(), functools.partial(function, *args, **kwargs))
+
+    buildspec_options = {
+        'wheelhouse': (codebuild.wheelhouse_uri(bucket, python)
+                       if wheelhouse else None),
+        'archive_format': archive_format,
+        'compression_level': compression_level,
+        'layer': layer,
+        'prune': codebuild.prune_rules() if slim else None,
+    }
+    delivery = {'output_dir': output_dir, 'to_zip': to_zip}
+    cache_dir = (cache_dir or cache.default_cache_dir()) \
+        if use_cache else None
+    max_cache_bytes = cache_size * 1024 ** 2
+
+    def delivered(package):
+        """ Where a package's artifact ends up. """
+        return os.path.abspath(output_dir or core.delivered_name(
+            core.package_artifact(package, buildspec_options), delivery))
+
+    await call(core.validate_region, region)
+    await call(core.check_for_boto_credentials)
+    aws = await call(create_clients, region, layer)
+    await call(core.check_bucket_region, aws['s3'], aws['codebuild'],
+               bucket, packages)
+
+    layer_arns = {}
+
+    def publish_layer(package, bucket, key):
+        """ Publishes an artifact in S3 as a Lambda layer version. """
+        layer_arns[package] = layers.publish_layer(
+            aws['lambda'], bucket, key, package, python)
+
+    publish = publish_layer if layer else None
+
+    results = {}
+    if cache_dir is not None:
+        cached = await call(core.restore_from_cache, aws['s3_resource'],
+                            aws['s3'], bucket, packages, python, cache_dir,
+                            max_cache_bytes, concurrency, delivery,
+                            buildspec_options, publish)
+        for package in cached:
+            results[package] = BuildResult(
+                package, True, delivered(package), cached=True,
+                layer_arn=layer_arns.get(package),
+                seconds=time.monotonic() - start)
+
+    to_build = [package for package in packages if package not in results]
+    if to_build:
+        project_cache = codebuild.project_cache(None, bucket)
+
+        async def setup(owned):
+            """ Creates, or reuses, the role and project. """
+            if warm:
+                role = await call(iam.ensure_role, aws['iam'], bucket)
+                await call(codebuild.ensure_build_project, aws['codebuild'],
+                           role, project_cache)
+                return
+            role, created = await call(iam.create_role, aws['iam'], bucket)
+            if created:
+                owned.add('role')
+            if await call(codebuild.create_build_project, aws['codebuild'],
+                          role, project_cache):
+                owned.add('project')
+
+        async def teardown(owned):
+            """ Deletes the role and project if this lease created them. """
+            if not warm:
+                await call(tasks.run_tasks, "Cleanup", core.cleanup_tasks(
+                    aws['iam'], aws['codebuild'], owned), {},
+                    keep_going=True)
+
+        lease = project_lease(loop)
+        await lease.acquire((region, bucket, warm), setup, teardown)
+        try:
+            built = await run_builds(
+                call, aws, bucket, to_build, python, concurrency, cache_dir,
+                max_cache_bytes, delivery, buildspec_options, publish,
+                compute_type, poller_options)
+        finally:
+            await lease.release(teardown)
+        for result in built.values():
+            if result.succeeded:
+                result.artifact = delivered(result.package)
+                result.layer_arn = layer_arns.get(result.package)
+            result.seconds = time.monotonic() - start
+        results.update(built)
+
+    results = {package: results[package] for package in packages}
+    if raise_on_failure and not all(result.succeeded
+                                    for result in results.values()):
+        raise errors.BuildError(results)
+    return results[packages[0]] if single else results
+
+
+def build(packages, bucket, **options):
+    """
+    Builds packages and waits for them. Takes the same arguments as
+    abuild(), which should be used instead inside a running event loop.
+
+    Parameters
+    ----------
+    packages : str or list
+        Name of the PyPi package to build, or a list of them.
+    bucket : str
+        Name of an existing S3 bucket in the build's region.
+    options
+        Keyword arguments for abuild().
+
+    Returns
+    -------
+    BuildResult or dict
+        See abuild().
+    """
+    # A new loop rather than asyncio.run(), which needs Python 3.7.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(abuild(packages, bucket, **options))
+    finally:
+        loop.close()
+
+
+def create_clients(region, layer=False):
+    """
+    Gets the shared boto3 clients a build uses.
+
+    Parameters
+    ----------
+    region : str
+        The AWS region, or None to let boto3 decide.
+    layer : bool
+        If True, include a client for AWS Lambda.
+
+    Returns
+    -------
+    dict
+        The clients by service, plus the S3 resource as "s3_resource".
+    """
+    return {
+        'iam': core.create_client('iam', region),
+        'codebuild': core.create_client('codebuild', region),
+        's3': core.create_client('s3', region),
+        's3_resource': core.create_resource('s3', region),
+        'lambda': core.create_client('lambda', region) if layer else None,
+    }
+
+
+async def run_builds(call, aws, bucket, packages, py_version, concurrency,
+                     cache_dir, max_cache_bytes, delivery, buildspec_options,
+                     publish, compute_type, poller_options):
+    """
+    Builds packages as concurrent CodeBuild builds, like
+    alppb.build_packages(), but polls and waits on the event loop. Only
+    the boto3 calls and downloads use the thread pool.
+
+    Parameters
+    ----------
+    call : callable
+        Runs a blocking function on the thread pool and returns an
+        awaitable of its result.
+    aws : dict
+        The clients from create_clients().
+    bucket : str
+        Name of the bucket the build artifacts will be put in.
+    packages : list
+        Names of the PyPi packages to build.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+    concurrency : int
+        The maximum number of builds to run at the same time.
+    cache_dir : str
+        Path of the local cache directory, or None to skip caching.
+    max_cache_bytes : int
+        The maximum total size of the local cache.
+    delivery : dict
+        Keyword arguments for s3.deliver_artifact().
+    buildspec_options : dict
+        Keyword arguments for codebuild.generate_buildspec().
+    publish : callable
+        Optional function to publish each artifact with.
+    compute_type : str
+        The CodeBuild compute type to build on, or None for the project's.
+    poller_options : dict
+        Keyword arguments for codebuild.BuildPoller.
+
+    Returns
+    -------
+    dict
+        Maps each package to its BuildResult.
+    """
+    queue, clashes = core.unique_artifacts(packages, buildspec_options)
+    results = {}
+    for package, first in clashes.items():
+        results[package] = BuildResult(
+            package, False,
+            error="Builds the same artifact as {}".format(first))
+    builds = {}
+    downloads = {}
+    poller = codebuild.BuildPoller(aws['codebuild'], **poller_options)
+
+    async def start_next():
+        """ Starts queued builds until the concurrency limit is reached. """
+        while queue and len(poller.pending) < concurrency:
+            package = queue.pop(0)
+            try:
+                build_id = await call(
+                    codebuild.start_build, aws['codebuild'],
+                    core.package_buildspec(package, py_version,
+                                           buildspec_options),
+                    compute_type, codebuild.determine_image(py_version),
+                    bucket)
+            except Exception as err:  # pylint: disable=broad-except
+                print("ERROR: {} failed to start: {}".format(package, err))
+                results[package] = BuildResult(package, False, error=str(err))
+                continue
+            builds[build_id] = package
+            poller.track(build_id)
+
+    await start_next()
+    while poller.pending:
+        try:
+            changed = await call(poller.poll)
+        except Exception as err:  # pylint: disable=broad-except
+            for build_id in poller.pending:
+                results[builds[build_id]] = BuildResult(
+                    builds[build_id], False, build_id=build_id,
+                    error="Polling builds failed: {}".format(err))
+            break
+        for build in changed:
+            codebuild.print_build_change(build)
+            status = str(build.get('buildStatus'))
+            if status not in codebuild.BuildPoller.TERMINAL_STATUSES:
+                continue
+            package = builds[build.get('id')]
+            core.print_build_report(package, build)
+            timing.add_build(build, package)
+            result = BuildResult(package, False, build_id=build.get('id'),
+                                 phases=codebuild.phase_durations(build))
+            results[package] = result
+            if status == 'SUCCEEDED':
+                downloads[package] = call(
+                    core.fetch_artifact, aws['s3_resource'], aws['s3'],
+                    bucket, codebuild.artifact_prefix(build), package,
+                    py_version, cache_dir, max_cache_bytes, delivery,
+                    buildspec_options, publish)
+            else:
+                print("ERROR: {} did not build, status is: {}".format(
+                    package, status))
+                result.error = "Build status is {}".format(status)
+        await start_next()
+        if poller.pending:
+            with timing.span("api.run_builds.sleep"):
+                await asyncio.sleep(poller.next_delay(changed))
+
+    for package, download in downloads.items():
+        try:
+            await download
+            results[package].succeeded = True
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR: {} failed to download: {}".format(package, err))
+            results[package].error = "Download failed: {}".format(err)
+    return results
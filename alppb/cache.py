@@ -0,0 +1,251 @@
+"""
+Content-addressed cache of build artifacts, kept in a local directory and
+under a prefix in the S3 bucket.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from botocore.exceptions import ClientError
+from . import files
+from . import timing
+
+S3_PREFIX = 'alppbCache'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def default_cache_dir():
+    """
+    Determines the local directory artifacts are cached in. Respects
+    $XDG_CACHE_HOME and falls back to ~/.cache.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    str
+        Path of the local cache directory.
+    """
+    return files.default_path('cache', 'artifacts')
+
+
+def cache_key(package, py_version, image, buildspec):
+    """
+    Hashes every input that determines the contents of a build artifact.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package being built.
+    py_version : str
+        Python version being used.
+    image : str
+        The Docker image the build runs in. Use codebuild.determine_image().
+    buildspec : str
+        The Buildspec in YAML. Use codebuild.generate_buildspec().
+
+    Returns
+    -------
+    str
+        Hex digest identifying the artifact.
+    """
+    inputs = json.dumps([package, py_version, image, buildspec])
+    return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+
+def s3_key(key, suffix='.zip'):
+    """
+    Gets the S3 key an artifact is cached under.
+
+    Parameters
+    ----------
+    key : str
+        The cache key from cache_key().
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    str
+        The S3 key, e.g. "alppbCache/<key>.zip".
+    """
+    return '{}/{}{}'.format(S3_PREFIX, key, suffix)
+
+
+def local_path(cache_dir, key, suffix='.zip'):
+    """
+    Gets the path an artifact is cached at locally.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path of the local cache directory.
+    key : str
+        The cache key from cache_key().
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    str
+        Path of the cached artifact.
+    """
+    return os.path.join(cache_dir, '{}{}'.format(key, suffix))
+
+
+@timing.traced
+def lookup_local(cache_dir, key, suffix='.zip'):
+    """
+    Looks an artifact up in the local cache. A hit marks the entry as
+    recently used so it is evicted last.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path of the local cache directory.
+    key : str
+        The cache key from cache_key().
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    str
+        Path of the cached artifact, or None on a miss.
+    """
+    path = local_path(cache_dir, key, suffix)
+    if not os.path.isfile(path):
+        return None
+    os.utime(path, None)
+    return path
+
+
+@timing.traced
+def store_local(cache_dir, key, path, max_bytes=DEFAULT_MAX_BYTES,
+                suffix='.zip'):
+    """
+    Copies an artifact into the local cache and evicts the least recently
+    used entries until the cache fits in max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path of the local cache directory.
+    key : str
+        The cache key from cache_key().
+    path : str
+        Path of the artifact to cache.
+    max_bytes : int
+        The maximum total size of the local cache.
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # Copy to a temporary file first so readers never see a partial entry.
+    handle, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(handle)
+    shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, local_path(cache_dir, key, suffix))
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries from the local cache until it
+    fits in max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path of the local cache directory.
+    max_bytes : int
+        The maximum total size of the local cache.
+
+    Returns
+    -------
+    list
+        Paths of the evicted entries.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        # Skip entries that are still being copied in.
+        if name.endswith('.tmp'):
+            continue
+        stat = os.stat(os.path.join(cache_dir, name))
+        entries.append((stat.st_mtime, stat.st_size,
+                        os.path.join(cache_dir, name)))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted.append(path)
+    return evicted
+
+
+@timing.traced
+def lookup_s3(client, bucket, key, suffix='.zip'):
+    """
+    Checks whether an artifact is cached in the S3 bucket.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the cache lives in.
+    key : str
+        The cache key from cache_key().
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    bool
+        True if the artifact is cached in S3.
+    """
+    try:
+        client.head_object(Bucket=bucket, Key=s3_key(key, suffix))
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise err
+    return True
+
+
+@timing.traced
+def store_s3(client, bucket, key, artifact_key, suffix='.zip'):
+    """
+    Copies a freshly built artifact to the S3 cache prefix. The copy happens
+    inside S3, so nothing is uploaded from the local machine.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the artifact and cache live in.
+    key : str
+        The cache key from cache_key().
+    artifact_key : str
+        The S3 key of the build artifact.
+    suffix : str
+        File suffix of the artifact's archive format, e.g. ".tar.xz".
+
+    Returns
+    -------
+    """
+    client.copy_object(Bucket=bucket, Key=s3_key(key, suffix),
+                       CopySource={'Bucket': bucket, 'Key': artifact_key})
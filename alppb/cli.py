@@ -0,0 +1,512 @@
+"""
+alppb.cli: command line parsing and the entry point of the app. This module
+only imports the standard library so that `alppb -h` and `alppb -v` start
+fast. boto3 and the AWS modules are imported once a command runs.
+"""
+import argparse
+import re
+import sys
+from . import errors
+from . import timing
+from .__version__ import __version__
+from .compute import COMPUTE_TYPES
+
+
+def positive_int(value):
+    """
+    argparse type for options that require an integer greater than zero.
+
+    Parameters
+    ----------
+    value : str
+        The raw value passed on the command line.
+
+    Returns
+    -------
+    int
+        The parsed value.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "{} is not a positive integer".format(value))
+    return number
+
+
+def compute_override(value):
+    """
+    argparse type for PACKAGE=COMPUTE_TYPE pairs.
+
+    Parameters
+    ----------
+    value : str
+        The raw value passed on the command line.
+
+    Returns
+    -------
+    tuple
+        The package and compute type.
+    """
+    package, _, compute_type = value.rpartition("=")
+    if not package or compute_type not in COMPUTE_TYPES:
+        raise argparse.ArgumentTypeError(
+            "{} is not PACKAGE=COMPUTE_TYPE with COMPUTE_TYPE one of {}"
+            .format(value, ", ".join(COMPUTE_TYPES)))
+    return package, compute_type
+
+
+PYTHON_VERSIONS = ["2.7", "3.6", "3.7"]
+
+
+def python_versions(value):
+    """
+    argparse type for a comma separated list of Python versions.
+
+    Parameters
+    ----------
+    value : str
+        The raw value passed on the command line, e.g. "3.6,3.7".
+
+    Returns
+    -------
+    list
+        The versions, without duplicates.
+    """
+    versions = [version.strip() for version in value.split(",")]
+    for version in versions:
+        if version not in PYTHON_VERSIONS:
+            raise argparse.ArgumentTypeError(
+                "{} is not one of {}".format(version,
+                                             ", ".join(PYTHON_VERSIONS)))
+    return list(dict.fromkeys(versions))
+
+
+def regular_expression(value):
+    """
+    argparse type for options that take a regular expression.
+
+    Parameters
+    ----------
+    value : str
+        The raw value passed on the command line.
+
+    Returns
+    -------
+    str
+        The value, once it is known to compile.
+    """
+    try:
+        re.compile(value)
+    except re.error as err:
+        raise argparse.ArgumentTypeError(
+            "{} is not a valid regular expression: {}".format(value, err))
+    return value
+
+
+def add_region_argument(parser):
+    """ Adds the --region option shared by every command. """
+    # Valid regions are checked after parsing, see alppb.validate_region(),
+    # so that -h and -v don't have to load boto3 and its endpoint data.
+    parser.add_argument("-r", "--region",
+                        help="The AWS region to use for building the package. "
+                             "This region must match the region that the "
+                             "specified S3 bucket exists in.",
+                        type=str)
+
+
+def add_metadata_arguments(parser):
+    """ Adds the metadata cache options shared by every command. """
+    parser.add_argument("--metadata-file",
+                        help="Where answers that rarely change, e.g. the "
+                             "bucket's region and the IAM Role's ARN, are "
+                             "cached between runs. Defaults to "
+                             "~/.cache/alppb/metadata.json.",
+                        type=str)
+
+    parser.add_argument("--no-metadata-cache",
+                        action="store_true",
+                        help="Ask AWS every time instead of using the "
+                             "metadata cache.")
+
+
+def parse_teardown_args(argv):
+    """ Setup ArgumentParser for `alppb teardown` """
+    parser = argparse.ArgumentParser(
+        prog="alppb teardown",
+        description="Deletes the IAM Role and CodeBuild project kept around "
+                    "by --warm.")
+
+    add_region_argument(parser)
+    add_metadata_arguments(parser)
+
+    args = parser.parse_args(argv)
+    args.command = "teardown"
+    return args
+
+
+def parse_serve_args(argv):
+    """ Setup ArgumentParser for `alppb serve` """
+    parser = argparse.ArgumentParser(
+        prog="alppb serve",
+        description="Serves build requests over HTTP. POST /build with "
+                    "{\"package\": \"lxml\"} builds a package into the "
+                    "artifact cache and answers with its path. Identical "
+                    "requests in flight share one build.")
+
+    parser.add_argument("bucket",
+                        help="Name of the S3 bucket to use.",
+                        type=str)
+
+    add_region_argument(parser)
+
+    parser.add_argument("-p", "--python",
+                        choices=PYTHON_VERSIONS,
+                        help="The Python version to build for. Defaults to "
+                             "3.6 if not specified.",
+                        type=str)
+
+    parser.add_argument("-c", "--concurrency",
+                        default=4,
+                        help="The maximum number of builds to run at the "
+                             "same time. Defaults to 4.",
+                        type=positive_int)
+
+    parser.add_argument("--host",
+                        default="127.0.0.1",
+                        help="Address to listen on. Defaults to 127.0.0.1.",
+                        type=str)
+
+    parser.add_argument("--port",
+                        default=8080,
+                        help="Port to listen on. Defaults to 8080.",
+                        type=positive_int)
+
+    parser.add_argument("--socket",
+                        help="Listen on this Unix socket instead of a port.",
+                        type=str)
+
+    parser.add_argument("--cache-dir",
+                        help="Directory built artifacts are cached in. "
+                             "Defaults to ~/.cache/alppb/artifacts.",
+                        type=str)
+
+    parser.add_argument("--cache-size",
+                        default=2048,
+                        help="Maximum size of the local cache in MB. "
+                             "Defaults to 2048.",
+                        type=positive_int)
+
+    parser.add_argument("-w", "--warm",
+                        action="store_true",
+                        help="Keep the IAM Role and CodeBuild project when "
+                             "the server stops.")
+
+    add_metadata_arguments(parser)
+
+    args = parser.parse_args(argv)
+    args.command = "serve"
+    return args
+
+
+def parse_args(argv=None):
+    """ Setup ArgumentParser """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(
+        epilog="Other commands: alppb teardown [-r REGION], "
+               "alppb serve BUCKET [-h]")
+
+    parser.add_argument("package",
+                        help="The PyPi package(s) you want to build on "
+                             "Amazon Linux. Each package is built as its "
+                             "own concurrent CodeBuild build.",
+                        nargs="+",
+                        type=str)
+
+    parser.add_argument("bucket",
+                        help="Name of the S3 bucket to use. This bucket "
+                             "temporarily stores the build artifact and is "
+                             "used AWS CodeBuild.",
+                        type=str)
+
+    add_region_argument(parser)
+
+    parser.add_argument("-p", "--python",
+                        help="The Python version to use, one of {}. Several "
+                             "versions, e.g. 3.6,3.7, are built in one run "
+                             "with their artifacts named alppb-<package>-"
+                             "py<version>. Defaults to 3.6 if not "
+                             "specified.".format(", ".join(PYTHON_VERSIONS)),
+                        type=python_versions)
+
+    parser.add_argument("-b", "--backend",
+                        choices=["codebuild", "docker", "podman", "process"],
+                        default="codebuild",
+                        help="Where to build. docker and podman run the "
+                             "same Buildspec locally in the alppb images, "
+                             "process runs it with this Python, for "
+                             "testing. Defaults to codebuild.",
+                        type=str)
+
+    parser.add_argument("-c", "--concurrency",
+                        default=4,
+                        help="The maximum number of builds to run at the "
+                             "same time. Defaults to 4.",
+                        type=positive_int)
+
+    parser.add_argument("--batch-size",
+                        default=1,
+                        help="The number of packages to build together in "
+                             "one CodeBuild build, so small packages pay "
+                             "for provisioning once per batch. Each package "
+                             "still gets its own artifact. Defaults to 1.",
+                        type=positive_int)
+
+    parser.add_argument("--cache-dir",
+                        help="Directory built artifacts are cached in. "
+                             "Defaults to ~/.cache/alppb/artifacts.",
+                        type=str)
+
+    parser.add_argument("--cache-size",
+                        default=2048,
+                        help="The maximum size of the local cache in MB. "
+                             "The least recently used artifacts are evicted "
+                             "first. Defaults to 2048.",
+                        type=positive_int)
+
+    parser.add_argument("--no-cache",
+                        action="store_true",
+                        help="Always build, without reading or writing the "
+                             "local and S3 artifact caches.")
+
+    parser.add_argument("--compute-type",
+                        choices=("auto",) + COMPUTE_TYPES,
+                        default=COMPUTE_TYPES[0],
+                        help="The CodeBuild compute type to build on. "
+                             "\"auto\" picks one per package from the "
+                             "recorded build history. Defaults to "
+                             "BUILD_GENERAL1_SMALL.",
+                        type=str)
+
+    parser.add_argument("--compute-policy",
+                        choices=["time", "cost"],
+                        default="time",
+                        help="What --compute-type auto optimizes for. "
+                             "Defaults to time.",
+                        type=str)
+
+    parser.add_argument("--compute-override",
+                        action="append",
+                        help="Build one package on a given compute type, "
+                             "e.g. lxml=BUILD_GENERAL1_LARGE. May be given "
+                             "more than once.",
+                        type=compute_override)
+
+    parser.add_argument("--history-file",
+                        help="Where build durations are recorded. Defaults "
+                             "to ~/.local/share/alppb/history.json.",
+                        type=str)
+
+    parser.add_argument("--slim",
+                        action="store_true",
+                        help="Prune tests, docs, C sources, headers and "
+                             "caches from the artifact and strip debug "
+                             "symbols from shared objects.")
+
+    parser.add_argument("--slim-exclude",
+                        action="append",
+                        metavar="PATTERN",
+                        help="Also prune paths matching this find -path "
+                             "pattern, e.g. '*/examples'. May be given more "
+                             "than once.",
+                        type=str)
+
+    parser.add_argument("--slim-include",
+                        action="append",
+                        metavar="PATTERN",
+                        help="Never prune paths matching this find -path "
+                             "pattern, e.g. '*/numpy/core/include*'. May be "
+                             "given more than once.",
+                        type=str)
+
+    parser.add_argument("--no-strip",
+                        action="store_false",
+                        dest="strip",
+                        help="With --slim, keep debug symbols in shared "
+                             "objects.")
+
+    parser.add_argument("--precompile",
+                        action="store_true",
+                        help="With --slim, compile modules to .pyc for the "
+                             "target Python so Lambda doesn't on cold "
+                             "start.")
+
+    parser.add_argument("--wheelhouse",
+                        action="store_true",
+                        help="Build every dependency as a wheel and share "
+                             "the wheels through the bucket, so later "
+                             "builds only compile wheels that are missing "
+                             "or changed.")
+
+    parser.add_argument("--build-cache",
+                        choices=["s3", "local"],
+                        help="Keep pip's cache between builds, either under "
+                             "alppbBuildCache/ in the bucket (s3) or on the "
+                             "CodeBuild host (local). Off by default.",
+                        type=str)
+
+    parser.add_argument("--invalidate-build-cache",
+                        action="store_true",
+                        help="Reset the CodeBuild project cache before "
+                             "building.")
+
+    parser.add_argument("-o", "--output-dir",
+                        help="Stream each artifact from S3 and extract it "
+                             "into this directory instead of downloading "
+                             "alppb-<package>.zip. The zip never touches "
+                             "the disk.",
+                        type=str)
+
+    parser.add_argument("--format",
+                        choices=["zip", "tar.gz", "tar.xz"],
+                        default="zip",
+                        help="Archive format the artifact is transferred "
+                             "in. Defaults to zip.",
+                        type=str)
+
+    parser.add_argument("--compression-level",
+                        choices=range(10),
+                        metavar="{0-9}",
+                        help="Compression level of the artifact. 0 stores a "
+                             "zip without compression. Defaults to the "
+                             "archiver's default.",
+                        type=int)
+
+    parser.add_argument("--to-zip",
+                        action="store_true",
+                        help="Convert tar artifacts to a zip for AWS Lambda "
+                             "after downloading them.")
+
+    parser.add_argument("--layer",
+                        action="store_true",
+                        help="Lay each artifact out as an AWS Lambda layer "
+                             "and publish it as a new layer version "
+                             "straight from S3.")
+
+    parser.add_argument("--no-download",
+                        action="store_false",
+                        dest="download",
+                        help="With --layer, only publish the layers and "
+                             "don't download the artifacts.")
+
+    parser.add_argument("--part-size",
+                        default=8,
+                        help="Size in MB of each part fetched from S3. "
+                             "Defaults to 8.",
+                        type=positive_int)
+
+    parser.add_argument("--transfer-threads",
+                        default=10,
+                        help="The maximum number of parts of each artifact "
+                             "to fetch at the same time. Defaults to 10.",
+                        type=positive_int)
+
+    parser.add_argument("--progress",
+                        action="store_true",
+                        help="Print the progress of each download.")
+
+    parser.add_argument("--no-log-tail",
+                        action="store_false",
+                        dest="tail_logs",
+                        help="Don't tail the CloudWatch logs of running "
+                             "builds. By default builds are stopped as soon "
+                             "as a known fatal error is logged.")
+
+    parser.add_argument("--fail-pattern",
+                        action="append",
+                        help="A regular expression that stops a build when "
+                             "a log line matches it, in addition to the "
+                             "built-in patterns. May be given more than "
+                             "once.",
+                        type=regular_expression)
+
+    parser.add_argument("-w", "--warm",
+                        action="store_true",
+                        help="Keep the IAM Role and CodeBuild project after "
+                             "the build and reuse them on later runs. Use "
+                             "`alppb teardown` to delete them.")
+
+    add_metadata_arguments(parser)
+
+    parser.add_argument("--profile",
+                        metavar="PATH",
+                        help="Write timing spans of every step, including "
+                             "the CodeBuild phases, to PATH in the Chrome "
+                             "trace format and print the AWS API calls made "
+                             "per phase. Open it in chrome://tracing or "
+                             "https://ui.perfetto.dev.",
+                        type=str)
+
+    parser.add_argument("-v", "--version",
+                        action='version',
+                        help="Prints the version of alppb you are using.",
+                        version="alppb {}".format(__version__))
+
+    args = parser.parse_args(argv)
+    if args.layer and args.format != "zip":
+        parser.error("--layer needs --format zip, Lambda layers are zips")
+    if not args.download and not args.layer:
+        parser.error("--no-download needs --layer")
+    if args.backend != "codebuild":
+        remote = [option for option, value in (
+            ("--layer", args.layer), ("--wheelhouse", args.wheelhouse),
+            ("--build-cache", args.build_cache),
+            ("--batch-size", args.batch_size > 1))
+            if value]
+        if remote:
+            parser.error("{} can only be used with --backend codebuild"
+                         .format(", ".join(remote)))
+    args.command = "build"
+    return args
+
+
+COMMANDS = {
+    "serve": parse_serve_args,
+    "teardown": parse_teardown_args,
+}
+
+
+def main():
+    """ Main entry point of the app """
+    # Parse args and get values used in functions below.
+    args = parse_args()
+
+    profile = getattr(args, "profile", None)
+    if profile is not None:
+        timing.enable()
+
+    # Only import boto3 and the AWS modules once a command needs them.
+    try:
+        from . import alppb
+        if args.command == "teardown":
+            alppb.teardown(args)
+        if args.command == "serve":
+            alppb.run_server(args)
+        alppb.build(args)
+    except errors.AlppbError as err:
+        print("ERROR: {}".format(err))
+        exit(1)
+    finally:
+        # build() exits, so the trace is written on the way out.
+        if profile is not None:
+            timing.print_api_calls()
+            timing.write(profile)
+            print(">>Wrote the timing trace to {}".format(profile))
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
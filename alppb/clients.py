@@ -0,0 +1,180 @@
+"""
+A shared boto3 session and a cache of clients, one per (service, region).
+Every client is created with the same botocore Config so concurrent builds,
+downloads and cleanups reuse pooled HTTP connections, retry adaptively and
+time out instead of hanging.
+"""
+import threading
+import boto3
+from botocore.config import Config
+from . import timing
+
+DEFAULT_OPTIONS = {
+    'max_pool_connections': 32,
+    'retries': {'mode': 'adaptive', 'max_attempts': 10},
+    'connect_timeout': 10,
+    'read_timeout': 60,
+}
+
+_LOCK = threading.RLock()
+_SESSION = None
+# The session that already created a client, see get_client().
+_READY_SESSION = None
+_CLIENTS = {}
+_RESOURCES = {}
+_OPTIONS = dict(DEFAULT_OPTIONS)
+
+
+def configure(**options):
+    """
+    Changes the botocore Config options used for new clients and drops any
+    cached clients so they are recreated with the new options.
+
+    Parameters
+    ----------
+    options
+        Keyword arguments for botocore.config.Config, e.g.
+        max_pool_connections=64.
+
+    Returns
+    -------
+    """
+    with _LOCK:
+        _OPTIONS.update(options)
+        _CLIENTS.clear()
+        _RESOURCES.clear()
+
+
+def reset():
+    """
+    Drops the shared session, cached clients and custom options.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    """
+    global _SESSION, _READY_SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        _SESSION = None
+        _READY_SESSION = None
+        _CLIENTS.clear()
+        _RESOURCES.clear()
+        _OPTIONS.clear()
+        _OPTIONS.update(DEFAULT_OPTIONS)
+
+
+def get_session():
+    """
+    Gets the boto3 session shared by every client. boto3 sessions are not
+    thread-safe to create, so this is guarded by a lock.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    boto3.session.Session
+        The shared session.
+    """
+    global _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session()
+        return _SESSION
+
+
+def client_config():
+    """
+    Builds the botocore Config used for every client.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    botocore.config.Config
+        The client configuration.
+    """
+    with _LOCK:
+        return Config(**_OPTIONS)
+
+
+def get_client(service, region=None):
+    """
+    Gets the cached client for a service and region, creating it on first
+    use. botocore clients are thread-safe, so one client is shared by every
+    thread. Only the cache is locked, so threads setting up different
+    services create their clients at the same time, except for the first
+    client of a session.
+
+    Parameters
+    ----------
+    service : str
+        The name of the AWS service, e.g. "s3".
+    region : str
+        The region to use, or None to let boto3 decide.
+
+    Returns
+    -------
+    botocore.client.service
+        The shared client.
+    """
+    global _READY_SESSION  # pylint: disable=global-statement
+    key = (service, region)
+    with _LOCK:
+        if key in _CLIENTS:
+            return _CLIENTS[key]
+        session = get_session()
+        config = client_config()
+        if session is not _READY_SESSION:
+            # botocore sets up the session's credentials, endpoints and
+            # loaders on its first client, which isn't thread-safe.
+            client = _CLIENTS[key] = new_client(session, service, region,
+                                                config)
+            _READY_SESSION = session
+            return client
+    client = new_client(session, service, region, config)
+    with _LOCK:
+        # Another thread may have created one meanwhile, keep the first.
+        return _CLIENTS.setdefault(key, client)
+
+
+def new_client(session, service, region, config):
+    """ Creates a client that counts its calls for --profile. """
+    client = session.client(service, region_name=region, config=config)
+    # A no-op unless --profile is enabled.
+    client.meta.events.register('before-parameter-build',
+                                timing.count_api_call)
+    return client
+
+
+def get_resource(service, region=None):
+    """
+    Gets the cached resource for a service and region. The resource uses
+    the cached client from get_client() instead of its own, so both share
+    one connection pool.
+
+    Parameters
+    ----------
+    service : str
+        The name of the AWS service, e.g. "s3".
+    region : str
+        The region to use, or None to let boto3 decide.
+
+    Returns
+    -------
+    boto3.resources.factory.service.ServiceResource
+        The shared resource.
+    """
+    key = (service, region)
+    with _LOCK:
+        if key in _RESOURCES:
+            return _RESOURCES[key]
+        session = get_session()
+        config = client_config()
+    resource = session.resource(service, region_name=region, config=config)
+    resource.meta.client = get_client(service, region)
+    with _LOCK:
+        return _RESOURCES.setdefault(key, resource)
@@ -1,8 +1,43 @@
 """
 Administration of AWS CodeBuild Resources through a boto3 client.
 """
+import hashlib
+import json
+import random
+import re
+import shlex
 import time
+from botocore.exceptions import ClientError
 import yaml
+from . import metadata
+from . import timing
+from .layers import site_packages
+
+PIP_CACHE_DIR = "/root/.cache/pip"
+# Stored on the project, but every build overrides it with its own package's.
+GENERIC_BUILDSPEC = yaml.dump({
+    "version": 0.2,
+    "phases": {"build": {"commands": [
+        "echo alppbBuilder builds need a buildspecOverride",
+        "exit 1",
+    ]}},
+})
+# Formats the artifact can be transferred in. Each is also its file suffix.
+ARCHIVE_FORMATS = ["zip", "tar.gz", "tar.xz"]
+# Paths, as `find -path` patterns, that Lambda never imports at runtime.
+PRUNE_EXCLUDES = [
+    "*/tests",
+    "*/test",
+    "*/__pycache__",
+    "*/docs",
+    "*.pyc",
+    "*.pyo",
+    "*.h",
+    "*.c",
+    "*.pyx",
+    "*.pxd",
+    "*.dist-info/RECORD",
+]
 
 
 def determine_image(py_version):
@@ -57,7 +92,227 @@ def pip_to_use(py_version):
     return "pip-3.6"
 
 
-def generate_buildspec(package, py_version):
+def artifact_name(package, archive_format="zip", suffix=""):
+    """
+    Determines the file name of the build artifact for a PyPi package. Any
+    characters that are unsafe in a file name or S3 key (e.g. version
+    specifiers like "==") are replaced with an underscore.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package being built.
+    archive_format : str
+        One of codebuild.ARCHIVE_FORMATS. Defaults to "zip".
+    suffix : str
+        Appended to the name before the extension, e.g. "-py3.7" to tell
+        apart the artifacts of several Python versions.
+
+    Returns
+    -------
+    str
+        File name of the artifact, e.g. "alppb-requests.zip".
+    """
+    return "alppb-{}{}.{}".format(
+        re.sub(r'[^A-Za-z0-9._-]+', '_', package), suffix, archive_format)
+
+
+def archive_command(artifact, archive_format="zip", level=None):
+    """
+    Generates the Buildspec command that packs the contents of alppb/ into
+    the artifact.
+
+    Parameters
+    ----------
+    artifact : str
+        File name of the artifact to create.
+    archive_format : str
+        One of codebuild.ARCHIVE_FORMATS. Defaults to "zip".
+    level : int
+        Compression level from 0 to 9, or None for the tool's default. A
+        zip with level 0 is stored without compression.
+
+    Returns
+    -------
+    str
+        The command, run from inside alppb/.
+    """
+    if archive_format == "zip":
+        if level is None:
+            return "zip -r ../{} *".format(artifact)
+        return "zip -r -{} ../{} *".format(level, artifact)
+    if archive_format == "tar.gz":
+        return "tar -cf - * | gzip -{} > ../{}".format(
+            6 if level is None else max(1, level), artifact)
+    if archive_format == "tar.xz":
+        return "tar -cf - * | xz -T0 -{} > ../{}".format(
+            6 if level is None else level, artifact)
+    raise ValueError("Unknown archive format {}".format(archive_format))
+
+
+def wheelhouse_uri(bucket, py_version):
+    """
+    Determines the S3 prefix wheels are shared under. Wheels only work on
+    the image and Python version they were built with, so the prefix is a
+    hash of both.
+
+    Parameters
+    ----------
+    bucket : str
+        Name of the bucket the wheelhouse lives in.
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+
+    Returns
+    -------
+    str
+        The S3 URI of the wheelhouse, e.g.
+        "s3://bucket/alppbWheelhouse/0123456789abcdef/".
+    """
+    key = hashlib.sha256("{} {}".format(
+        determine_image(py_version), pip_to_use(py_version)).encode('utf-8'))
+    return "s3://{}/alppbWheelhouse/{}/".format(bucket, key.hexdigest()[:16])
+
+
+def wheelhouse_commands(package, pip, wheelhouse):
+    """
+    Generates the Buildspec commands that install a package from wheels
+    kept in an S3 wheelhouse. Only wheels missing from the wheelhouse are
+    built, and new ones are uploaded for later builds.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package to be built by AWS CodeBuild.
+    pip : str
+        Pip command to use. See codebuild.pip_to_use().
+    wheelhouse : str
+        The S3 URI of the wheelhouse. See codebuild.wheelhouse_uri().
+
+    Returns
+    -------
+    list
+        The commands.
+    """
+    return [
+        # The alppb images don't ship the AWS CLI.
+        "command -v aws || {} install --quiet awscli".format(pip),
+        "mkdir -p wheelhouse",
+        "aws s3 sync {} wheelhouse/ --only-show-errors".format(wheelhouse),
+        # Wheels already in the wheelhouse are reused instead of rebuilt.
+        "{} wheel {} -w wheelhouse --find-links wheelhouse".format(
+            pip, package),
+        "{} install {} -t alppb --no-index --find-links wheelhouse".format(
+            pip, package),
+        "aws s3 sync wheelhouse/ {} --only-show-errors".format(wheelhouse),
+    ]
+
+
+def prune_rules(exclude=None, include=None, strip=True, precompile=False):
+    """
+    Collects the rules of the pruning stage of a Buildspec.
+
+    Parameters
+    ----------
+    exclude : list
+        Extra `find -path` patterns to remove, on top of
+        codebuild.PRUNE_EXCLUDES.
+    include : list
+        `find -path` patterns that are never removed, even if they match an
+        exclude pattern.
+    strip : bool
+        If True, strip debug symbols from shared objects.
+    precompile : bool
+        If True, compile every module to .pyc for the target Python.
+
+    Returns
+    -------
+    dict
+        The rules, for generate_buildspec().
+    """
+    return {
+        'exclude': PRUNE_EXCLUDES + list(exclude or []),
+        'include': list(include or []),
+        'strip': strip,
+        'precompile': precompile,
+    }
+
+
+def prune_commands(rules, pip):
+    """
+    Generates the Buildspec commands that shrink the installed packages in
+    alppb/ before they are zipped, and log how many bytes that saved.
+
+    Parameters
+    ----------
+    rules : dict
+        The rules from codebuild.prune_rules().
+    pip : str
+        Pip command to use. See codebuild.pip_to_use().
+
+    Returns
+    -------
+    list
+        The commands.
+    """
+    def any_path(patterns):
+        return " -o ".join("-path '{}'".format(pattern)
+                           for pattern in patterns)
+
+    remove = "find alppb -depth \\( {} \\)".format(
+        any_path(rules['exclude']))
+    if rules['include']:
+        remove += " ! \\( {} \\)".format(any_path(rules['include']))
+    commands = [
+        "ALPPB_SIZE=$(du -sb alppb | cut -f1)",
+        remove + " -exec rm -rf {} +",
+    ]
+    if rules['strip']:
+        commands.append(
+            "find alppb -name '*.so*' -type f -exec strip --strip-unneeded "
+            "{} + 2>/dev/null || true")
+    if rules['precompile']:
+        # e.g. pip-3.6 -> python3.6. Zip keeps mtimes to two seconds only,
+        # so pin them or Lambda would see every .pyc as stale.
+        python = pip.replace("pip-", "pip").replace("pip", "python", 1)
+        commands += [
+            "find alppb -exec touch -t 200001010000 {} +",
+            "{} -m compileall -q alppb || true".format(python),
+        ]
+    commands.append(
+        'echo "alppb pruned $((ALPPB_SIZE - $(du -sb alppb | cut -f1))) '
+        'of $ALPPB_SIZE bytes"')
+    return commands
+
+
+def project_cache(mode, bucket):
+    """
+    Generates the cache setting of the CodeBuild project.
+
+    Parameters
+    ----------
+    mode : str
+        "s3" to keep the cache under alppbBuildCache/ in the bucket, "local"
+        for a LOCAL custom cache on the build host, or None for no cache.
+    bucket : str
+        Name of the bucket an S3 cache is kept in.
+
+    Returns
+    -------
+    dict
+        The cache setting for create_project/update_project.
+    """
+    if mode == "s3":
+        return {'type': 'S3', 'location': '{}/alppbBuildCache'.format(bucket)}
+    if mode == "local":
+        return {'type': 'LOCAL', 'modes': ['LOCAL_CUSTOM_CACHE']}
+    return {'type': 'NO_CACHE'}
+
+
+def generate_buildspec(package, py_version, artifact='alppb.zip',
+                       wheelhouse=None, pip_cache=False, prune=None,
+                       archive_format="zip", compression_level=None,
+                       layer=False):
     """
     Creates a valid Buildspec, from a template, for an AWS CodeBuild project.
     The template requires a valid PyPi package to be specified.
@@ -70,97 +325,482 @@ def generate_buildspec(package, py_version):
     py_version: str
         Python version being used. Must be one of "2.7", "3.6", or "3.7"
 
+    artifact : str
+        File name of the zip the build produces. Defaults to "alppb.zip".
+
+    wheelhouse : str
+        Optional S3 URI of a wheelhouse to reuse wheels from and upload new
+        wheels to. See codebuild.wheelhouse_uri().
+
+    pip_cache : bool
+        If True, declare pip's cache directory as a cache path so it is kept
+        between builds. The project needs a cache, see project_cache().
+
+    prune : dict
+        Optional rules from codebuild.prune_rules(). If given, tests, docs,
+        sources and debug symbols are removed before zipping.
+
+    archive_format : str
+        One of codebuild.ARCHIVE_FORMATS. The artifact name should use the
+        same suffix, see codebuild.artifact_name().
+
+    compression_level : int
+        Compression level from 0 to 9, see codebuild.archive_command().
+
+    layer : bool
+        If True, lay the artifact out as an AWS Lambda layer, with the
+        packages under python/lib/pythonX.Y/site-packages.
+
     Returns
     -------
     str
         The Buildspec in YAML.
     """
-    return yaml.dump({
+    pip = pip_to_use(py_version)
+    if wheelhouse is None:
+        commands = ["{} install {} -t alppb".format(pip, package)]
+    else:
+        commands = wheelhouse_commands(package, pip, wheelhouse)
+    if prune is not None:
+        commands += prune_commands(prune, pip)
+    if layer:
+        path = site_packages(py_version)
+        commands += [
+            "mkdir -p layer/{}".format(path.rsplit("/", 1)[0]),
+            "mv alppb layer/{}".format(path),
+            "mv layer alppb",
+        ]
+
+    buildspec = {
         "version": 0.2,
         "phases": {
             "build": {
-                "commands": [
-                    "{} install {} -t alppb".format(pip_to_use(py_version),
-                                                    package),
+                "commands": commands + [
                     "cd alppb/",
-                    "zip -r ../alppb.zip *"
+                    archive_command(artifact, archive_format,
+                                    compression_level)
                 ]
             }
         },
         "artifacts": {
             "files": [
-                "alppb.zip"
+                artifact
             ]
         }
-    })
+    }
+    if pip_cache:
+        buildspec["env"] = {"variables": {"PIP_CACHE_DIR": PIP_CACHE_DIR}}
+        buildspec["cache"] = {"paths": ["{}/**/*".format(PIP_CACHE_DIR)]}
+    return yaml.dump(buildspec)
 
 
-def create_build_project(client, role, bucket, buildspec, image):
+def generate_batch_buildspec(packages, py_version, artifacts, **options):
     """
-    Creates a new AWS CodeBuild Project to build the PyPi package(s).
+    Creates one Buildspec that builds several packages, so a single build
+    pays for provisioning once. Each package runs the commands of its own
+    Buildspec in its own directory and produces its own artifact, and a
+    package that fails doesn't stop the others. Its failure is logged as
+    "alppb batch failed: <package>" and its artifact is missing.
+
+    Parameters
+    ----------
+    packages : list
+        Names of the PyPi packages to be built by AWS CodeBuild.
+
+    py_version: str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+
+    artifacts : list
+        File name of the artifact of each package, in the same order. They
+        are uploaded side by side, as a single build would upload them.
+
+    options
+        Passed through to codebuild.generate_buildspec().
+
+    Returns
+    -------
+    str
+        The Buildspec in YAML.
+    """
+    commands = ['ALPPB_ROOT="$(pwd)"', 'mkdir -p alppb-batch/out']
+    variables = {}
+    for index, (package, artifact) in enumerate(zip(packages, artifacts)):
+        spec = yaml.safe_load(generate_buildspec(package, py_version,
+                                                 artifact, **options))
+        variables.update((spec.get("env") or {}).get("variables") or {})
+        # Braces keep `a || b` commands whole when joined with &&, and the
+        # subshell keeps `cd` and a failure from leaking into the next one.
+        steps = " && ".join("{{ {}; }}".format(command) for command in
+                            spec["phases"]["build"]["commands"])
+        directory = '"$ALPPB_ROOT/alppb-batch/{}"'.format(index)
+        commands += [
+            "mkdir -p {0} && cd {0}".format(directory),
+            '( {} ) && mv {} "$ALPPB_ROOT/alppb-batch/out/" || '
+            'echo "alppb batch failed: "{}'.format(
+                steps, artifact, shlex.quote(package)),
+            'cd "$ALPPB_ROOT"',
+        ]
+    buildspec = {
+        "version": 0.2,
+        "phases": {
+            "build": {
+                "commands": commands
+            }
+        },
+        "artifacts": {
+            "files": [
+                "alppb-batch/out/*"
+            ],
+            "discard-paths": "yes"
+        }
+    }
+    if variables:
+        buildspec["env"] = {"variables": variables}
+    if options.get("pip_cache"):
+        buildspec["cache"] = {"paths": ["{}/**/*".format(PIP_CACHE_DIR)]}
+    return yaml.dump(buildspec)
+
+
+def role_not_ready(err):
+    """
+    Checks whether a CodeBuild error means the service role can't be
+    assumed yet because IAM changes are still propagating.
+
+    Parameters
+    ----------
+    err : botocore.exceptions.ClientError
+        The error raised by a CodeBuild call.
+
+    Returns
+    -------
+    bool
+        True if retrying the call later may succeed.
+    """
+    error = err.response.get('Error', {})
+    message = str(error.get('Message'))
+    return error.get('Code') == 'InvalidInputException' and (
+        'sts:AssumeRole' in message or 'not authorized' in message)
+
+
+@timing.traced
+def retry_until_role_ready(call, attempts=8, delay=1.0, max_delay=8.0,
+                           sleep=None, **kwargs):
+    """
+    Makes a CodeBuild call, retrying with exponential backoff while the
+    service role is not assumable yet. This replaces a fixed propagation
+    sleep after creating the role: ready roles cost nothing, and slow
+    propagation still succeeds.
+
+    Parameters
+    ----------
+    call : callable
+        The boto3 client method to call, e.g. client.start_build.
+    attempts : int
+        The maximum number of calls to make.
+    delay : float
+        Seconds to wait before the first retry. Doubles on each retry.
+    max_delay : float
+        The longest time, in seconds, to wait between retries.
+    sleep : callable
+        Function used to wait between retries. Defaults to time.sleep,
+        looked up on each call so it can be replaced.
+    kwargs
+        Passed through to the call.
+
+    Returns
+    -------
+    dict
+        boto3 response object of the call.
+    """
+    sleep = sleep or time.sleep
+    for attempt in range(1, attempts + 1):
+        try:
+            return call(**kwargs)
+        except ClientError as err:
+            if attempt == attempts or not role_not_ready(err):
+                raise err
+            print(">>IAM Role is not ready yet, retrying in {} "
+                  "seconds...".format(delay))
+            with timing.span("codebuild.retry_until_role_ready.sleep"):
+                sleep(delay)
+            delay = min(max_delay, delay * 2)
+
+
+def artifacts_override(bucket):
+    """
+    Generates the artifact settings of one build, which put its artifacts
+    under <build ID>/alppbBuilder/ in the bucket, so builds of the same
+    artifact never overwrite each other. See codebuild.artifact_prefix().
 
     Parameters
     ----------
-    client : botocore.client.S3
-        A boto3 client for S3.
-    role : str
-        Name of the IAM Role the AWS CodeBuild project should use.
     bucket : str
-        Name of the bucket the build artifact will be put in.
-    buildspec : str
-        A valid AWS CodeBuild Buildspec in YAML. Use s3.generate_buildspec().
-    image : str
-        The Docker image to use for the CodeBuild project.
+        Name of the bucket the build artifacts will be put in.
+
+    Returns
+    -------
+    dict
+        The artifactsOverride of start_build.
+    """
+    return {
+        'type': 'S3',
+        'location': bucket,
+        'name': 'alppbBuilder',
+        'namespaceType': 'BUILD_ID',
+        'packaging': 'NONE',
+    }
+
+
+def artifact_prefix(build):
+    """
+    Gets the S3 prefix a finished build put its artifacts under, see
+    codebuild.artifacts_override().
+
+    Parameters
+    ----------
+    build : dict
+        The build as returned by batch_get_builds.
+
+    Returns
+    -------
+    str
+        The prefix, without the bucket or a trailing slash.
+    """
+    location = (build.get('artifacts') or {}).get('location') or ''
+    # e.g. arn:aws:s3:::bucket/<build UUID>/alppbBuilder
+    path = location.partition(':::')[2]
+    if '/' in path:
+        return path.split('/', 1)[1]
+    # CodeBuild names the folder after the ID without the project name.
+    return '{}/alppbBuilder'.format(build.get('id').split(':')[-1])
+
+
+def generic_project(role, cache=None):
+    """
+    Generates the settings of the alppb AWS CodeBuild project. Nothing in it
+    is specific to a package, Python version or bucket, since every build
+    overrides the Buildspec, image, compute type and artifacts.
+
+    Parameters
+    ----------
+    role : str
+        ARN of the IAM Role the AWS CodeBuild project should use.
+    cache : dict
+        The cache setting of the project. Defaults to no cache, see
+        codebuild.project_cache().
 
     Returns
     -------
     dict
-        boto3 response object. See https://boto3.amazonaws.com/v1/documentation
-        /api/latest/reference/services
-        /codebuild.html#CodeBuild.Client.create_project for more information.
+        Keyword arguments for create_project or update_project.
+    """
+    return {
+        'name': 'alppbBuilder',
+        'source': {
+            'type': 'NO_SOURCE',
+            'buildspec': GENERIC_BUILDSPEC,
+        },
+        'artifacts': {'type': 'NO_ARTIFACTS'},
+        'environment': {
+            'type': 'LINUX_CONTAINER',
+            'image': determine_image(None),
+            'computeType': 'BUILD_GENERAL1_SMALL',
+        },
+        'cache': cache or {'type': 'NO_CACHE'},
+        'serviceRole': role,
+    }
+
+
+@timing.traced
+def create_build_project(client, role, cache=None):
+    """
+    Creates a new AWS CodeBuild Project to build the PyPi package(s). Builds
+    of any package, Python version and bucket can run on it at once.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+    role : str
+        ARN of the IAM Role the AWS CodeBuild project should use.
+    cache : dict
+        The cache setting of the project. Defaults to no cache, see
+        codebuild.project_cache().
+
+    Returns
+    -------
+    bool
+        True if the project was created, False if an existing one, e.g.
+        from a warm or concurrent run, was overwritten.
     """
     print("Creating CodeBuild project...")
     try:
-        response = client.create_project(
-            name='alppbBuilder',
-            source={
-                'type': 'NO_SOURCE',
-                'buildspec': buildspec,
-            },
-            artifacts={
-                'type': 'S3',
-                'location': bucket,
-            },
-            environment={
-                'type': 'LINUX_CONTAINER',
-                'image': image,
-                'computeType': 'BUILD_GENERAL1_SMALL',
-            },
-            serviceRole=role,
-        )
+        retry_until_role_ready(client.create_project,
+                               **generic_project(role, cache))
     except client.exceptions.ResourceAlreadyExistsException:
         print(">>alppbBuilder project already exists, overwriting...")
-        response = client.update_project(
-            name='alppbBuilder',
-            source={
-                'type': 'NO_SOURCE',
-                'buildspec': buildspec,
-            },
-            artifacts={
-                'type': 'S3',
-                'location': bucket,
-            },
-            environment={
-                'type': 'LINUX_CONTAINER',
-                'image': image,
-                'computeType': 'BUILD_GENERAL1_SMALL',
-            },
-            serviceRole=role,
-        )
-
-    return response
+        retry_until_role_ready(client.update_project,
+                               **generic_project(role, cache))
+        return False
+
+    return True
+
+
+def project_hash(role, cache=None):
+    """
+    Hashes the settings of the project, see generic_project(), to remember
+    which project the metadata cache has seen.
+
+    Parameters
+    ----------
+    role : str
+        ARN of the IAM Role the AWS CodeBuild project should use.
+    cache : dict
+        The cache setting of the project. Defaults to no cache.
+
+    Returns
+    -------
+    str
+        Hex digest of the settings.
+    """
+    settings = json.dumps(generic_project(role, cache), sort_keys=True)
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+
+def project_matches(project, role, cache=None):
+    """
+    Checks whether an existing CodeBuild project can be reused as is. Only
+    the role and cache are compared, because every build overrides the
+    rest. That includes the bucket of its artifacts, and the role grants
+    every bucket it is used with.
+
+    Parameters
+    ----------
+    project : dict
+        The project as returned by batch_get_projects.
+    role : str
+        ARN of the IAM Role the project should use.
+    cache : dict
+        The cache setting the project should have. Defaults to no cache.
+
+    Returns
+    -------
+    bool
+        True if the project matches.
+    """
+    cache = cache or {'type': 'NO_CACHE'}
+    current = project.get('cache') or {'type': 'NO_CACHE'}
+    return (project.get('serviceRole') == role and
+            all(current.get(key) == value for key, value in cache.items()))
+
+
+@timing.traced
+def ensure_build_project(client, role, cache=None):
+    """
+    Reuses the alppb AWS CodeBuild project if it already exists with the
+    same role and cache, without any call while the metadata cache
+    remembers it. Otherwise creates or overwrites it with
+    codebuild.create_build_project().
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+    role : str
+        ARN of the IAM Role the AWS CodeBuild project should use.
+    cache : dict
+        The cache setting of the project. Defaults to no cache.
+
+    Returns
+    -------
+    bool
+        True if an existing project was reused.
+    """
+    print("Checking CodeBuild project...")
+    region = client.meta.region_name
+    settings = project_hash(role, cache)
+    if metadata.lookup('project', region) == settings:
+        print(">>alppbBuilder project is cached, reusing...")
+        return True
+    response = client.batch_get_projects(names=['alppbBuilder'])
+    projects = response.get('projects')
+    reused = bool(projects) and project_matches(projects[0], role, cache)
+    if reused:
+        print(">>alppbBuilder project is up to date, reusing...")
+    else:
+        create_build_project(client, role, cache)
+    metadata.store('project', region, settings)
+    return reused
+
+
+@timing.traced
+def project_in_use(client):
+    """
+    Checks whether any build, e.g. of another alppb run, is still running on
+    the alppb AWS CodeBuild project.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+
+    Returns
+    -------
+    bool
+        True if a build is in progress.
+    """
+    try:
+        response = client.list_builds_for_project(
+            projectName='alppbBuilder', sortOrder='DESCENDING')
+    except client.exceptions.ResourceNotFoundException:
+        return False
+    # Builds are listed newest first, so older ones have long finished.
+    build_ids = response.get('ids', [])[:100]
+    if not build_ids:
+        return False
+    builds = client.batch_get_builds(ids=build_ids).get('builds', [])
+    return any(build.get('buildStatus') == 'IN_PROGRESS' for build in builds)
 
 
+@timing.traced
+def invalidate_cache(client):
+    """
+    Resets the cache of the alppb AWS CodeBuild project, so the next build
+    starts with a cold pip cache.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+
+    Returns
+    -------
+    """
+    print("Invalidating the CodeBuild project cache...")
+    client.invalidate_project_cache(projectName='alppbBuilder')
+
+
+def phase_durations(build):
+    """
+    Gets how long each phase of a build took.
+
+    Parameters
+    ----------
+    build : dict
+        The build as returned by batch_get_builds.
+
+    Returns
+    -------
+    dict
+        Maps each finished phase, e.g. "BUILD", to its duration in seconds,
+        in the order the phases ran.
+    """
+    return {phase.get('phaseType'): phase.get('durationInSeconds')
+            for phase in build.get('phases', [])
+            if phase.get('durationInSeconds') is not None}
+
+
+@timing.traced
 def delete_build_project(client):
     """
     Deletes the alppb AWS CodeBuild project.
@@ -174,10 +814,231 @@ def delete_build_project(client):
     -------
     """
     print("Deleting CodeBuild project...")
+    metadata.forget('project', client.meta.region_name)
     client.delete_project(name="alppbBuilder")
 
 
-def wait_for_build_to_complete(client, build_id):
+class BuildPoller(object):
+    """
+    Tracks one or more CodeBuild builds with a single batch_get_builds call
+    per tick. The delay between ticks backs off exponentially (with jitter)
+    while nothing changes, and shrinks again when a build changes phase,
+    reaches one of the final phases or nears its expected duration.
+
+    Builds may be tracked while iterating over changes(), which lets callers
+    start new builds as soon as others finish.
+    """
+    TERMINAL_STATUSES = ('SUCCEEDED', 'FAILED', 'FAULT', 'TIMED_OUT',
+                         'STOPPED')
+    # Phases that mean the build is about to finish, so poll eagerly.
+    LATE_PHASES = ('POST_BUILD', 'UPLOAD_ARTIFACTS', 'FINALIZING',
+                   'COMPLETED')
+    # batch_get_builds() accepts at most 100 IDs per call.
+    BATCH_SIZE = 100
+
+    def __init__(self, client, min_delay=2.0, max_delay=30.0,
+                 sleep=None, clock=None,
+                 jitter=None, on_poll=None):
+        """
+        Parameters
+        ----------
+        client : botocore.client.codebuild
+            A boto3 client for CodeBuild.
+        min_delay : float
+            The shortest time, in seconds, to wait between ticks.
+        max_delay : float
+            The longest time, in seconds, to wait between ticks.
+        sleep : callable
+            Function used to wait between ticks. Defaults to time.sleep,
+            looked up when the poller is created so it can be replaced.
+        clock : callable
+            Function returning the current time in seconds. Defaults to
+            time.monotonic, looked up the same way.
+        jitter : callable
+            Function returning a random number between its two arguments.
+            Defaults to random.uniform, looked up the same way.
+        on_poll : callable
+            Optional function called with each build returned by every
+            poll, changed or not, e.g. to tail its logs.
+        """
+        self.client = client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.sleep = sleep or time.sleep
+        self.clock = clock or time.monotonic
+        self.jitter = jitter or random.uniform
+        self.on_poll = on_poll
+        self.builds = {}
+        self._states = {}
+        self._started = {}
+        self._expected = {}
+        self._delay = min_delay
+
+    def track(self, build_id, expected_duration=None):
+        """
+        Starts tracking a build.
+
+        Parameters
+        ----------
+        build_id : str
+            The ID of the AWS CodeBuild job to poll.
+        expected_duration : float
+            Optional number of seconds the build is expected to take. Polling
+            speeds up as the build approaches this duration.
+
+        Returns
+        -------
+        """
+        self._states[build_id] = None
+        self._started[build_id] = self.clock()
+        self._expected[build_id] = expected_duration
+        self._delay = self.min_delay
+
+    @property
+    def pending(self):
+        """ IDs of the tracked builds that have not finished yet. """
+        return [build_id for build_id, state in self._states.items()
+                if state is None or state[0] not in self.TERMINAL_STATUSES]
+
+    @timing.traced
+    def poll(self):
+        """
+        Queries every pending build once and records its status and phase.
+
+        Returns
+        -------
+        list
+            The builds, as returned by batch_get_builds, whose status or
+            phase changed since the last poll. Builds it doesn't return are
+            reported as FAILED in the NOT_FOUND phase.
+        """
+        changed = []
+        pending = self.pending
+        for index in range(0, len(pending), self.BATCH_SIZE):
+            batch = pending[index:index + self.BATCH_SIZE]
+            response = self.client.batch_get_builds(ids=batch)
+            builds = response.get('builds', [])
+            # Builds CodeBuild doesn't know would never finish, so they fail.
+            found = set(build.get('id') for build in builds)
+            builds = builds + [{'id': build_id, 'buildStatus': 'FAILED',
+                                'currentPhase': 'NOT_FOUND'}
+                               for build_id in batch if build_id not in found]
+            for build in builds:
+                build_id = build.get('id')
+                state = (str(build.get('buildStatus')),
+                         str(build.get('currentPhase')))
+                self.builds[build_id] = build
+                if state != self._states.get(build_id):
+                    self._states[build_id] = state
+                    changed.append(build)
+                if self.on_poll is not None:
+                    self.on_poll(build)
+        return changed
+
+    def next_delay(self, changed):
+        """
+        Works out how long to wait before the next tick.
+
+        Parameters
+        ----------
+        changed : list
+            The builds whose status or phase changed on the last poll.
+
+        Returns
+        -------
+        float
+            Number of seconds to wait.
+        """
+        if changed:
+            self._delay = self.min_delay
+        else:
+            self._delay = min(self.max_delay, self._delay * 2)
+        delay = self._delay
+        now = self.clock()
+        for build_id in self.pending:
+            state = self._states[build_id]
+            if state is not None and state[1] in self.LATE_PHASES:
+                delay = self.min_delay
+            expected = self._expected[build_id]
+            if expected is None:
+                continue
+            # Past its expected duration the build gets the usual back-off.
+            remaining = expected - (now - self._started[build_id])
+            if remaining > 0:
+                delay = min(delay, max(self.min_delay, remaining))
+        # Equal jitter keeps many pollers from hitting the API in lockstep.
+        return delay / 2 + self.jitter(0, delay / 2)
+
+    def changes(self):
+        """
+        Polls until every tracked build has finished.
+
+        Yields
+        ------
+        dict
+            Each build, as returned by batch_get_builds, whose status or
+            phase changed.
+        """
+        while self.pending:
+            changed = self.poll()
+            for build in changed:
+                yield build
+            if self.pending:
+                with timing.span("codebuild.BuildPoller.sleep"):
+                    self.sleep(self.next_delay(changed))
+
+
+def wait_for_builds(client, build_ids, callback=None, **kwargs):
+    """
+    Keeps checking until all of the builds complete.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+
+    build_ids : list
+        The IDs of the AWS CodeBuild jobs to poll.
+
+    callback : callable
+        Optional function called with each build, as returned by
+        batch_get_builds, whenever its status or phase changes.
+
+    kwargs
+        Passed through to BuildPoller.
+
+    Returns
+    -------
+    dict
+        Maps each build ID to its final status, e.g. "SUCCEEDED".
+    """
+    poller = BuildPoller(client, **kwargs)
+    for build_id in build_ids:
+        poller.track(build_id)
+    for build in poller.changes():
+        if callback is not None:
+            callback(build)
+    return {build_id: str(poller.builds[build_id].get('buildStatus'))
+            for build_id in build_ids}
+
+
+def print_build_change(build):
+    """
+    Prints a status or phase change of a build.
+
+    Parameters
+    ----------
+    build : dict
+        The build as returned by batch_get_builds.
+
+    Returns
+    -------
+    """
+    print(">>Build {} is {} ({})...".format(
+        build.get('id'), build.get('buildStatus'), build.get('currentPhase')))
+
+
+def wait_for_build_to_complete(client, build_id, **kwargs):
     """
     Keeps checking until a build completes.
 
@@ -189,42 +1050,115 @@ def wait_for_build_to_complete(client, build_id):
     build_id : str
         The ID of the AWS CodeBuild job to poll.
 
+    kwargs
+        Passed through to BuildPoller.
+
     Returns
     -------
+    str
+        The final status of the build, e.g. "SUCCEEDED" or "FAILED".
     """
-    response = client.batch_get_builds(ids=[build_id])
-    # batch_get_builds() will return an array with one element.
-    status = str(response.get('builds')[0].get('buildStatus'))
+    status = wait_for_builds(client, [build_id], print_build_change,
+                             **kwargs)[build_id]
     if status == 'SUCCEEDED':
-        print("Build completed...")
-        return
-    elif status == 'IN_PROGRESS':
-        print(">>Build {}, waiting 10 seconds...".format(status))
-        time.sleep(10)
-        # Recursively call until the build is done.
-        return wait_for_build_to_complete(client, build_id)
+        print("Build {} completed...".format(build_id))
     else:
         print("ERROR: Build did not complete, status is: {}. Check "
               "the AWS console for more information on {}".format(
                   status, build_id
               ))
-        exit(1)
+    return status
 
 
-def build_artifact(client):
+@timing.traced
+def stop_build(client, build_id):
     """
-    Start a build and wait until it's done.
+    Stops a running build.
 
     Parameters
     ----------
     client : botocore.client.codebuild
         A boto3 client for CodeBuild.
 
+    build_id : str
+        The ID of the AWS CodeBuild job to stop.
+
     Returns
     -------
     """
-    print("Submitting a build job for the specified package(s)...")
-    response = client.start_build(projectName='alppbBuilder')
+    print(">>Stopping build {}...".format(build_id))
+    client.stop_build(id=build_id)
+
+
+@timing.traced
+def start_build(client, buildspec=None, compute_type=None, image=None,
+                bucket=None):
+    """
+    Starts a build of the alppb CodeBuild project.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+
+    buildspec : str
+        Optional Buildspec in YAML that overrides the one stored on the
+        project for this build only. This allows several builds of different
+        packages to run on the same project at once.
+
+    compute_type : str
+        Optional compute type, e.g. "BUILD_GENERAL1_LARGE", that overrides
+        the one stored on the project for this build only.
+
+    image : str
+        Optional Docker image that overrides the one stored on the project
+        for this build only, e.g. to build for another Python version.
+
+    bucket : str
+        Name of the bucket to put the build artifacts in. The project has
+        none of its own, see artifacts_override().
+
+    Returns
+    -------
+    str
+        The ID of the new build.
+    """
+    kwargs = {'projectName': 'alppbBuilder'}
+    if buildspec is not None:
+        kwargs['buildspecOverride'] = buildspec
+    if compute_type is not None:
+        kwargs['computeTypeOverride'] = compute_type
+    if image is not None:
+        kwargs['imageOverride'] = image
+    if bucket is not None:
+        kwargs['artifactsOverride'] = artifacts_override(bucket)
+    response = retry_until_role_ready(client.start_build, **kwargs)
     build_id = str(response.get('build').get('id'))
     print(">>Build ID is {}".format(build_id))
-    wait_for_build_to_complete(client, build_id)
+    return build_id
+
+
+def build_artifact(client, buildspec=None, bucket=None):
+    """
+    Start a build and wait until it's done.
+
+    Parameters
+    ----------
+    client : botocore.client.codebuild
+        A boto3 client for CodeBuild.
+
+    buildspec : str
+        Optional Buildspec in YAML that overrides the one stored on the
+        project for this build only.
+
+    bucket : str
+        Name of the bucket to put the build artifacts in.
+
+    Returns
+    -------
+    str
+        The final status of the build, e.g. "SUCCEEDED" or "FAILED".
+    """
+    print("Submitting a build job for the specified package(s)...")
+    build_id = start_build(client, buildspec, bucket=bucket)
+    return wait_for_build_to_complete(client, build_id)
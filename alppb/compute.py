@@ -0,0 +1,10 @@
+"""
+The AWS CodeBuild compute types alppb builds on, smallest first. Kept free
+of imports so alppb.cli can use it without slowing down startup.
+"""
+
+COMPUTE_TYPES = (
+    'BUILD_GENERAL1_SMALL',
+    'BUILD_GENERAL1_MEDIUM',
+    'BUILD_GENERAL1_LARGE',
+)
@@ -0,0 +1,37 @@
+"""
+Exceptions raised by alppb. The command line prints them and exits, the
+Python API in alppb.api lets them propagate.
+"""
+
+
+class AlppbError(Exception):
+    """ Base class of every error alppb raises on purpose. """
+
+
+class CredentialsError(AlppbError):
+    """ No AWS credentials were found. """
+
+
+class RegionError(AlppbError):
+    """ The region is missing, unsupported, or not the bucket's region. """
+
+
+class BucketError(AlppbError):
+    """ The bucket does not exist or its name is invalid. """
+
+
+class BuildError(AlppbError):
+    """ One or more packages failed to build or download. """
+
+    def __init__(self, results):
+        """
+        Parameters
+        ----------
+        results : dict
+            Maps each package to its api.BuildResult, failed or not.
+        """
+        self.results = results
+        self.failed = [package for package, result in results.items()
+                       if not result.succeeded]
+        super(BuildError, self).__init__("{} of {} builds failed: {}".format(
+            len(self.failed), len(results), ", ".join(self.failed)))
@@ -0,0 +1,64 @@
+"""
+Where alppb keeps its files between runs and how it writes them, shared by
+the artifact cache, the build history and the metadata cache.
+"""
+import json
+import os
+import tempfile
+
+# The XDG variable of each kind of directory, and its fallback under ~.
+BASE_DIRS = {
+    'cache': ('XDG_CACHE_HOME', ('.cache',)),
+    'data': ('XDG_DATA_HOME', ('.local', 'share')),
+}
+
+
+def default_path(kind, name):
+    """
+    Determines where alppb keeps a file or directory. Respects
+    $XDG_CACHE_HOME and $XDG_DATA_HOME and falls back to ~/.cache and
+    ~/.local/share.
+
+    Parameters
+    ----------
+    kind : str
+        "cache" for files that can be rebuilt, "data" for the others.
+    name : str
+        Name of the file or directory.
+
+    Returns
+    -------
+    str
+        Path of the file or directory.
+    """
+    variable, fallback = BASE_DIRS[kind]
+    base = os.environ.get(variable) or \
+        os.path.join(os.path.expanduser('~'), *fallback)
+    return os.path.join(base, 'alppb', name)
+
+
+def write_json(path, data):
+    """
+    Writes a JSON file, replacing it atomically so readers never see half
+    of it. Creates its directory if needed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+    data : dict
+        The JSON serializable contents.
+
+    Returns
+    -------
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as json_file:
+            json.dump(data, json_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
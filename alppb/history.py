@@ -0,0 +1,229 @@
+"""
+A local record of how long past builds took, used to pick the CodeBuild
+compute type for each package.
+"""
+import json
+import statistics
+import time
+from . import files
+from .compute import COMPUTE_TYPES
+
+# On-demand Linux price in USD per build minute. Only the ratios matter.
+PRICES = {
+    'BUILD_GENERAL1_SMALL': 0.005,
+    'BUILD_GENERAL1_MEDIUM': 0.01,
+    'BUILD_GENERAL1_LARGE': 0.02,
+}
+# Assumed speed of the BUILD phase relative to SMALL, used until a package
+# has been built on a compute type. Compiles rarely scale with every core.
+SPEEDUPS = {
+    'BUILD_GENERAL1_SMALL': 1.0,
+    'BUILD_GENERAL1_MEDIUM': 1.7,
+    'BUILD_GENERAL1_LARGE': 2.5,
+}
+# BUILD phases shorter than this gain nothing from a bigger host.
+MIN_SCALABLE_SECONDS = 60
+RECORDS_PER_PACKAGE = 10
+
+
+def default_history_path():
+    """
+    Determines where the build history is kept. Respects $XDG_DATA_HOME and
+    falls back to ~/.local/share.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    str
+        Path of the history file.
+    """
+    return files.default_path('data', 'history.json')
+
+
+def load(path):
+    """
+    Reads the build history. A missing or unreadable file is an empty
+    history.
+
+    Parameters
+    ----------
+    path : str
+        Path of the history file.
+
+    Returns
+    -------
+    dict
+        Maps "<python version>/<package>" to a list of build records.
+    """
+    try:
+        with open(path) as history_file:
+            history = json.load(history_file)
+    except (OSError, ValueError):
+        return {}
+    return history if isinstance(history, dict) else {}
+
+
+def save(path, history):
+    """
+    Writes the build history, replacing the file atomically.
+
+    Parameters
+    ----------
+    path : str
+        Path of the history file.
+    history : dict
+        The history from history.load().
+
+    Returns
+    -------
+    """
+    files.write_json(path, history)
+
+
+def history_key(package, py_version):
+    """ The key a package's records are kept under. """
+    return "{}/{}".format(py_version or "3.6", package)
+
+
+def record(history, package, py_version, build):
+    """
+    Adds a finished build to the history. Only the most recent records of
+    each package are kept.
+
+    Parameters
+    ----------
+    history : dict
+        The history from history.load().
+    package : str
+        Name of the PyPi package that was built.
+    py_version : str
+        Python version the package was built for.
+    build : dict
+        The build as returned by batch_get_builds.
+
+    Returns
+    -------
+    dict
+        The new record.
+    """
+    phases = {phase.get('phaseType'): phase.get('durationInSeconds')
+              for phase in build.get('phases', [])
+              if phase.get('durationInSeconds') is not None}
+    entry = {
+        'computeType': build.get('environment', {}).get(
+            'computeType', COMPUTE_TYPES[0]),
+        'status': build.get('buildStatus'),
+        'duration': sum(phases.values()),
+        'phases': phases,
+        'time': int(time.time()),
+    }
+    records = history.setdefault(history_key(package, py_version), [])
+    records.append(entry)
+    del records[:-RECORDS_PER_PACKAGE]
+    return entry
+
+
+def estimate_duration(history, package, py_version, compute_type):
+    """
+    Estimates how long a package takes to build on a compute type. Uses the
+    median of earlier successful builds on that compute type, or scales the
+    BUILD phase seen on another compute type by the assumed speedups.
+
+    Parameters
+    ----------
+    history : dict
+        The history from history.load().
+    package : str
+        Name of the PyPi package to build.
+    py_version : str
+        Python version the package is built for.
+    compute_type : str
+        One of history.COMPUTE_TYPES.
+
+    Returns
+    -------
+    float
+        Estimated seconds, or None if the package has never been built.
+    """
+    records = [entry for entry in
+               history.get(history_key(package, py_version), [])
+               if entry.get('status') == 'SUCCEEDED']
+    if not records:
+        return None
+
+    same = [entry['duration'] for entry in records
+            if entry.get('computeType') == compute_type]
+    if same:
+        return statistics.median(same)
+
+    estimates = []
+    for entry in records:
+        other = entry.get('computeType')
+        build_phase = entry.get('phases', {}).get('BUILD', 0)
+        overhead = entry['duration'] - build_phase
+        if build_phase >= MIN_SCALABLE_SECONDS and other in SPEEDUPS:
+            build_phase *= SPEEDUPS[other] / SPEEDUPS[compute_type]
+        estimates.append(overhead + build_phase)
+    return statistics.median(estimates)
+
+
+def cost(compute_type, seconds):
+    """
+    Estimates the price of a build. CodeBuild bills started minutes.
+
+    Parameters
+    ----------
+    compute_type : str
+        One of history.COMPUTE_TYPES.
+    seconds : float
+        Duration of the build.
+
+    Returns
+    -------
+    float
+        The price in USD.
+    """
+    minutes = max(1, -(-int(seconds) // 60))
+    return minutes * PRICES[compute_type]
+
+
+def choose_compute_type(history, package, py_version, policy='time'):
+    """
+    Picks the compute type for a package from its build history.
+
+    Parameters
+    ----------
+    history : dict
+        The history from history.load().
+    package : str
+        Name of the PyPi package to build.
+    py_version : str
+        Python version the package is built for.
+    policy : str
+        "time" for the shortest expected build, "cost" for the cheapest.
+        Ties go to the smaller compute type.
+
+    Returns
+    -------
+    tuple
+        The compute type and its estimated duration in seconds. Packages
+        without history get the smallest compute type and None.
+    """
+    estimates = [(compute_type,
+                  estimate_duration(history, package, py_version,
+                                    compute_type))
+                 for compute_type in COMPUTE_TYPES]
+    if estimates[0][1] is None:
+        return COMPUTE_TYPES[0], None
+
+    def score(item):
+        compute_type, seconds = item
+        if policy == 'cost':
+            return (cost(compute_type, seconds), seconds)
+        # Seconds are only estimates, so don't pay more for under 5%.
+        return (round(seconds / max(1.0, estimates[0][1]) * 20),
+                PRICES[compute_type])
+
+    return min(estimates, key=score)
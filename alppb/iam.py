@@ -3,11 +3,20 @@ Administration of AWS IAM Resources through a boto3 client.
 """
 import json
 import time
+from urllib.parse import unquote
+from . import metadata
+from . import timing
 
+# Seconds to let a replaced policy reach the services that enforce it.
+POLICY_SETTLE_DELAY = 5.0
 
+
+@timing.traced
 def create_role(client, bucket):
     """
-    Creates an IAM Role to use with AWS CodeBuild
+    Creates an IAM Role to use with AWS CodeBuild, or adds the bucket to the
+    policy of one that already exists. The policy grants every bucket it has
+    been used with, so runs for different buckets can share the role.
 
     Parameters
     ----------
@@ -19,10 +28,13 @@ def create_role(client, bucket):
 
     Returns
     -------
-    str
-        ARN of the newly created IAM Role.
+    tuple
+        The ARN of the IAM Role, and True if this call created it rather
+        than finding it, e.g. from a warm or concurrent run.
     """
     print("Creating IAM Role...")
+    existed = False
+    granted = []
     try:
         response = client.create_role(
             RoleName='alppbBuilderRole',
@@ -43,32 +55,219 @@ def create_role(client, bucket):
         )
     except client.exceptions.EntityAlreadyExistsException:
         print(">>alppbBuilderRole already exists, skipping...")
+        existed = True
+        # A role kept by --warm or used by another run right now.
+        cached = metadata.lookup('role', bucket)
+        if cached is not None:
+            print(">>Policy is unchanged, skipping...")
+            return cached, False
         response = client.get_role(RoleName='alppbBuilderRole')
+        granted = policy_buckets(client)
+        if bucket in granted:
+            print(">>Policy is unchanged, skipping...")
+            arn = str(response.get('Role').get('Arn'))
+            metadata.store('role', bucket, arn)
+            return arn, False
 
-    add_role_policy(client, bucket)
+    try:
+        add_role_policy(client, sorted(set(granted) | {bucket}))
+    except Exception:
+        # Don't leave a role behind that nobody will clean up.
+        if not existed:
+            delete_role_if_exists(client)
+        raise
 
-    # TODO be smarter about checking if the role is ready
-    print(">>Waiting for policy propagation before continuing...")
-    time.sleep(12)
+    # Rather than sleeping for propagation here, the CodeBuild calls that
+    # need a new role retry until it can be assumed.
+    # See codebuild.retry_until_role_ready(). An existing role is assumable
+    # right away, so builds would start before its new policy lets them
+    # upload. Either way a run for another bucket may have put its policy
+    # over ours, which is checked for.
+    wait_for_role_policy(client, bucket, granted,
+                         settle=None if existed else 0)
+    arn = str(response.get('Role').get('Arn'))
+    metadata.store('role', bucket, arn)
+    return arn, not existed
 
-    return str(response.get('Role').get('Arn'))
 
+def policy_buckets(client):
+    """
+    Gets the buckets the policy of alppbBuilderRole grants.
 
-def generate_role_policy(bucket):
+    Parameters
+    ----------
+    client : botocore.client.iam
+        A boto3 client for IAM.
+
+    Returns
+    -------
+    list
+        Names of the buckets, empty if there is no policy or it isn't one
+        from iam.generate_role_policy().
     """
-    Generates a valid IAM Role policy from a template. The template requires
-    the name of an existing S3 bucket.
+    try:
+        response = client.get_role_policy(
+            RoleName='alppbBuilderRole',
+            PolicyName='alppbBuilderPolicy'
+        )
+    except client.exceptions.NoSuchEntityException:
+        return []
+
+    document = response.get('PolicyDocument')
+    # boto3 normally decodes the document, but be safe if it did not.
+    if isinstance(document, str):
+        document = json.loads(unquote(document))
+    try:
+        buckets = [resource.split(':::', 1)[1]
+                   for resource in document['Statement'][1]['Resource']]
+    except (KeyError, IndexError, TypeError):
+        return []
+    # A policy changed by hand is replaced rather than extended.
+    if document != json.loads(generate_role_policy(buckets)):
+        return []
+    return buckets
+
+
+def role_policy_matches(client, bucket):
+    """
+    Checks whether alppbBuilderRole already has a policy granting this
+    bucket.
+
+    Parameters
+    ----------
+    client : botocore.client.iam
+        A boto3 client for IAM.
+
+    bucket : str
+        Name of an existing S3 bucket.
+
+    Returns
+    -------
+    bool
+        True if the attached policy grants the bucket.
+    """
+    return bucket in policy_buckets(client)
+
+
+@timing.traced
+def wait_for_role_policy(client, bucket, replaced=None, attempts=8,
+                         delay=1.0, max_delay=8.0, settle=None, sleep=None):
+    """
+    Waits until IAM returns the policy for this bucket, then a little longer
+    for it to reach S3. Runs for other buckets update the policy the same
+    way, so if one put its policy over ours, the bucket is added again.
 
     Parameters
     ----------
+    client : botocore.client.iam
+        A boto3 client for IAM.
+    bucket : str
+        Name of an existing S3 bucket.
+    replaced : list
+        The buckets of the policy that was replaced, which IAM may still
+        return for a while. A policy with other buckets was put by another
+        run. None to only wait.
+    attempts : int
+        The maximum number of times to check the policy.
+    delay : float
+        Seconds to wait before checking again. Doubles on each check.
+    max_delay : float
+        The longest time, in seconds, to wait between checks.
+    settle : float
+        Seconds to wait once the policy is returned. Defaults to
+        iam.POLICY_SETTLE_DELAY.
+    sleep : callable
+        Function used to wait. Defaults to time.sleep, looked up on each
+        call so it can be replaced.
+
+    Returns
+    -------
+    bool
+        True if IAM returned the policy before running out of attempts.
+    """
+    sleep = sleep or time.sleep
+    settle = POLICY_SETTLE_DELAY if settle is None else settle
+    if settle:
+        print(">>Waiting for the IAM Policy to propagate...")
+    matched = False
+    for attempt in range(1, attempts + 1):
+        granted = policy_buckets(client)
+        matched = bucket in granted
+        if matched or attempt == attempts:
+            break
+        if replaced is not None and sorted(granted) != sorted(replaced):
+            print(">>Another run replaced the IAM Policy, adding the bucket "
+                  "again...")
+            add_role_policy(client, sorted(set(granted) | {bucket}))
+            replaced = granted
+        if attempt == 1 and not settle:
+            print(">>Waiting for the IAM Policy to propagate...")
+        with timing.span("iam.wait_for_role_policy.sleep"):
+            sleep(delay)
+        delay = min(max_delay, delay * 2)
+    if settle:
+        with timing.span("iam.wait_for_role_policy.sleep"):
+            sleep(settle)
+    return matched
+
+
+@timing.traced
+def ensure_role(client, bucket):
+    """
+    Reuses alppbBuilderRole if it already exists with the policy for this
+    bucket, which costs two read-only calls and no propagation wait, or
+    none while the metadata cache remembers the role. Otherwise falls back
+    to iam.create_role().
+
+    Parameters
+    ----------
+    client : botocore.client.iam
+        A boto3 client for IAM.
+
     bucket : str
         Name of an existing S3 bucket.
 
+    Returns
+    -------
+    str
+        ARN of the IAM Role.
+    """
+    print("Checking IAM Role...")
+    cached = metadata.lookup('role', bucket)
+    if cached is not None:
+        print(">>alppbBuilderRole is cached, reusing...")
+        return cached
+    try:
+        response = client.get_role(RoleName='alppbBuilderRole')
+    except client.exceptions.NoSuchEntityException:
+        return create_role(client, bucket)[0]
+
+    if not role_policy_matches(client, bucket):
+        return create_role(client, bucket)[0]
+
+    print(">>alppbBuilderRole is up to date, reusing...")
+    arn = str(response.get('Role').get('Arn'))
+    metadata.store('role', bucket, arn)
+    return arn
+
+
+def generate_role_policy(buckets):
+    """
+    Generates a valid IAM Role policy from a template. The template requires
+    the names of existing S3 buckets.
+
+    Parameters
+    ----------
+    buckets : str or list
+        Name of an existing S3 bucket, or a list of them.
+
     Returns
     -------
     str
         The IAM Policy document in JSON.
     """
+    if isinstance(buckets, str):
+        buckets = [buckets]
     return json.dumps({
         "Version": "2012-10-17",
         "Statement": [
@@ -90,7 +289,7 @@ def generate_role_policy(bucket):
                     "s3:ListBucket"
                 ],
                 "Resource": [
-                    "arn:aws:s3:::{}".format(bucket)
+                    "arn:aws:s3:::{}".format(bucket) for bucket in buckets
                 ]
             },
             {
@@ -101,24 +300,26 @@ def generate_role_policy(bucket):
                     "s3:DeleteObject"
                 ],
                 "Resource": [
-                    "arn:aws:s3:::{}/*".format(bucket)
+                    "arn:aws:s3:::{}/*".format(bucket) for bucket in buckets
                 ]
             }
         ]
     })
 
 
-def add_role_policy(client, bucket):
+@timing.traced
+def add_role_policy(client, buckets):
     """
-    Adds an IAM Policy to a newly created IAM Role from iam.create_role().
+    Adds an IAM Policy to an IAM Role from iam.create_role(), replacing any
+    policy it had.
 
     Parameters
     ----------
     client : botocore.client.iam
         A boto3 client for IAM.
 
-    bucket : str
-        Name of an existing S3 bucket.
+    buckets : str or list
+        Every S3 bucket the role must be able to use.
 
     Returns
     -------
@@ -127,10 +328,11 @@ def add_role_policy(client, bucket):
     client.put_role_policy(
         RoleName='alppbBuilderRole',
         PolicyName='alppbBuilderPolicy',
-        PolicyDocument=generate_role_policy(bucket),
+        PolicyDocument=generate_role_policy(buckets),
     )
 
 
+@timing.traced
 def delete_role(client):
     """
     Deletes an IAM Role created from iam.create_role().
@@ -144,6 +346,7 @@ def delete_role(client):
     -------
     """
     print("Deleting IAM Role...")
+    metadata.forget('role')
     # AWS API wants all role policies deleted before the role itself.
     # TODO get all policies on the role and then delete in case it was modified
     client.delete_role_policy(
@@ -151,3 +354,30 @@ def delete_role(client):
         PolicyName='alppbBuilderPolicy'
     )
     client.delete_role(RoleName='alppbBuilderRole')
+
+
+@timing.traced
+def delete_role_if_exists(client):
+    """
+    Deletes the IAM Role created from iam.create_role(), ignoring a role or
+    policy that is already gone.
+
+    Parameters
+    ----------
+    client : botocore.client.iam
+        A boto3 client for IAM.
+
+    Returns
+    -------
+    bool
+        True if the role existed and was deleted.
+    """
+    try:
+        delete_role(client)
+    except client.exceptions.NoSuchEntityException:
+        try:
+            client.delete_role(RoleName='alppbBuilderRole')
+        except client.exceptions.NoSuchEntityException:
+            print(">>alppbBuilderRole does not exist, skipping...")
+            return False
+    return True
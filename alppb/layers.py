@@ -0,0 +1,89 @@
+"""
+Publishes build artifacts as AWS Lambda layer versions through a boto3
+client. Lambda reads the artifact straight from S3, so it never has to be
+downloaded and uploaded again.
+"""
+import re
+from . import timing
+
+RUNTIMES = {
+    "2.7": "python2.7",
+    "3.6": "python3.6",
+    "3.7": "python3.7",
+}
+
+
+def site_packages(py_version):
+    """
+    Determines the directory of a layer that Lambda adds to sys.path.
+
+    Parameters
+    ----------
+    py_version : str
+        Python version being used. Must be one of "2.7", "3.6", or "3.7"
+
+    Returns
+    -------
+    str
+        The path inside the layer, e.g. "python/lib/python3.6/site-packages".
+    """
+    return "python/lib/{}/site-packages".format(
+        RUNTIMES.get(py_version, RUNTIMES["3.6"]))
+
+
+def layer_name(package, py_version):
+    """
+    Determines the name of the layer a package is published as. Lambda only
+    allows letters, digits, hyphens and underscores.
+
+    Parameters
+    ----------
+    package : str
+        Name of the PyPi package that was built.
+    py_version : str
+        Python version the package was built for.
+
+    Returns
+    -------
+    str
+        The layer name, e.g. "alppb-requests-py36".
+    """
+    name = "alppb-{}-py{}".format(
+        re.sub(r'[^A-Za-z0-9_-]+', '_', package),
+        (py_version or "3.6").replace(".", ""))
+    return name[:64]
+
+
+@timing.traced
+def publish_layer(client, bucket, key, package, py_version):
+    """
+    Publishes a new version of the layer for a package from an artifact in
+    S3. The bucket must be in the same region as the client.
+
+    Parameters
+    ----------
+    client : botocore.client.Lambda
+        A boto3 client for AWS Lambda.
+    bucket : str
+        Name of the bucket the artifact exists in.
+    key : str
+        The S3 key of the artifact, a zip laid out as a layer. See
+        codebuild.generate_buildspec().
+    package : str
+        Name of the PyPi package that was built.
+    py_version : str
+        Python version the package was built for.
+
+    Returns
+    -------
+    str
+        The ARN of the new layer version.
+    """
+    name = layer_name(package, py_version)
+    print("Publishing {} as Lambda layer {}...".format(package, name))
+    response = client.publish_layer_version(
+        LayerName=name,
+        Description="{} built by alppb".format(package)[:256],
+        Content={'S3Bucket': bucket, 'S3Key': key},
+        CompatibleRuntimes=[RUNTIMES.get(py_version, RUNTIMES["3.6"])])
+    return response['LayerVersionArn']
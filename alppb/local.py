@@ -0,0 +1,204 @@
+"""
+Runs Buildspecs on this machine instead of AWS CodeBuild, either in the
+alppb Docker images through a local container runtime (Docker or Podman) or
+as a plain subprocess on the host.
+"""
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import uuid
+import yaml
+from . import s3
+from . import timing
+
+RUNTIMES = ["docker", "podman"]
+PHASES = ["install", "pre_build", "build", "post_build"]
+# Commands the Buildspecs call that only exist in the alppb images. Host
+# builds point them at the running Python.
+SHIMS = {
+    "pip": "{} -m pip",
+    "pip-2.7": "{} -m pip",
+    "pip-3.6": "{} -m pip",
+    "pip3.7": "{} -m pip",
+    "python2.7": "{}",
+    "python3.6": "{}",
+    "python3.7": "{}",
+}
+
+
+def buildspec_script(buildspec):
+    """
+    Turns a Buildspec into a shell script that runs its commands in order,
+    stopping at the first one that fails like CodeBuild does.
+
+    Parameters
+    ----------
+    buildspec : str
+        The Buildspec in YAML. Use codebuild.generate_buildspec().
+
+    Returns
+    -------
+    str
+        The script.
+    """
+    spec = yaml.safe_load(buildspec)
+    lines = ["set -e"]
+    variables = (spec.get("env") or {}).get("variables") or {}
+    for name, value in sorted(variables.items()):
+        lines.append("export {}={}".format(name, shlex.quote(str(value))))
+    for phase in PHASES:
+        lines.extend((spec.get("phases", {}).get(phase) or {})
+                     .get("commands", []))
+    return "\n".join(lines)
+
+
+def write_shims(directory):
+    """
+    Writes the commands in local.SHIMS as scripts that run the current
+    Python, for builds without the alppb images.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write the scripts to. Put it first on $PATH.
+
+    Returns
+    -------
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, command in SHIMS.items():
+        path = os.path.join(directory, name)
+        with open(path, "w") as shim:
+            shim.write('#!/bin/sh\nexec {} "$@"\n'.format(
+                command.format(shlex.quote(sys.executable))))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+@timing.traced
+def run_build(buildspec, artifact, work_dir, runtime=None, image=None):
+    """
+    Runs a Buildspec and collects the artifact it creates. The output of the
+    build is written to build.log in work_dir.
+
+    Parameters
+    ----------
+    buildspec : str
+        The Buildspec in YAML. Use codebuild.generate_buildspec().
+    artifact : str
+        File name of the artifact the Buildspec creates.
+    work_dir : str
+        An empty directory for the build. The artifact ends up in it.
+    runtime : str
+        One of local.RUNTIMES to run the build in a container of image, or
+        None to run it as a subprocess in work_dir.
+    image : str
+        The Docker image to run the build in. Use
+        codebuild.determine_image().
+
+    Returns
+    -------
+    str
+        Path of the artifact, or None if the build failed.
+    """
+    script = buildspec_script(buildspec)
+    log_path = os.path.join(work_dir, "build.log")
+    with open(log_path, "w") as log:
+        if runtime is None:
+            shims = os.path.join(work_dir, "shims")
+            write_shims(shims)
+            env = dict(os.environ)
+            env["PATH"] = shims + os.pathsep + env.get("PATH", "")
+            returncode = subprocess.run(
+                ["sh", "-c", script], cwd=work_dir, env=env, stdout=log,
+                stderr=subprocess.STDOUT, check=False).returncode
+        else:
+            # Files written by the container would belong to its user, so
+            # copy the artifact out instead of mounting work_dir.
+            name = "alppb-{}".format(uuid.uuid4().hex)
+            try:
+                returncode = subprocess.run(
+                    [runtime, "run", "--name", name, "-w", "/build", image,
+                     "sh", "-c", script], stdout=log,
+                    stderr=subprocess.STDOUT, check=False).returncode
+                if returncode == 0:
+                    returncode = subprocess.run(
+                        [runtime, "cp", "{}:/build/{}".format(name, artifact),
+                         work_dir], stdout=log, stderr=subprocess.STDOUT,
+                        check=False).returncode
+            finally:
+                subprocess.run([runtime, "rm", "-f", name],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, check=False)
+    path = os.path.join(work_dir, artifact)
+    if returncode != 0 or not os.path.isfile(path):
+        return None
+    return path
+
+
+def read_log(work_dir):
+    """
+    Reads the output of a build run by run_build().
+
+    Parameters
+    ----------
+    work_dir : str
+        The directory the build ran in.
+
+    Returns
+    -------
+    list
+        The log lines.
+    """
+    try:
+        with open(os.path.join(work_dir, "build.log"),
+                  errors="replace") as log:
+            return log.read().splitlines()
+    except OSError:
+        return []
+
+
+@timing.traced
+def deliver_file(path, local_path, output_dir=None, config=None,
+                 progress=False, to_zip=False, download=True):
+    """
+    Delivers a locally built artifact the way s3.deliver_artifact() delivers
+    one from S3, so both take the same options.
+
+    Parameters
+    ----------
+    path : str
+        Path of the built artifact.
+    local_path: str
+        The local path the artifact is moved to when output_dir is None.
+    output_dir : str
+        Directory to extract the artifact into, or None to move it.
+    config : boto3.s3.transfer.TransferConfig
+        Unused, there is nothing to transfer.
+    progress : bool
+        Unused, there is nothing to transfer.
+    to_zip : bool
+        If True, a tar is converted to a zip for AWS Lambda.
+    download : bool
+        If False, nothing is delivered.
+
+    Returns
+    -------
+    str
+        Path of the delivered file, output_dir, or None if nothing was
+        delivered.
+    """
+    # pylint: disable=unused-argument
+    if not download:
+        return None
+    if output_dir is not None:
+        s3.extract_local(path, output_dir)
+        return output_dir
+    shutil.move(path, local_path)
+    if to_zip and s3.file_format(local_path) != "zip":
+        zip_path = s3.convert_to_zip(local_path)
+        os.remove(local_path)
+        return zip_path
+    return local_path
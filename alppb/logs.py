@@ -0,0 +1,209 @@
+"""
+Tails the Amazon CloudWatch Logs of running CodeBuild builds through a boto3
+client, so known fatal errors stop a build early instead of waiting for it
+to fail.
+"""
+from collections import deque
+import re
+from botocore.exceptions import ClientError
+
+# Errors pip can't recover from. Each one is matched against every log line.
+DEFAULT_FATAL_PATTERNS = [
+    r"Could not find a version that satisfies the requirement",
+    r"No matching distribution found for",
+    r"error: command '.+' failed with exit status \d+",
+    r"fatal error: .+: No such file or directory",
+    r"Command \".+\" failed with error code \d+",
+    r"ERROR: Command errored out with exit status \d+",
+]
+
+# Lines that show whether pip's cache was used, counted per build.
+PIP_CACHE_COUNTERS = {
+    'cached': r"Using cached ",
+    'compiled': r"Building wheel for ",
+}
+
+# Lines whose groups are kept per build. The pruning stage of the Buildspec
+# logs how many bytes it removed, see codebuild.prune_commands().
+PRUNE_CAPTURES = {
+    'pruned': r"^alppb pruned (\d+) of (\d+) bytes",
+}
+
+
+class LogTailer(object):
+    """
+    Follows the log stream of each build given to it, keeping the last few
+    lines for context and checking new lines against a list of fatal
+    patterns.
+    """
+
+    def __init__(self, client, patterns=None, context=10, counters=None,
+                 captures=None):
+        """
+        Parameters
+        ----------
+        client : botocore.client.CloudWatchLogs
+            A boto3 client for CloudWatch Logs.
+        patterns : list
+            Regular expressions that mark a log line as fatal. Defaults to
+            logs.DEFAULT_FATAL_PATTERNS.
+        context : int
+            How many of the most recent lines to keep per build.
+        counters : dict
+            Optional map of names to regular expressions. Log lines matching
+            each one are counted per build, see LogTailer.counts().
+        captures : dict
+            Optional map of names to regular expressions with groups. The
+            groups of the last line matching each one are kept per build,
+            see LogTailer.captured().
+        """
+        self.client = client
+        self.patterns = [re.compile(pattern) for pattern in
+                         (DEFAULT_FATAL_PATTERNS if patterns is None
+                          else patterns)]
+        self.context = context
+        self.counters = {name: re.compile(pattern) for name, pattern in
+                         (counters or {}).items()}
+        self.captures = {name: re.compile(pattern) for name, pattern in
+                         (captures or {}).items()}
+        self._counts = {}
+        self._captured = {}
+        self._tokens = {}
+        self._lines = {}
+        # Set once CloudWatch Logs refuses to return events, see fetch().
+        self.denied = False
+
+    def fetch(self, build):
+        """
+        Gets the log lines a build wrote since the last fetch.
+
+        Parameters
+        ----------
+        build : dict
+            The build as returned by batch_get_builds.
+
+        Returns
+        -------
+        list
+            The new log lines, oldest first. Always empty once the caller
+            was denied access to the logs.
+        """
+        if self.denied:
+            return []
+        logs = build.get('logs') or {}
+        group = logs.get('groupName')
+        stream = logs.get('streamName')
+        if not group or not stream:
+            # CodeBuild only reports the stream once the build has started.
+            return []
+
+        build_id = build.get('id')
+        lines = []
+        while True:
+            kwargs = {'logGroupName': group, 'logStreamName': stream,
+                      'startFromHead': True}
+            token = self._tokens.get(build_id)
+            if token is not None:
+                kwargs['nextToken'] = token
+            try:
+                response = self.client.get_log_events(**kwargs)
+            except ClientError as err:
+                code = err.response['Error']['Code']
+                if code == 'ResourceNotFoundException':
+                    return lines
+                if code == 'AccessDeniedException':
+                    # Without logs:GetLogEvents no build can be tailed, so
+                    # only the first fetch raises.
+                    self.denied = True
+                raise err
+            lines.extend(event.get('message', '').rstrip('\n')
+                         for event in response.get('events', []))
+            next_token = response.get('nextForwardToken')
+            # The same token coming back means the end of the stream.
+            if next_token is None or next_token == token:
+                break
+            self._tokens[build_id] = next_token
+
+        self._lines.setdefault(
+            build_id, deque(maxlen=self.context)).extend(lines)
+        counts = self._counts.setdefault(
+            build_id, dict.fromkeys(self.counters, 0))
+        captured = self._captured.setdefault(build_id, {})
+        for line in lines:
+            for name, pattern in self.counters.items():
+                if pattern.search(line):
+                    counts[name] += 1
+            for name, pattern in self.captures.items():
+                match = pattern.search(line)
+                if match:
+                    captured[name] = match.groups()
+        return lines
+
+    def check(self, build):
+        """
+        Fetches new log lines of a build and looks for a fatal error.
+
+        Parameters
+        ----------
+        build : dict
+            The build as returned by batch_get_builds.
+
+        Returns
+        -------
+        str
+            The first fatal log line, or None if there wasn't one.
+        """
+        for line in self.fetch(build):
+            if any(pattern.search(line) for pattern in self.patterns):
+                return line
+        return None
+
+    def counts(self, build_id):
+        """
+        Gets how many log lines of a build matched each counter.
+
+        Parameters
+        ----------
+        build_id : str
+            The ID of the AWS CodeBuild job.
+
+        Returns
+        -------
+        dict
+            Maps each counter name to its number of matching lines.
+        """
+        return dict(self._counts.get(build_id,
+                                     dict.fromkeys(self.counters, 0)))
+
+    def captured(self, build_id):
+        """
+        Gets the groups of the last log line of a build that matched each
+        capture.
+
+        Parameters
+        ----------
+        build_id : str
+            The ID of the AWS CodeBuild job.
+
+        Returns
+        -------
+        dict
+            Maps each capture name that matched to the tuple of its groups.
+        """
+        return dict(self._captured.get(build_id, {}))
+
+    def recent(self, build_id):
+        """
+        Gets the most recent log lines of a build.
+
+        Parameters
+        ----------
+        build_id : str
+            The ID of the AWS CodeBuild job.
+
+        Returns
+        -------
+        list
+            Up to `context` lines, oldest first.
+        """
+        return list(self._lines.get(build_id, []))
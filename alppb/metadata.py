@@ -0,0 +1,243 @@
+"""
+A small on-disk cache of control-plane answers that almost never change, so
+warm runs skip their round trips: the region of a bucket, the ARN of the
+IAM Role, the settings of the CodeBuild project and the regions CodeBuild
+is available in. Entries expire after their kind's TTL and are forgotten
+when the resource is deleted or a run fails.
+
+The cache is off until enable() is called, so library users and tests
+never touch the disk unless they ask to.
+"""
+import hashlib
+import json
+import threading
+import time
+from . import clients
+from . import files
+
+DAY = 24 * 60 * 60
+# Seconds each kind of entry is trusted for.
+TTLS = {
+    'regions': 7 * DAY,
+    'bucket_region': 7 * DAY,
+    'role': DAY,
+    'project': DAY,
+}
+# Kinds that belong to an AWS account rather than to everyone.
+ACCOUNT_KINDS = ('role', 'project')
+
+_LOCK = threading.Lock()
+_PATH = None
+_ENTRIES = None
+
+
+def default_metadata_path():
+    """
+    Determines where the metadata cache is kept. Respects $XDG_CACHE_HOME
+    and falls back to ~/.cache.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    str
+        Path of the metadata file.
+    """
+    return files.default_path('cache', 'metadata.json')
+
+
+def enable(path=None):
+    """
+    Turns the cache on, reading it from path.
+
+    Parameters
+    ----------
+    path : str
+        Path of the metadata file. Defaults to default_metadata_path().
+
+    Returns
+    -------
+    """
+    global _PATH, _ENTRIES  # pylint: disable=global-statement
+    with _LOCK:
+        _PATH = path or default_metadata_path()
+        _ENTRIES = load(_PATH)
+
+
+def reset():
+    """
+    Turns the cache off, leaving the file as it is.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    """
+    global _PATH, _ENTRIES  # pylint: disable=global-statement
+    with _LOCK:
+        _PATH = None
+        _ENTRIES = None
+
+
+def load(path):
+    """
+    Reads the metadata file. A missing or unreadable file is an empty
+    cache.
+
+    Parameters
+    ----------
+    path : str
+        Path of the metadata file.
+
+    Returns
+    -------
+    dict
+        Maps each entry's key to its "value" and "expires" time.
+    """
+    try:
+        with open(path) as metadata_file:
+            entries = json.load(metadata_file)
+    except (OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def save(path, entries):
+    """
+    Writes the metadata file, replacing it atomically. Failing to write
+    only costs the next run its round trips.
+
+    Parameters
+    ----------
+    path : str
+        Path of the metadata file.
+    entries : dict
+        The entries from load().
+
+    Returns
+    -------
+    """
+    try:
+        files.write_json(path, entries)
+    except OSError as err:
+        print(">>Could not save the metadata cache: {}".format(err))
+
+
+def account_scope():
+    """
+    Identifies the credentials in use without asking AWS. Entries of an
+    account are kept under a hash of the access key ID, so switching
+    profiles never reuses another account's role or project.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    str
+        The scope, or None if there are no credentials.
+    """
+    credentials = clients.get_session().get_credentials()
+    if credentials is None or not credentials.access_key:
+        return None
+    return hashlib.sha256(
+        credentials.access_key.encode('utf-8')).hexdigest()[:16]
+
+
+def entry_key(kind, key):
+    """ The key an entry is stored under, or None if it can't be scoped. """
+    if kind not in ACCOUNT_KINDS:
+        return "{}/{}".format(kind, key)
+    scope = account_scope()
+    if scope is None:
+        return None
+    return "{}/{}/{}".format(kind, scope, key)
+
+
+def lookup(kind, key):
+    """
+    Gets a cached answer.
+
+    Parameters
+    ----------
+    kind : str
+        One of the kinds in TTLS, e.g. "bucket_region".
+    key : str
+        What the answer is about, e.g. the bucket name.
+
+    Returns
+    -------
+    object
+        The cached value, or None if the cache is off, or the entry is
+        missing or expired.
+    """
+    if _ENTRIES is None:
+        return None
+    name = entry_key(kind, key)
+    with _LOCK:
+        entry = None if _ENTRIES is None else _ENTRIES.get(name)
+    if not isinstance(entry, dict) or entry.get('expires', 0) < time.time():
+        return None
+    return entry.get('value')
+
+
+def store(kind, key, value):
+    """
+    Caches an answer for its kind's TTL. Does nothing if the cache is off.
+
+    Parameters
+    ----------
+    kind : str
+        One of the kinds in TTLS.
+    key : str
+        What the answer is about.
+    value : object
+        The answer. Must be JSON serializable.
+
+    Returns
+    -------
+    """
+    if _ENTRIES is None:
+        return
+    name = entry_key(kind, key)
+    if name is None:
+        return
+    with _LOCK:
+        if _ENTRIES is None:
+            return
+        _ENTRIES[name] = {'value': value,
+                          'expires': time.time() + TTLS[kind]}
+        save(_PATH, _ENTRIES)
+
+
+def forget(kind=None, key=None):
+    """
+    Drops cached answers, e.g. because the resource was deleted or a call
+    that relied on them failed.
+
+    Parameters
+    ----------
+    kind : str
+        The kind to drop, or None for every kind.
+    key : str
+        The entry of that kind to drop, or None for all of them. Entries of
+        account kinds are dropped for every account.
+
+    Returns
+    -------
+    """
+    if _ENTRIES is None:
+        return
+    with _LOCK:
+        if _ENTRIES is None:
+            return
+        stale = [name for name in _ENTRIES
+                 if kind is None or
+                 (name.split("/", 1)[0] == kind and
+                  (key is None or name.rsplit("/", 1)[-1] == key))]
+        if stale:
+            for name in stale:
+                del _ENTRIES[name]
+            save(_PATH, _ENTRIES)
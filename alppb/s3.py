@@ -1,12 +1,117 @@
 """
 Administration of Amazon S3 Resources through a boto3 client.
 """
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from botocore.exceptions import ParamValidationError
+from . import errors
+from . import metadata
+from . import timing
 
+MB = 1024 ** 2
+# Leading bytes of each archive format an artifact can be transferred in.
+MAGIC_NUMBERS = [
+    (b'PK', 'zip'),
+    (b'\x1f\x8b', 'tar.gz'),
+    (b'\xfd7zXZ\x00', 'tar.xz'),
+]
 
+
+def transfer_config(part_size=8, threads=10):
+    """
+    Creates the transfer settings used to download artifacts. Objects larger
+    than one part are fetched as parallel ranged GETs.
+
+    Parameters
+    ----------
+    part_size : int
+        Size of each part in MB.
+    threads : int
+        The maximum number of parts to download at the same time.
+
+    Returns
+    -------
+    boto3.s3.transfer.TransferConfig
+        The transfer settings.
+    """
+    return TransferConfig(multipart_threshold=part_size * MB,
+                          multipart_chunksize=part_size * MB,
+                          max_concurrency=threads)
+
+
+class Progress(object):
+    """
+    A thread-safe progress callback for S3 transfers that prints every time
+    another 10% of the object has been transferred.
+    """
+
+    def __init__(self, label, size, step=10):
+        """
+        Parameters
+        ----------
+        label : str
+            What is being transferred, printed with each update.
+        size : int
+            Total number of bytes to transfer.
+        step : int
+            Print every time this many more percent are done.
+        """
+        self.label = label
+        self.size = size
+        self.step = step
+        self.done = 0
+        self._printed = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, transferred):
+        """ Called by boto3 with the number of bytes just transferred. """
+        with self._lock:
+            self.done += transferred
+            if not self.size:
+                return
+            percent = min(100, self.done * 100 // self.size)
+            if percent >= self._printed + self.step or \
+                    (percent == 100 and self._printed < 100):
+                self._printed = percent - percent % self.step
+                # Readers of several threads may fetch a few bytes twice.
+                print(">>{} {}% ({:.1f} of {:.1f} MB)".format(
+                    self.label, percent, min(self.done, self.size) / MB,
+                    self.size / MB))
+
+
+@timing.traced
+def object_size(client, bucket, key):
+    """
+    Gets the size of an object in S3.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the object exists in.
+    key: str
+        The S3 key of the object.
+
+    Returns
+    -------
+    int
+        Size of the object in bytes.
+    """
+    return client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+
+@timing.traced
 def download_artifact(resource, bucket, key='alppbBuilder/alppb.zip',
-                      local_path='alppb.zip'):
+                      local_path='alppb.zip', config=None, progress=False):
     """
     Fetches the artifact from Amazon S3 built by alppb .
 
@@ -22,15 +127,457 @@ def download_artifact(resource, bucket, key='alppbBuilder/alppb.zip',
     local_path: str
         The local path where the artifact will be downloaded. Defaults to the
         current directory alppb is being run from.
+    config : boto3.s3.transfer.TransferConfig
+        Part size and thread count to use. See s3.transfer_config().
+    progress : bool
+        If True, print the progress of the download.
 
     Returns
     -------
     """
     print("Downloading built package(s) to {}...".format(local_path))
-    resource.meta.client.download_file(bucket, key, local_path)
+    client = resource.meta.client
+    callback = None
+    if progress:
+        callback = Progress(local_path, object_size(client, bucket, key))
+    client.download_file(bucket, key, local_path, Config=config,
+                         Callback=callback)
     print("Download complete...")
 
 
+class S3ObjectReader(io.RawIOBase):
+    """
+    A seekable, read-only file object over an S3 object. Reads are served
+    from ranged GETs of block_size bytes, so at most one block is held in
+    memory no matter how large the object is.
+    """
+
+    def __init__(self, client, bucket, key, size=None, block_size=8 * MB,
+                 callback=None, stop=None):
+        """
+        Parameters
+        ----------
+        client : botocore.client.S3
+            A boto3 client for S3.
+        bucket : str
+            Name of the bucket the object exists in.
+        key: str
+            The S3 key of the object.
+        size : int
+            Size of the object in bytes. Looked up with head_object if None.
+        block_size : int
+            Number of bytes fetched by each ranged GET.
+        callback : callable
+            Optional function called with the number of bytes fetched.
+        stop : int
+            Optional offset that ranged GETs starting before it don't read
+            past, e.g. where the part of the object a thread reads ends.
+        """
+        super(S3ObjectReader, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = object_size(client, bucket, key) if size is None \
+            else size
+        self.block_size = block_size
+        self.callback = callback
+        self.stop = stop
+        self._position = 0
+        self._block_start = 0
+        self._block = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        self._position = max(0, self._position)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        offset = self._position - self._block_start
+        if not 0 <= offset < len(self._block):
+            self._fetch(self._position, self.block_size)
+            offset = 0
+        count = min(len(buffer), len(self._block) - offset)
+        buffer[:count] = self._block[offset:offset + count]
+        self._position += count
+        return count
+
+    def _fetch(self, start, length):
+        """ Replaces the buffered block with a ranged GET. """
+        end = min(self.size, start + length)
+        if self.stop is not None and start < self.stop:
+            end = min(end, self.stop)
+        end -= 1
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key,
+            Range='bytes={}-{}'.format(start, end))
+        self._block = response['Body'].read()
+        self._block_start = start
+        if self.callback is not None:
+            self.callback(len(self._block))
+
+
+def extract_members(source, names, target_dir):
+    """
+    Extracts some members of a zip, keeping their Unix permissions.
+
+    Parameters
+    ----------
+    source : file object or str
+        The zip, either a path or a seekable file object.
+    names : list
+        Names of the members to extract.
+    target_dir : str
+        Directory to extract into.
+
+    Returns
+    -------
+    """
+    with zipfile.ZipFile(source) as archive:
+        for name in names:
+            info = archive.getinfo(name)
+            # ZipFile.extract() strips absolute paths and "..".
+            path = archive.extract(info, target_dir)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode and not info.is_dir():
+                os.chmod(path, mode)
+
+
+def zip_chunks(infos, count):
+    """
+    Splits the members of a zip into contiguous runs of about the same
+    compressed size, so each thread reads its own part of the archive.
+
+    Parameters
+    ----------
+    infos : list
+        The ZipInfo of every member.
+    count : int
+        The maximum number of runs.
+
+    Returns
+    -------
+    list
+        Lists of ZipInfo, in the order they are stored in the archive.
+    """
+    infos = sorted(infos, key=lambda info: info.header_offset)
+    total = sum(info.compress_size for info in infos)
+    chunks = []
+    size = 0
+    for info in infos:
+        if not chunks or (size >= total * len(chunks) / count and
+                          len(chunks) < count):
+            chunks.append([])
+        chunks[-1].append(info)
+        size += info.compress_size
+    return chunks
+
+
+def extract_zip(open_source, target_dir, threads=4, min_chunk=0):
+    """
+    Extracts a zip into a directory, splitting the members across several
+    threads. Each thread gets a contiguous run of members and opens its own
+    copy of the source because ZipFile objects can't be shared between
+    threads.
+
+    Parameters
+    ----------
+    open_source : callable
+        Returns a new seekable file object (or path) for the zip each time
+        it is called. It is passed the offset the thread's members end at,
+        or None, so a reader can avoid fetching past them.
+    target_dir : str
+        Directory to extract into.
+    threads : int
+        The maximum number of threads to extract with.
+    min_chunk : int
+        The fewest compressed bytes worth a thread of their own.
+
+    Returns
+    -------
+    int
+        Number of members extracted.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    with zipfile.ZipFile(open_source(None)) as archive:
+        infos = archive.infolist()
+    # Threads creating the same parent directory would race, so create them
+    # all up front, sanitized the way ZipFile.extract() does.
+    for info in infos:
+        parts = [part for part in info.filename.split('/')[:-1]
+                 if part not in ('', '.', '..')]
+        os.makedirs(os.path.join(target_dir, *parts), exist_ok=True)
+    total = sum(info.compress_size for info in infos)
+    if min_chunk:
+        threads = min(threads, total // min_chunk)
+    chunks = zip_chunks(infos, max(1, threads))
+    # Each run ends where the next one starts.
+    stops = [chunk[0].header_offset for chunk in chunks[1:]] + [None]
+    with ThreadPoolExecutor(max_workers=max(1, len(chunks))) as executor:
+        futures = [
+            executor.submit(extract_members, open_source(stop),
+                            [info.filename for info in chunk], target_dir)
+            for chunk, stop in zip(chunks, stops)]
+        for future in futures:
+            future.result()
+    return len(infos)
+
+
+def detect_format(header):
+    """
+    Determines the archive format of an artifact from its first bytes.
+
+    Parameters
+    ----------
+    header : bytes
+        At least the first six bytes of the artifact.
+
+    Returns
+    -------
+    str
+        One of "zip", "tar.gz" or "tar.xz".
+    """
+    for magic, archive_format in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return archive_format
+    raise ValueError("Unknown archive format")
+
+
+def file_format(path):
+    """
+    Determines the archive format of a local artifact.
+
+    Parameters
+    ----------
+    path : str
+        Path of the artifact.
+
+    Returns
+    -------
+    str
+        One of "zip", "tar.gz" or "tar.xz".
+    """
+    with open(path, 'rb') as artifact:
+        return detect_format(artifact.read(6))
+
+
+def object_format(client, bucket, key):
+    """
+    Determines the archive format of an artifact in S3 from a ranged GET of
+    its first bytes.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the artifact exists in.
+    key: str
+        The S3 key of the artifact.
+
+    Returns
+    -------
+    str
+        One of "zip", "tar.gz" or "tar.xz".
+    """
+    response = client.get_object(Bucket=bucket, Key=key, Range='bytes=0-5')
+    return detect_format(response['Body'].read())
+
+
+def zip_path(path):
+    """
+    Gets the path a tar artifact is converted to, e.g. "alppb-lxml.zip" for
+    "alppb-lxml.tar.xz".
+
+    Parameters
+    ----------
+    path : str
+        Path of the artifact.
+
+    Returns
+    -------
+    str
+        The path with its archive suffix replaced by ".zip".
+    """
+    for suffix in ('.tar.gz', '.tar.xz', '.zip'):
+        if path.endswith(suffix):
+            return path[:-len(suffix)] + '.zip'
+    return path + '.zip'
+
+
+@timing.traced
+def convert_to_zip(path, target=None):
+    """
+    Repacks a tar artifact as the zip AWS Lambda expects. Files are streamed
+    from the tar into the zip one at a time and keep their permissions.
+    Symbolic links are stored as the file they point to, like `zip -r`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the tar artifact.
+    target : str
+        Path of the zip to write. Defaults to s3.zip_path(path).
+
+    Returns
+    -------
+    str
+        Path of the zip.
+    """
+    target = target or zip_path(path)
+    print("Converting {} to {}...".format(path, target))
+    with tarfile.open(path, 'r:*') as archive, \
+            zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as output:
+        for member in archive:
+            # Zip can't store dates before 1980.
+            date_time = time.localtime(max(member.mtime, 315532800))[:6]
+            if member.isdir():
+                info = zipfile.ZipInfo(member.name.rstrip('/') + '/',
+                                       date_time)
+                info.external_attr = (0o40000 | member.mode) << 16 | 0x10
+                output.writestr(info, b'')
+                continue
+            source = archive.extractfile(member)
+            if source is None:
+                continue
+            info = zipfile.ZipInfo(member.name, date_time)
+            info.external_attr = (0o100000 | (member.mode & 0o777)) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with source, output.open(info, 'w') as entry:
+                shutil.copyfileobj(source, entry, 1024 * 1024)
+    return target
+
+
+def extract_tar(source, target_dir):
+    """
+    Extracts a tar, compressed or not, into a directory in a single pass
+    over the source, so it may be a stream. Members that would land outside
+    target_dir, and device files, are skipped.
+
+    Parameters
+    ----------
+    source : file object
+        The tar, read front to back once.
+    target_dir : str
+        Directory to extract into.
+
+    Returns
+    -------
+    int
+        Number of members extracted.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    root = os.path.realpath(target_dir)
+    # Python versions with extraction filters get their safety checks too.
+    kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    count = 0
+    with tarfile.open(fileobj=source, mode='r|*') as archive:
+        for member in archive:
+            path = os.path.realpath(os.path.join(root, member.name))
+            if not (path == root or path.startswith(root + os.sep)) or \
+                    member.isdev():
+                print(">>Skipping unsafe member {}".format(member.name))
+                continue
+            archive.extract(member, target_dir, **kwargs)
+            count += 1
+    return count
+
+
+@timing.traced
+def extract_local(path, target_dir, threads=4):
+    """
+    Extracts a local artifact of any archive format into a directory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the artifact.
+    target_dir : str
+        Directory to extract into.
+    threads : int
+        The maximum number of threads to extract a zip with.
+
+    Returns
+    -------
+    int
+        Number of members extracted.
+    """
+    if file_format(path) == 'zip':
+        return extract_zip(lambda stop: path, target_dir, threads)
+    with open(path, 'rb') as source:
+        return extract_tar(source, target_dir)
+
+
+@timing.traced
+def extract_artifact(client, bucket, key, target_dir, threads=4,
+                     block_size=8 * MB, progress=False):
+    """
+    Streams the artifact from Amazon S3 and extracts it straight into a
+    directory. The artifact is never written to disk and each thread holds
+    at most block_size bytes of it in memory. Zips are extracted by several
+    threads, tars in one sequential pass.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        A boto3 client for S3.
+    bucket : str
+        Name of the bucket the artifact exists in.
+    key: str
+        The S3 key of the artifact.
+    target_dir : str
+        Directory to extract into.
+    threads : int
+        The maximum number of threads to extract a zip with.
+    block_size : int
+        Number of bytes fetched by each ranged GET.
+    progress : bool
+        If True, print the progress of the download.
+
+    Returns
+    -------
+    int
+        Number of members extracted.
+    """
+    print("Extracting built package(s) to {}...".format(target_dir))
+    size = object_size(client, bucket, key)
+    callback = Progress(target_dir, size) if progress else None
+
+    def open_source(stop=None):
+        """ A new reader, and so a new buffer, for every thread. """
+        return io.BufferedReader(
+            S3ObjectReader(client, bucket, key, size, block_size, callback,
+                           stop),
+            buffer_size=64 * 1024)
+
+    if object_format(client, bucket, key) == 'zip':
+        # Threads share nothing, so each should have at least a block.
+        count = extract_zip(open_source, target_dir, threads, block_size)
+    else:
+        with open_source() as source:
+            count = extract_tar(source, target_dir)
+    print("Extracted {} files...".format(count))
+    return count
+
+
+@timing.traced
 def delete_artifact(client, bucket, key='alppbBuilder/alppb.zip'):
     """
     Deletes the artifact from Amazon S3 built by alppb.
@@ -52,40 +599,105 @@ def delete_artifact(client, bucket, key='alppbBuilder/alppb.zip'):
     client.delete_object(Bucket=bucket, Key=key)
 
 
+@timing.traced
 def bucket_region(client, bucket):
     """
-    Gets the region where this bucket exists.
+    Gets the region where this bucket exists. The answer is kept in the
+    metadata cache.
 
     Parameters
     ----------
     client : botocore.client.S3
         A boto3 client for S3.
+    bucket : str
+        Name of the bucket.
 
     Returns
     -------
     str
         Region of the bucket.
+
+    Raises
+    ------
+    errors.BucketError
+        If the bucket doesn't exist or its name is invalid.
     """
+    cached = metadata.lookup('bucket_region', bucket)
+    if cached is not None:
+        return cached
     # Check if the bucket exists and has a valid name.
     try:
         response = client.get_bucket_location(Bucket=bucket)
     except ClientError as err:
         if err.response['Error']['Code'] == 'NoSuchBucket':
-            print("ERROR: {} is an invalid bucket name. "
-                  "Please check the name and try again."
-                  .format(bucket))
-            exit(1)
-        else:
-            print("ERROR: Unhandled exception. Please submit a bug report to "
-                  "https://github.com/irlrobot/alppb/issues/new")
-            raise err
+            raise errors.BucketError(
+                "{} is an invalid bucket name. Please check the name and "
+                "try again.".format(bucket))
+        print("ERROR: Unhandled exception. Please submit a bug report to "
+              "https://github.com/irlrobot/alppb/issues/new")
+        raise err
     except ParamValidationError:
-        print("ERROR: {} is an invalid bucket name. "
-              "Please check the name and try again."
-              .format(bucket))
-        exit(1)
-
-    location = response.get('LocationConstraint')
-    if location is None:
-        return 'us-east-1'
-    return str(location)
+        raise errors.BucketError(
+            "{} is an invalid bucket name. Please check the name and try "
+            "again.".format(bucket))
+
+    # Buckets in us-east-1 have no location constraint.
+    location = str(response.get('LocationConstraint') or 'us-east-1')
+    metadata.store('bucket_region', bucket, location)
+    return location
+
+
+@timing.traced
+def deliver_artifact(resource, bucket, key, local_path, output_dir=None,
+                     config=None, progress=False, to_zip=False,
+                     download=True):
+    """
+    Delivers an artifact from Amazon S3, either as a file at local_path or
+    extracted into output_dir. Zip, tar.gz and tar.xz artifacts are all
+    handled.
+
+    Parameters
+    ----------
+    resource : boto3.resources.factory.s3.ServiceResource
+        A boto3 Resource interface for S3.
+    bucket : str
+        Name of the bucket the artifact exists in.
+    key: str
+        The S3 key of the artifact.
+    local_path: str
+        The local path the zip is downloaded to when output_dir is None.
+    output_dir : str
+        Directory to stream and extract the artifact into, or None to
+        download the zip.
+    config : boto3.s3.transfer.TransferConfig
+        Part size and thread count to use. See s3.transfer_config().
+    progress : bool
+        If True, print the progress of the download.
+    to_zip : bool
+        If True, a downloaded tar is converted to a zip for AWS Lambda and
+        removed.
+    download : bool
+        If False, nothing is delivered, e.g. because the artifact is only
+        published as a Lambda layer.
+
+    Returns
+    -------
+    str
+        Path of the delivered file, output_dir, or None if nothing was
+        delivered.
+    """
+    if not download:
+        return None
+    if output_dir is None:
+        download_artifact(resource, bucket, key, local_path, config,
+                          progress)
+        if to_zip and file_format(local_path) != 'zip':
+            path = convert_to_zip(local_path)
+            os.remove(local_path)
+            return path
+        return local_path
+    config = config or transfer_config()
+    extract_artifact(resource.meta.client, bucket, key, output_dir,
+                     config.max_concurrency, config.multipart_chunksize,
+                     progress)
+    return output_dir
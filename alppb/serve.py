@@ -0,0 +1,237 @@
+"""
+A long-running build service. Requests arrive as JSON over HTTP, on a TCP
+port or a Unix socket, and identical requests that are in flight at the
+same time share one build.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import json
+import os
+import signal
+import socketserver
+import stat
+import threading
+
+
+class BuildService(object):
+    """
+    Runs builds on a bounded pool of workers. Requests for a key that is
+    already being built wait for that build instead of starting another one
+    (single-flight).
+    """
+
+    def __init__(self, build, max_workers=4):
+        """
+        Parameters
+        ----------
+        build : callable
+            Called with the package to build on a worker thread. Returns a
+            JSON serializable dict describing the result.
+        max_workers : int
+            The maximum number of builds to run at the same time. Further
+            requests wait in a queue.
+        """
+        self.build = build
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    @property
+    def in_flight(self):
+        """ Number of distinct builds queued or running. """
+        with self._lock:
+            return len(self._in_flight)
+
+    def submit(self, key, package):
+        """
+        Starts a build, or joins the one already in flight for key.
+
+        Parameters
+        ----------
+        key : str
+            Identifies what is built, e.g. the artifact cache key. Requests
+            with the same key share a build.
+        package : str
+            Name of the PyPi package to build.
+
+        Returns
+        -------
+        tuple
+            The concurrent.futures.Future of the build and True if it was
+            already in flight.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, True
+            future = self.executor.submit(self.build, package)
+            self._in_flight[key] = future
+
+        def forget(_):
+            """ Later requests start a new build, e.g. after a failure. """
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+
+        future.add_done_callback(forget)
+        return future, False
+
+    def request(self, key, package):
+        """
+        Builds a package, sharing the build with identical requests, and
+        waits for it.
+
+        Parameters
+        ----------
+        key : str
+            Identifies what is built. See BuildService.submit().
+        package : str
+            Name of the PyPi package to build.
+
+        Returns
+        -------
+        dict
+            The result of the build, plus "shared" saying whether it was
+            joined instead of started.
+        """
+        future, shared = self.submit(key, package)
+        try:
+            result = dict(future.result())
+        except Exception as err:  # pylint: disable=broad-except
+            result = {'package': package, 'status': 'FAILED',
+                      'error': str(err)}
+        result['shared'] = shared
+        return result
+
+    def shutdown(self):
+        """ Waits for running builds and stops the workers. """
+        self.executor.shutdown(wait=True)
+
+
+def make_handler(service, resolve):
+    """
+    Creates the HTTP request handler of the service.
+
+    POST /build with {"package": "lxml"} builds a package and answers with
+    the result once it is done. GET /health answers with the number of
+    builds in flight.
+
+    Parameters
+    ----------
+    service : serve.BuildService
+        The service to send builds to.
+    resolve : callable
+        Called with the decoded request body. Returns the key and package
+        for BuildService.request(), or raises ValueError for a bad request.
+
+    Returns
+    -------
+    class
+        A subclass of http.server.BaseHTTPRequestHandler.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """ Serves the JSON API of the build service. """
+
+        def address_string(self):
+            # Unix sockets have no client address.
+            return self.client_address[0] if self.client_address else "-"
+
+        def respond(self, code, body):
+            """ Sends a JSON response. """
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """ Answers health checks. """
+            if self.path != "/health":
+                self.respond(404, {'error': "Not found"})
+                return
+            self.respond(200, {'ok': True, 'in_flight': service.in_flight})
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """ Builds the requested package. """
+            if self.path != "/build":
+                self.respond(404, {'error': "Not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                key, package = resolve(json.loads(
+                    self.rfile.read(length).decode("utf-8") or "{}"))
+            except ValueError as err:
+                self.respond(400, {'error': str(err)})
+                return
+            result = service.request(key, package)
+            self.respond(200 if result.get('status') == 'SUCCEEDED' else 500,
+                         result)
+
+    return Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ An HTTP server on a TCP port, one thread per request. """
+    # http.server only has one from Python 3.7.
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """ An HTTP server on a Unix socket, one thread per request. """
+    daemon_threads = True
+
+
+def stop_on_sigterm():
+    """
+    Makes SIGTERM, which service managers stop services with, interrupt the
+    main thread like Ctrl+C does, so the same cleanup runs.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    callable
+        The previous SIGTERM handler.
+    """
+    def interrupt(signum, frame):
+        """ Raises KeyboardInterrupt in the main thread. """
+        # pylint: disable=unused-argument
+        raise KeyboardInterrupt
+
+    return signal.signal(signal.SIGTERM, interrupt)
+
+
+def create_server(handler, host="127.0.0.1", port=8080, socket_path=None):
+    """
+    Creates the server the service listens on.
+
+    Parameters
+    ----------
+    handler : class
+        The request handler. See make_handler().
+    host : str
+        Address to listen on when socket_path is None.
+    port : int
+        Port to listen on when socket_path is None.
+    socket_path : str
+        Path of a Unix socket to listen on instead of a TCP port. A stale
+        socket left at the path is replaced, any other file is kept.
+
+    Returns
+    -------
+    socketserver.BaseServer
+        The server. Call serve_forever() on it.
+    """
+    if socket_path is None:
+        return ThreadingHTTPServer((host, port), handler)
+    try:
+        if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+    except FileNotFoundError:
+        pass
+    return UnixHTTPServer(socket_path, handler)
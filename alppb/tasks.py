@@ -0,0 +1,116 @@
+"""
+A small dependency-aware task runner for the setup and cleanup steps of
+alppb. Independent steps, e.g. creating clients and the IAM Role, run at the
+same time on a thread pool.
+"""
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import time
+from . import timing
+
+
+def run_tasks(name, tasks, results, max_workers=8, keep_going=False):
+    """
+    Runs tasks as soon as the tasks they depend on have finished.
+
+    Parameters
+    ----------
+    name : str
+        Name of the phase, used when printing how long it took.
+    tasks : dict
+        Maps each task name to a tuple of (function, dependencies). The
+        function is called with the results dict and its return value is
+        stored in it under the task name. Dependencies is a list of task
+        names that must finish first.
+    results : dict
+        Results of the finished tasks. Filled in as tasks finish, so callers
+        can see which tasks completed even if another task failed.
+    max_workers : int
+        The maximum number of tasks to run at the same time.
+    keep_going : bool
+        If True a failed task only skips the tasks that depend on it and
+        errors are printed instead of raised. Use this for cleanup.
+
+    Returns
+    -------
+    dict
+        Maps each task that ran to the number of seconds it took.
+    """
+    for task, (_, dependencies) in tasks.items():
+        unknown = [dep for dep in dependencies if dep not in tasks]
+        if unknown:
+            raise ValueError("Task {} depends on unknown task(s) {}".format(
+                task, ", ".join(unknown)))
+
+    # pylint: disable=broad-except
+    waiting = dict(tasks)
+    running = {}
+    failed = {}
+    timings = {}
+    start = time.monotonic()
+
+    def timed(task, function):
+        """ Runs a task and records how long it took. """
+        task_start = time.monotonic()
+        try:
+            with timing.span(task, category="task"):
+                return function(results)
+        finally:
+            timings[task] = time.monotonic() - task_start
+
+    # API calls made by the tasks are counted against this phase.
+    with timing.phase(name):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running:
+                for task, (function, dependencies) in list(waiting.items()):
+                    if any(dep in failed for dep in dependencies):
+                        del waiting[task]
+                        failed[task] = None
+                    elif all(dep in results for dep in dependencies) and \
+                            not (failed and not keep_going):
+                        del waiting[task]
+                        running[executor.submit(timed, task, function)] = task
+
+                if not running:
+                    # Everything left depends on a failed task.
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        results[task] = future.result()
+                    except BaseException as err:
+                        failed[task] = err
+                        if keep_going:
+                            print("ERROR: {} failed: {}".format(task, err))
+
+    print_timings(name, time.monotonic() - start, timings)
+
+    errors = [err for err in failed.values() if err is not None]
+    if errors and not keep_going:
+        raise errors[0]
+    return timings
+
+
+def print_timings(name, wall, timings):
+    """
+    Prints how long a phase took compared to running its tasks one after
+    another.
+
+    Parameters
+    ----------
+    name : str
+        Name of the phase.
+    wall : float
+        Seconds the phase took.
+    timings : dict
+        Maps each task that ran to the number of seconds it took.
+
+    Returns
+    -------
+    """
+    sequential = sum(timings.values())
+    print(">>{} took {:.1f}s, {:.1f}s if run in sequence (saved {:.1f}s)"
+          .format(name, wall, sequential, max(0.0, sequential - wall)))
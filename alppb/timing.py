@@ -0,0 +1,315 @@
+"""
+Timing spans and AWS API call counts for `alppb --profile`. Spans are kept
+in memory and written in the Chrome trace format, which chrome://tracing
+and https://ui.perfetto.dev open directly. Nothing is recorded until
+enable() is called, so the spans cost a flag check otherwise.
+"""
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+ALPPB_PID = 1
+CODEBUILD_PID = 2
+
+_LOCK = threading.Lock()
+_ENABLED = False
+_EVENTS = []
+_API_CALLS = {}
+_PHASE = None
+_BUILDS = {}
+
+
+def enable():
+    """
+    Starts recording spans and API calls.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    """
+    global _ENABLED  # pylint: disable=global-statement
+    _ENABLED = True
+
+
+def enabled():
+    """ True if spans are being recorded. """
+    return _ENABLED
+
+
+def reset():
+    """
+    Stops recording and drops everything recorded so far.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    """
+    global _ENABLED, _PHASE  # pylint: disable=global-statement
+    with _LOCK:
+        _ENABLED = False
+        _PHASE = None
+        del _EVENTS[:]
+        _API_CALLS.clear()
+        _BUILDS.clear()
+
+
+def add_span(name, start, duration, category="alppb", pid=ALPPB_PID,
+             tid=None, **args):
+    """
+    Records a span that has already finished.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span, e.g. "codebuild.start_build".
+    start : float
+        When it started, in seconds since the epoch.
+    duration : float
+        How long it took in seconds.
+    category : str
+        Category of the span, used to filter traces.
+    pid : int
+        timing.ALPPB_PID for work done by alppb, timing.CODEBUILD_PID for
+        build phases.
+    tid : int
+        The row the span is drawn on. Defaults to the current thread.
+    args
+        Extra details shown with the span.
+
+    Returns
+    -------
+    """
+    if not _ENABLED:
+        return
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int(duration * 1e6),
+        'pid': pid,
+        'tid': threading.get_ident() if tid is None else tid,
+    }
+    if args:
+        event['args'] = args
+    with _LOCK:
+        _EVENTS.append(event)
+
+
+@contextmanager
+def span(name, category="alppb", **args):
+    """
+    Records how long the code in a with block takes.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span.
+    category : str
+        Category of the span.
+    args
+        Extra details shown with the span.
+
+    Returns
+    -------
+    """
+    if not _ENABLED:
+        yield
+        return
+    start = time.time()
+    clock = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.perf_counter() - clock, category,
+                 **args)
+
+
+@contextmanager
+def phase(name):
+    """
+    Records a span for a phase of a run, e.g. "Setup", and counts the AWS
+    API calls made by any thread while it runs against it.
+
+    Parameters
+    ----------
+    name : str
+        Name of the phase.
+
+    Returns
+    -------
+    """
+    global _PHASE  # pylint: disable=global-statement
+    previous = _PHASE
+    _PHASE = name
+    try:
+        with span(name, category="phase"):
+            yield
+    finally:
+        _PHASE = previous
+
+
+def traced(function):
+    """
+    Decorates a function so each call is recorded as a span named after its
+    module and name, e.g. "iam.create_role".
+    """
+    name = "{}.{}".format(function.__module__.rsplit(".", 1)[-1],
+                          function.__qualname__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _ENABLED:
+            return function(*args, **kwargs)
+        with span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def count_api_call(event_name=None, **kwargs):
+    """
+    Counts an AWS API call against the current phase. Registered for the
+    botocore "before-parameter-build" event of every client, which fires
+    once per call before any retries, see clients.get_client().
+
+    Parameters
+    ----------
+    event_name : str
+        The botocore event, e.g.
+        "before-parameter-build.codebuild.StartBuild".
+    kwargs
+        The rest of the event, unused.
+
+    Returns
+    -------
+    """
+    # pylint: disable=unused-argument
+    if not _ENABLED or not event_name:
+        return
+    operation = ".".join(event_name.split(".")[1:3])
+    with _LOCK:
+        calls = _API_CALLS.setdefault(_PHASE or "Other", {})
+        calls[operation] = calls.get(operation, 0) + 1
+
+
+def api_calls():
+    """
+    Gets the AWS API calls counted so far.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    dict
+        Maps each phase to a dict of "service.Operation" to call counts.
+    """
+    with _LOCK:
+        return {name: dict(calls) for name, calls in _API_CALLS.items()}
+
+
+def add_build(build, label=None):
+    """
+    Records the phases of a finished CodeBuild build, e.g. QUEUED,
+    PROVISIONING and BUILD, as spans on a row of their own.
+
+    Parameters
+    ----------
+    build : dict
+        The build as returned by batch_get_builds.
+    label : str
+        What was built, shown on the row. Defaults to the build ID.
+
+    Returns
+    -------
+    """
+    if not _ENABLED:
+        return
+    build_id = build.get('id')
+    with _LOCK:
+        tid = len(_BUILDS) + 1
+        _BUILDS[tid] = label or build_id
+    for build_phase in build.get('phases', []):
+        start = build_phase.get('startTime')
+        end = build_phase.get('endTime')
+        if start is None or end is None:
+            continue
+        add_span(build_phase.get('phaseType', "UNKNOWN"), start.timestamp(),
+                 (end - start).total_seconds(), category="codebuild",
+                 pid=CODEBUILD_PID, tid=tid, build=build_id,
+                 status=build_phase.get('phaseStatus'))
+
+
+def trace():
+    """
+    Gets everything recorded so far in the Chrome trace format.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    dict
+        The trace, with the API call counts under "otherData".
+    """
+    with _LOCK:
+        events = list(_EVENTS)
+        # Metadata events name the rows of the CodeBuild builds.
+        events += [{'name': "thread_name", 'ph': 'M', 'pid': CODEBUILD_PID,
+                    'tid': tid, 'args': {'name': label}}
+                   for tid, label in _BUILDS.items()]
+    events += [
+        {'name': "process_name", 'ph': 'M', 'pid': ALPPB_PID,
+         'args': {'name': "alppb"}},
+        {'name': "process_name", 'ph': 'M', 'pid': CODEBUILD_PID,
+         'args': {'name': "CodeBuild"}},
+    ]
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'apiCalls': api_calls()},
+    }
+
+
+def write(path):
+    """
+    Writes the trace to a file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON file to write.
+
+    Returns
+    -------
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as trace_file:
+        json.dump(trace(), trace_file)
+
+
+def print_api_calls():
+    """
+    Prints how many AWS API calls each phase made.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    """
+    for name, calls in api_calls().items():
+        print(">>{}: {} AWS API call(s) ({})".format(
+            name, sum(calls.values()),
+            ", ".join("{} {}".format(operation, count)
+                      for operation, count in sorted(calls.items()))))
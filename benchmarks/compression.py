@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Compares the transfer formats and compression levels of artifacts. Each
+installed package is packed with the same command the Buildspec would run,
+then the artifact size, the time to pack it, the time to download it at a
+given bandwidth and the time to extract it (or convert it to a zip) locally
+are printed.
+
+Packages are taken from the current environment so no network is needed.
+
+Usage: python benchmarks/compression.py [bandwidth MB/s] [package ...]
+"""
+import contextlib
+import importlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from alppb.codebuild import archive_command  # noqa: E402
+from alppb.s3 import MB  # noqa: E402
+from alppb.s3 import convert_to_zip  # noqa: E402
+from alppb.s3 import extract_local  # noqa: E402
+
+PACKAGES = ["botocore", "yaml", "pip"]
+
+FORMATS = [
+    ("zip", 0),
+    ("zip", 1),
+    ("zip", None),
+    ("zip", 9),
+    ("tar.gz", 1),
+    ("tar.xz", 0),
+    ("tar.xz", None),
+]
+
+
+def stage(package, work_dir):
+    """
+    Copies an installed package into an alppb/ directory, like the one
+    pip install -t creates in CodeBuild.
+
+    Parameters
+    ----------
+    package : str
+        Name of an importable package.
+    work_dir : str
+        Directory to create alppb/ in.
+
+    Returns
+    -------
+    int
+        Size of the staged files in bytes.
+    """
+    module = importlib.import_module(package)
+    source = os.path.dirname(module.__file__)
+    target = os.path.join(work_dir, "alppb", os.path.basename(source))
+    shutil.copytree(source, target,
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(target) for name in names)
+
+
+def measure(work_dir, archive_format, level, bandwidth):
+    """
+    Packs alppb/ in one format and level and times each step.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory containing alppb/.
+    archive_format : str
+        One of codebuild.ARCHIVE_FORMATS.
+    level : int
+        Compression level, or None for the default.
+    bandwidth : float
+        Download bandwidth in MB/s.
+
+    Returns
+    -------
+    tuple
+        Size in bytes, and seconds to pack, download and extract it, and to
+        convert it to a zip (0 for zips).
+    """
+    artifact = "artifact.{}".format(archive_format)
+    path = os.path.join(work_dir, artifact)
+    start = time.perf_counter()
+    subprocess.run(archive_command(artifact, archive_format, level),
+                   shell=True, check=True, cwd=os.path.join(work_dir, "alppb"),
+                   stdout=subprocess.DEVNULL)
+    pack = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    target = os.path.join(work_dir, "extracted")
+    start = time.perf_counter()
+    extract_local(path, target)
+    extract = time.perf_counter() - start
+    shutil.rmtree(target)
+
+    convert = 0.0
+    if archive_format != "zip":
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            os.remove(convert_to_zip(path))
+        convert = time.perf_counter() - start
+    os.remove(path)
+    return size, pack, size / MB / bandwidth, extract, convert
+
+
+def main():
+    """ Prints one table per package """
+    bandwidth = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    packages = sys.argv[2:] or PACKAGES
+    header = "{:<12}{:>8}{:>10}{:>9}{:>11}{:>10}{:>10}{:>10}".format(
+        "format", "level", "MB", "pack s", "download s", "extract s",
+        "to zip s", "total s")
+    for package in packages:
+        work_dir = tempfile.mkdtemp()
+        try:
+            size = stage(package, work_dir)
+            print("\n{} ({:.1f} MB installed, {:.0f} MB/s download)".format(
+                package, size / MB, bandwidth))
+            print(header)
+            for archive_format, level in FORMATS:
+                size, pack, download, extract, convert = measure(
+                    work_dir, archive_format, level, bandwidth)
+                print("{:<12}{:>8}{:>10.2f}{:>9.2f}{:>11.2f}{:>10.2f}"
+                      "{:>10.2f}{:>10.2f}".format(
+                          archive_format,
+                          "default" if level is None else level,
+                          size / MB, pack, download, extract, convert,
+                          pack + download + extract))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
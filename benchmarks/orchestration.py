@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+"""
+Measures the overhead of alppb's own orchestration without touching AWS.
+Each scenario runs the `alppb` build command end to end against an
+in-memory stand-in for IAM, CodeBuild and S3. The stand-in answers every
+botocore call from its `before-call` event, so parameter validation,
+modeled exceptions and the --profile API call counters are the real ones.
+Builds go through simulated phases on a virtual clock, so polling and
+backoff waits take no real time.
+
+For each scenario the script prints:
+- wall time
+- simulated build time
+- AWS API calls
+- polls
+- seconds slept
+
+It exits with 1 when a number goes above its entry in THRESHOLDS.
+
+Usage: python benchmarks/orchestration.py [scenario ...]
+"""
+import contextlib
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import io
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
+from urllib.parse import quote
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from botocore.awsrequest import AWSResponse  # noqa: E402
+from botocore.response import StreamingBody  # noqa: E402
+from alppb import alppb as app  # noqa: E402
+from alppb import clients  # noqa: E402
+from alppb import codebuild  # noqa: E402
+from alppb import timing  # noqa: E402
+from alppb.cli import parse_args  # noqa: E402
+
+REGION = "us-east-1"
+BUCKET = "alppb-benchmark"
+ROLE = {
+    'Path': "/",
+    'RoleName': "alppbBuilderRole",
+    'RoleId': "AROABENCHMARK",
+    'Arn': "arn:aws:iam::123456789012:role/alppbBuilderRole",
+    'CreateDate': datetime(2019, 1, 1, tzinfo=timezone.utc),
+}
+# Simulated seconds of each CodeBuild phase. BUILD takes the seconds of the
+# packages being built.
+PHASES = [
+    ("SUBMITTED", 0),
+    ("QUEUED", 3),
+    ("PROVISIONING", 25),
+    ("DOWNLOAD_SOURCE", 2),
+    ("INSTALL", 1),
+    ("PRE_BUILD", 1),
+    ("BUILD", None),
+    ("POST_BUILD", 1),
+    ("UPLOAD_ARTIFACTS", 2),
+    ("FINALIZING", 2),
+]
+BUILD_SECONDS = 20
+# How many CreateProject calls fail while the new IAM Role propagates.
+ROLE_PROPAGATION_FAILURES = 1
+
+MANY = ["package{:02d}".format(index) for index in range(20)]
+
+# Name, packages, extra options, packages to build before measuring (to
+# fill the cache) and the expected exit code.
+SCENARIOS = [
+    ("single", ["requests"], [], [], 0),
+    ("many", MANY, ["--concurrency", "4"], [], 0),
+    ("batched", MANY, ["--concurrency", "4", "--batch-size", "5"], [], 0),
+    ("cache-hit", ["requests", "six"], [], ["requests", "six"], 0),
+    ("failure", ["requests", "broken"], [], [], 1),
+    ("matrix", ["requests"], ["--python", "3.6,3.7"], [], 0),
+    ("warm", ["requests"], ["--warm", "--no-cache"], ["six"], 0),
+]
+
+# Upper bounds per scenario. Wall time is generous since it depends on the
+# machine. The counts and simulated sleeps are deterministic, so they get
+# about 15% room over the current code.
+THRESHOLDS = {
+    "single": {"wall": 2.0, "api_calls": 29, "polls": 13, "slept": 68},
+    "many": {"wall": 4.0, "api_calls": 210, "polls": 63, "slept": 332},
+    "batched": {"wall": 3.0, "api_calls": 146, "polls": 17, "slept": 170},
+    # Cache hits need neither the role nor the project.
+    "cache-hit": {"wall": 1.0, "api_calls": 0, "polls": 0, "slept": 0},
+    "failure": {"wall": 2.0, "api_calls": 31, "polls": 13, "slept": 68},
+    # Both versions build at the same time, so the run takes as long as a
+    # single build while each version sleeps through its own.
+    "matrix": {"wall": 2.0, "api_calls": 48, "polls": 25, "slept": 134,
+               "simulated": 68},
+    # Warm runs find the role, project and bucket in the metadata cache.
+    "warm": {"wall": 2.0, "api_calls": 16, "polls": 12, "slept": 68},
+}
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when something sleeps. Each thread that starts
+    builds gets a timeline of its own, starting where the shared one is, so
+    threads building at the same time don't age each other's builds and the
+    numbers don't depend on how they interleave. Other threads, e.g. setup
+    steps, share one timeline.
+    """
+
+    def __init__(self):
+        self.shared = 0.0
+        self.slept = 0.0
+        self.timelines = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def fork(self):
+        """ Gives the calling thread its own timeline, if it has none. """
+        with self.lock:
+            if getattr(self.local, 'timeline', None) is None:
+                self.local.timeline = [self.shared]
+                self.timelines.append(self.local.timeline)
+
+    def join(self):
+        """ Moves the shared timeline to the end of every forked one. """
+        with self.lock:
+            self.shared = self.end()
+            for timeline in self.timelines:
+                timeline[0] = self.shared
+            self.timelines = []
+
+    def sleep(self, seconds):
+        """ Advances the calling thread's timeline instead of waiting. """
+        with self.lock:
+            timeline = getattr(self.local, 'timeline', None)
+            if timeline is None:
+                self.shared += seconds
+            else:
+                timeline[0] += seconds
+            self.slept += seconds
+
+    def monotonic(self):
+        """ The current virtual time of the calling thread in seconds. """
+        with self.lock:
+            timeline = getattr(self.local, 'timeline', None)
+            return self.shared if timeline is None else timeline[0]
+
+    def end(self):
+        """ The latest time of any timeline. """
+        return max([self.shared] + [timeline[0]
+                                    for timeline in self.timelines])
+
+
+class ThreadRandom(object):
+    """ A seeded random.Random for every thread, so jitter is repeatable. """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.local = threading.local()
+
+    def uniform(self, low, high):
+        """ random.uniform() from the calling thread's generator. """
+        if getattr(self.local, 'random', None) is None:
+            self.local.random = random.Random(self.seed)
+        return self.local.random.uniform(low, high)
+
+
+class FakeAWS(object):
+    """
+    Answers IAM, CodeBuild and S3 calls from memory. Objects are kept in a
+    dict and each build finishes once the virtual clock has passed all of
+    its phases. Packages named in `failing` fail their build.
+    """
+
+    def __init__(self, clock, failing=("broken",)):
+        self.clock = clock
+        self.failing = failing
+        self.epoch = datetime(2019, 1, 1, tzinfo=timezone.utc)
+        self.objects = {}
+        self.builds = {}
+        self.role_failures = ROLE_PROPAGATION_FAILURES
+        self.policy = None
+        self.project = None
+        self.lock = threading.Lock()
+        self.handlers = {
+            ('iam', 'CreateRole'): lambda params: {'Role': ROLE},
+            ('iam', 'GetRole'): self.get_role,
+            ('iam', 'GetRolePolicy'): self.get_role_policy,
+            ('iam', 'PutRolePolicy'): self.put_role_policy,
+            ('iam', 'DeleteRolePolicy'): self.delete_role_policy,
+            ('iam', 'DeleteRole'): lambda params: {},
+            ('codebuild', 'CreateProject'): self.create_project,
+            ('codebuild', 'BatchGetProjects'): lambda params: {
+                'projects': [self.project] if self.project else []},
+            ('codebuild', 'DeleteProject'): self.delete_project,
+            ('codebuild', 'StartBuild'): self.start_build,
+            ('codebuild', 'BatchGetBuilds'): self.batch_get_builds,
+            ('codebuild', 'ListBuildsForProject'): self.list_builds,
+            ('s3', 'GetBucketLocation'): lambda params: {
+                'LocationConstraint': None},
+            ('s3', 'HeadObject'): self.head_object,
+            ('s3', 'GetObject'): self.get_object,
+            ('s3', 'CopyObject'): self.copy_object,
+            ('s3', 'DeleteObject'): self.delete_object,
+        }
+
+    def install(self, events):
+        """
+        Registers the stand-in on a botocore event emitter. Clients created
+        afterwards use it instead of the network.
+        """
+        events.register('before-parameter-build.*.*', self.keep_params)
+        events.register_first('before-call.*.*', self.respond)
+
+    @staticmethod
+    def keep_params(params, context, **kwargs):
+        """ Keeps the call's parameters before they are serialized. """
+        # pylint: disable=unused-argument
+        context['benchmark_params'] = dict(params)
+
+    def respond(self, model, context, **kwargs):
+        """ Answers a call, or raises for calls the stand-in lacks. """
+        # pylint: disable=unused-argument
+        service = model.service_model.endpoint_prefix
+        handler = self.handlers.get((service, model.name))
+        if handler is None:
+            raise NotImplementedError("{}.{}".format(service, model.name))
+        status, body = 200, handler(context.get('benchmark_params', {}))
+        if 'Error' in body:
+            status = body.pop('Status', 400)
+        body['ResponseMetadata'] = {'HTTPStatusCode': status,
+                                    'RequestId': "benchmark"}
+        return AWSResponse(None, status, {}, None), body
+
+    def get_role(self, params):
+        """ Knows the role once it has a policy. """
+        # pylint: disable=unused-argument
+        if self.policy is None:
+            return {'Status': 404, 'Error': {
+                'Code': "NoSuchEntity", 'Message': "Role not found"}}
+        return {'Role': ROLE}
+
+    def get_role_policy(self, params):
+        """ Returns the policy put on the role. """
+        # pylint: disable=unused-argument
+        if self.policy is None:
+            return {'Status': 404, 'Error': {
+                'Code': "NoSuchEntity", 'Message': "Policy not found"}}
+        return {'RoleName': ROLE['RoleName'],
+                'PolicyName': "alppbBuilderPolicy",
+                # IAM returns the document URL encoded.
+                'PolicyDocument': quote(self.policy)}
+
+    def put_role_policy(self, params):
+        """ Keeps the policy document. """
+        self.policy = params['PolicyDocument']
+        return {}
+
+    def delete_role_policy(self, params):
+        """ Drops the policy document. """
+        # pylint: disable=unused-argument
+        self.policy = None
+        return {}
+
+    def create_project(self, params):
+        """ Fails while the IAM Role propagates, like CodeBuild does. """
+        with self.lock:
+            if self.role_failures > 0:
+                self.role_failures -= 1
+                return {'Error': {
+                    'Code': "InvalidInputException",
+                    'Message': "CodeBuild is not authorized to perform: "
+                               "sts:AssumeRole"}}
+            self.project = dict(params)
+        return {'project': {'name': params['name']}}
+
+    def delete_project(self, params):
+        """ Forgets the project. """
+        # pylint: disable=unused-argument
+        self.project = None
+        return {}
+
+    def start_build(self, params):
+        """ Starts a build of the packages in its Buildspec. """
+        buildspec = params['buildspecOverride']
+        artifacts_to = params['artifactsOverride']
+        packages = re.findall(r"install (\S+) -t alppb", buildspec)
+        artifacts = re.findall(r"\.\./(alppb-\S+)", buildspec)
+        # The thread that starts a build also polls it.
+        self.clock.fork()
+        with self.lock:
+            build_id = "alppbBuilder:{:04d}".format(len(self.builds))
+            self.builds[build_id] = {
+                'start': self.clock.monotonic(),
+                'built': [(package, artifact) for package, artifact in
+                          zip(packages, artifacts)
+                          if package not in self.failing],
+                'failed': len(packages) == 1 and packages[0] in self.failing,
+                'seconds': BUILD_SECONDS * len(packages),
+                'computeType': params.get('computeTypeOverride',
+                                          "BUILD_GENERAL1_SMALL"),
+                'location': artifacts_to['location'],
+                # Like namespaceType BUILD_ID, see artifacts_override().
+                'prefix': "{}/{}/".format(build_id.split(":")[-1],
+                                          artifacts_to['name']),
+                'uploaded': False,
+            }
+        return {'build': {'id': build_id, 'buildStatus': "IN_PROGRESS"}}
+
+    def describe(self, build_id):
+        """ Reports a build as batch_get_builds would at the current time. """
+        build = self.builds[build_id]
+        elapsed = self.clock.monotonic() - build['start']
+        phases = []
+        offset = 0.0
+        current = None
+        for phase_type, seconds in PHASES:
+            seconds = build['seconds'] if seconds is None else seconds
+            start = self.epoch + timedelta(seconds=build['start'] + offset)
+            phase = {'phaseType': phase_type, 'startTime': start}
+            phases.append(phase)
+            current = phase_type
+            if elapsed < offset + seconds:
+                break
+            offset += seconds
+            phase.update(endTime=start + timedelta(seconds=seconds),
+                         durationInSeconds=seconds, phaseStatus="SUCCEEDED")
+        else:
+            current = "COMPLETED"
+        status = "IN_PROGRESS"
+        if current == "COMPLETED":
+            status = "FAILED" if build['failed'] else "SUCCEEDED"
+            if not build['failed'] and not build['uploaded']:
+                build['uploaded'] = True
+                for package, artifact in build['built']:
+                    self.objects[(build['location'],
+                                  build['prefix'] + artifact)] = \
+                        artifact_bytes(package)
+        return {'id': build_id, 'buildStatus': status,
+                'currentPhase': current, 'phases': phases,
+                'environment': {'computeType': build['computeType']},
+                'artifacts': {'location': "arn:aws:s3:::{}/{}".format(
+                    build['location'], build['prefix'].rstrip("/"))}}
+
+    def list_builds(self, params):
+        """ Lists every build, newest first. """
+        # pylint: disable=unused-argument
+        # Only cleanup lists builds, once every thread waited for its own,
+        # so their timelines have all ended.
+        self.clock.join()
+        with self.lock:
+            return {'ids': sorted(self.builds, reverse=True)}
+
+    def batch_get_builds(self, params):
+        """ Reports every requested build. """
+        with self.lock:
+            return {'builds': [self.describe(build_id)
+                               for build_id in params['ids']]}
+
+    def head_object(self, params):
+        """ Reports the size of an object, or 404. """
+        data = self.objects.get((params['Bucket'], params['Key']))
+        if data is None:
+            return {'Error': {'Code': "404", 'Message': "Not Found"},
+                    'Status': 404}
+        return {'ContentLength': len(data), 'ETag': '"benchmark"'}
+
+    def get_object(self, params):
+        """ Streams an object, or the requested byte range of it. """
+        data = self.objects.get((params['Bucket'], params['Key']))
+        if data is None:
+            return {'Error': {'Code': "NoSuchKey", 'Message': "Not Found"},
+                    'Status': 404}
+        match = re.match(r"bytes=(\d+)-(\d*)", params.get('Range', ""))
+        if match:
+            end = int(match.group(2)) + 1 if match.group(2) else len(data)
+            data = data[int(match.group(1)):end]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)),
+                'ContentLength': len(data), 'ETag': '"benchmark"'}
+
+    def copy_object(self, params):
+        """ Copies an object within the stand-in. """
+        source = params['CopySource']
+        if isinstance(source, str):
+            bucket, key = source.split("/", 1)
+        else:
+            bucket, key = source['Bucket'], source['Key']
+        self.objects[(params['Bucket'], params['Key'])] = \
+            self.objects[(bucket, key)]
+        return {'CopyObjectResult': {'ETag': '"benchmark"'}}
+
+    def delete_object(self, params):
+        """ Deletes an object, if it exists. """
+        self.objects.pop((params['Bucket'], params['Key']), None)
+        return {}
+
+
+def artifact_bytes(package):
+    """ A small zip standing in for a built package. """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("{}/__init__.py".format(package), "VERSION = 1\n")
+    return buffer.getvalue()
+
+
+def run_alppb(argv, work_dir):
+    """
+    Runs the alppb build command in work_dir with its output hidden.
+
+    Parameters
+    ----------
+    argv : list
+        Command line arguments.
+    work_dir : str
+        Directory artifacts are downloaded to.
+
+    Returns
+    -------
+    int
+        The exit code.
+    """
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.build(parse_args(argv))
+    except SystemExit as exit_:
+        return exit_.code or 0
+    finally:
+        os.chdir(cwd)
+    return 0
+
+
+def run_scenario(packages, options, warmup):
+    """
+    Runs one scenario against a fresh stand-in.
+
+    Parameters
+    ----------
+    packages : list
+        Packages of the measured run.
+    options : list
+        Extra command line options of the measured run.
+    warmup : list
+        Packages built first, unmeasured, to fill the cache.
+
+    Returns
+    -------
+    dict
+        The exit code, the wall and simulated seconds, the API calls, polls
+        and seconds slept of the measured run.
+    """
+    work_dir = tempfile.mkdtemp()
+    clock = VirtualClock()
+    fake = FakeAWS(clock)
+    common = ["--region", REGION,
+              "--cache-dir", os.path.join(work_dir, "cache"),
+              "--history-file", os.path.join(work_dir, "history.json"),
+              "--metadata-file", os.path.join(work_dir, "metadata.json")]
+    virtual_time = types.SimpleNamespace(sleep=clock.sleep,
+                                         monotonic=clock.monotonic)
+    try:
+        # The poller's jitter decides the poll count, so fix its seeds.
+        with mock.patch.object(codebuild, "time", virtual_time), \
+                mock.patch.object(codebuild, "random", ThreadRandom(0)):
+            clients.reset()
+            fake.install(clients.get_session().events)
+            if warmup:
+                run_alppb(warmup + [BUCKET] + options + common, work_dir)
+            clock.join()
+            timing.reset()
+            timing.enable()
+            clock.slept = 0.0
+            start_clock = clock.monotonic()
+            start = time.perf_counter()
+            code = run_alppb(packages + [BUCKET] + options + common,
+                             work_dir)
+            wall = time.perf_counter() - start
+            calls = timing.api_calls()
+    finally:
+        timing.reset()
+        clients.reset()
+        shutil.rmtree(work_dir)
+    return {
+        'code': code,
+        'wall': wall,
+        'simulated': clock.end() - start_clock,
+        'api_calls': sum(sum(ops.values()) for ops in calls.values()),
+        'polls': sum(ops.get("codebuild.BatchGetBuilds", 0)
+                     for ops in calls.values()),
+        'slept': clock.slept,
+        'calls': calls,
+    }
+
+
+def main():
+    """ Runs the scenarios, prints a table and checks the thresholds. """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    selected = sys.argv[1:]
+    print("{:<12}{:>6}{:>10}{:>13}{:>11}{:>7}{:>9}".format(
+        "scenario", "exit", "wall s", "simulated s", "API calls", "polls",
+        "slept s"))
+    failures = []
+    for name, packages, options, warmup, expected_code in SCENARIOS:
+        if selected and name not in selected:
+            continue
+        result = run_scenario(packages, options, warmup)
+        print("{:<12}{:>6}{:>10.3f}{:>13.0f}{:>11}{:>7}{:>9.0f}".format(
+            name, result['code'], result['wall'], result['simulated'],
+            result['api_calls'], result['polls'], result['slept']))
+        for phase, operations in sorted(result['calls'].items()):
+            print("    {}: {}".format(phase, ", ".join(
+                "{} {}".format(operation, count)
+                for operation, count in sorted(operations.items()))))
+        if result['code'] != expected_code:
+            failures.append("{} exited with {}, expected {}".format(
+                name, result['code'], expected_code))
+        for metric, limit in sorted(THRESHOLDS.get(name, {}).items()):
+            if result[metric] > limit:
+                failures.append("{} {} is {:.3f}, above {}".format(
+                    name, metric, result[metric], limit))
+
+    for failure in failures:
+        print("REGRESSION: {}".format(failure))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Measures how long `alppb --version` and `alppb --help` take to start, which
+should be tens of milliseconds because boto3 is only imported for commands
+that talk to AWS. Also times a bare interpreter as a baseline.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    ("python (baseline)", [sys.executable, "-c", "pass"]),
+    ("alppb --version", [sys.executable, "-m", "alppb", "--version"]),
+    ("alppb --help", [sys.executable, "-m", "alppb", "--help"]),
+    ("import boto3 (for comparison)",
+     [sys.executable, "-c", "import boto3"]),
+]
+
+
+def time_command(command, runs):
+    """
+    Runs a command several times.
+
+    Parameters
+    ----------
+    command : list
+        The command and its arguments.
+    runs : int
+        How many times to run it.
+
+    Returns
+    -------
+    list
+        Wall time of each run in milliseconds.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    """ Prints the median and best time of each command """
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("{:<32}{:>12}{:>12}".format("command", "median ms", "best ms"))
+    for name, command in COMMANDS:
+        timings = time_command(command, runs)
+        print("{:<32}{:>12.1f}{:>12.1f}".format(
+            name, statistics.median(timings), min(timings)))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,8 @@ AUTHOR = "Josh Campbell"
 REQUIRES_PYTHON = ">=3.6.0"
 # What packages are required for this module to be executed?
 REQUIRED = [
-    "boto3", "pyyaml",
+    # Retry modes need botocore 1.15, which boto3 1.12 requires.
+    "boto3>=1.12.0", "botocore>=1.15.0", "pyyaml",
 ]
 # What packages are optional?
 EXTRAS = {}
@@ -127,7 +128,7 @@ setup(
     # py_modules=['mypackage'],
 
     entry_points={
-        'console_scripts': ['alppb=alppb.alppb:main'],
+        'console_scripts': ['alppb=alppb.cli:main'],
     },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
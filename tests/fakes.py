@@ -0,0 +1,45 @@
+"""
+Stand-ins for AWS clients shared by the tests.
+"""
+
+
+class FakeCodeBuild(object):
+    """ Finishes every build on its second batch_get_builds call. """
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.polls = {}
+        self.batch_calls = 0
+        self.started = []
+        self.compute_types = {}
+        self.images = {}
+        self.locations = {}
+
+    def start_build(self, projectName, buildspecOverride, **kwargs):
+        package = buildspecOverride.split(" install ")[1].split(" ")[0]
+        self.started.append(package)
+        self.compute_types[package] = kwargs.get("computeTypeOverride")
+        self.images[package] = kwargs.get("imageOverride")
+        self.locations[package] = kwargs.get(
+            "artifactsOverride", {}).get("location")
+        return {"build": {"id": "alppbBuilder:{}".format(package)}}
+
+    def batch_get_builds(self, ids):
+        self.batch_calls += 1
+        builds = []
+        for build_id in ids:
+            package = build_id.split(":")[1]
+            self.polls[build_id] = self.polls.get(build_id, 0) + 1
+            if self.polls[build_id] < 2:
+                status = "IN_PROGRESS"
+            elif package in self.failing:
+                status = "FAILED"
+            else:
+                status = "SUCCEEDED"
+            # Artifacts go under the build's ID, see artifacts_override().
+            location = "arn:aws:s3:::{}/{}/alppbBuilder".format(
+                self.locations[package], package)
+            builds.append({"id": build_id, "buildStatus": status,
+                           "currentPhase": "BUILD",
+                           "artifacts": {"location": location}})
+        return {"builds": builds}
@@ -0,0 +1,257 @@
+import os
+import tarfile
+from unittest.mock import MagicMock
+from alppb import local
+from alppb.alppb import LocalBackend
+from alppb.alppb import build_packages
+from alppb.alppb import fetch_artifact
+from alppb.alppb import plan_builds
+from alppb.alppb import restore_cached
+from tests.fakes import FakeCodeBuild
+
+
+"""
+alppb.alppb.build_packages()
+"""
+
+
+def test_build_packages_reports_each_package():
+    s3_resource = MagicMock()
+    s3_client = MagicMock()
+    results = build_packages(FakeCodeBuild(failing=("lxml",)), s3_resource,
+                             s3_client, "bucket", ["requests", "lxml"], "3.6",
+                             2, sleep=lambda delay: None)
+
+    assert results == {"requests": True, "lxml": False}
+    s3_resource.meta.client.download_file.assert_called_once_with(
+        "bucket", "requests/alppbBuilder/alppb-requests.zip",
+        "alppb-requests.zip", Config=None, Callback=None)
+    s3_client.delete_object.assert_called_once_with(
+        Bucket="bucket", Key="requests/alppbBuilder/alppb-requests.zip")
+
+
+def test_build_packages_skips_packages_with_the_same_artifact():
+    client = FakeCodeBuild()
+    results = build_packages(client, MagicMock(), MagicMock(), "bucket",
+                             ["lxml==4.2", "lxml>=4.2", "lxml==4.2"], "3.6",
+                             2, sleep=lambda delay: None)
+
+    assert results == {"lxml==4.2": True, "lxml>=4.2": False}
+    assert client.started == ["lxml==4.2"]
+
+
+def test_build_packages_polls_builds_together():
+    client = FakeCodeBuild()
+    build_packages(client, MagicMock(), MagicMock(), "bucket",
+                   ["a", "b", "c"], "3.6", 3, sleep=lambda delay: None)
+
+    assert client.batch_calls == 2
+
+
+def test_build_packages_uses_plans_and_reports_finished_builds():
+    client = FakeCodeBuild(failing=("b",))
+    finished = []
+    plans = {"a": {"compute_type": "BUILD_GENERAL1_LARGE",
+                   "expected_duration": 120}}
+    build_packages(client, MagicMock(), MagicMock(), "bucket", ["a", "b"],
+                   "3.6", 2, plans=plans,
+                   on_finished=lambda package, build: finished.append(
+                       (package, build["buildStatus"])),
+                   sleep=lambda delay: None)
+
+    assert client.compute_types == {"a": "BUILD_GENERAL1_LARGE", "b": None}
+    assert sorted(finished) == [("a", "SUCCEEDED"), ("b", "FAILED")]
+
+
+def test_build_packages_respects_concurrency():
+    client = FakeCodeBuild()
+    results = build_packages(client, MagicMock(), MagicMock(), "bucket",
+                             ["a", "b", "c"], "3.6", 1,
+                             sleep=lambda delay: None)
+
+    assert results == {"a": True, "b": True, "c": True}
+    assert client.batch_calls == 6
+
+
+def test_build_packages_in_batches():
+    client = FakeCodeBuild(failing=("c",))
+    s3_resource = MagicMock()
+    finished = []
+    results = build_packages(client, s3_resource, MagicMock(), "bucket",
+                             ["a", "b", "c"], "3.6", 2, batch_size=2,
+                             on_finished=lambda package, build:
+                             finished.append(package),
+                             sleep=lambda delay: None)
+
+    assert results == {"a": True, "b": True, "c": False}
+    assert sorted(client.compute_types) == ["a", "c"]
+    assert sorted(call[0][2] for call in
+                  s3_resource.meta.client.download_file.call_args_list) == \
+        ["alppb-a.zip", "alppb-b.zip"]
+    assert finished == ["c"]
+
+
+def test_build_packages_for_another_python_version():
+    client = FakeCodeBuild()
+    s3_resource = MagicMock()
+    results = build_packages(client, s3_resource, MagicMock(), "bucket",
+                             ["six"], "3.7", 1,
+                             buildspec_options={"artifact_suffix": "-py3.7"},
+                             image="irlrobot/alppb-python37",
+                             sleep=lambda delay: None)
+
+    assert results == {"six": True}
+    assert client.images == {"six": "irlrobot/alppb-python37"}
+    assert s3_resource.meta.client.download_file.call_args[0][1:] == \
+        ("six/alppbBuilder/alppb-six-py3.7.zip", "alppb-six-py3.7.zip")
+
+
+def test_build_packages_catches_download_errors():
+    s3_resource = MagicMock()
+    s3_resource.meta.client.download_file.side_effect = RuntimeError("boom")
+    results = build_packages(FakeCodeBuild(), s3_resource, MagicMock(),
+                             "bucket", ["requests"], "3.6", 1,
+                             sleep=lambda delay: None)
+
+    assert results == {"requests": False}
+
+
+class FakeLogs(object):
+    """ Every build logs a pip error straight away. """
+
+    def get_log_events(self, **kwargs):
+        return {"events": [{"message": "No matching distribution found for "
+                                       "nosuchpackage"}],
+                "nextForwardToken": kwargs.get("nextToken", "end")}
+
+
+class StoppableCodeBuild(FakeCodeBuild):
+    def __init__(self):
+        super(StoppableCodeBuild, self).__init__()
+        self.stopped = []
+
+    def stop_build(self, id):
+        self.stopped.append(id)
+
+    def batch_get_builds(self, ids):
+        response = super(StoppableCodeBuild, self).batch_get_builds(ids)
+        for build in response["builds"]:
+            build["logs"] = {"groupName": "group", "streamName": "stream"}
+            if build["id"] in self.stopped:
+                build["buildStatus"] = "STOPPED"
+        return response
+
+
+def test_build_packages_stops_builds_on_fatal_log_lines():
+    client = StoppableCodeBuild()
+    results = build_packages(client, MagicMock(), MagicMock(), "bucket",
+                             ["nosuchpackage"], "3.6", 1,
+                             logs_client=FakeLogs(),
+                             sleep=lambda delay: None)
+
+    assert results == {"nosuchpackage": False}
+    assert client.stopped == ["alppbBuilder:nosuchpackage"]
+
+
+"""
+alppb.alppb.fetch_artifact()
+"""
+
+
+def test_fetch_artifact_publishes_without_downloading():
+    s3_resource = MagicMock()
+    s3_client = MagicMock()
+    published = []
+    fetch_artifact(s3_resource, s3_client, "bucket", "1234/alppbBuilder",
+                   "lxml", "3.6",
+                   delivery={"download": False},
+                   publish=lambda *args: published.append(args))
+
+    assert published == [
+        ("lxml", "bucket", "1234/alppbBuilder/alppb-lxml.zip")]
+    s3_resource.meta.client.download_file.assert_not_called()
+    s3_client.delete_object.assert_called_once_with(
+        Bucket="bucket", Key="1234/alppbBuilder/alppb-lxml.zip")
+
+
+"""
+alppb.alppb.plan_builds()
+"""
+
+
+def test_plan_builds_auto_and_overrides():
+    history_data = {"3.6/numpy": [{
+        "computeType": "BUILD_GENERAL1_SMALL", "status": "SUCCEEDED",
+        "duration": 650, "phases": {"BUILD": 600}}]}
+    plans = plan_builds(["numpy", "six", "lxml"], "3.6", "auto",
+                        {"lxml": "BUILD_GENERAL1_MEDIUM"}, history_data)
+
+    assert plans["numpy"]["compute_type"] == "BUILD_GENERAL1_LARGE"
+    assert plans["numpy"]["expected_duration"] == 290
+    assert plans["six"] == {"compute_type": "BUILD_GENERAL1_SMALL",
+                            "expected_duration": None}
+    assert plans["lxml"]["compute_type"] == "BUILD_GENERAL1_MEDIUM"
+
+
+"""
+alppb.alppb.restore_cached()
+"""
+
+
+def test_restore_cached_keeps_converted_zips_locally(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    options = {"archive_format": "tar.xz"}
+    delivery = {"to_zip": True}
+    s3_resource = MagicMock()
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {}
+
+    def download(bucket, key, local_path, **kwargs):
+        assert key.startswith("alppbCache/") and key.endswith(".tar.xz")
+        with tarfile.open(local_path, "w:xz") as archive:
+            archive.add(__file__, "six.py")
+
+    s3_resource.meta.client.download_file.side_effect = download
+    assert restore_cached(s3_resource, s3_client, "bucket", "six", "3.6",
+                          "cache", 10 ** 6, delivery, options)
+    assert sorted(os.listdir(".")) == ["alppb-six.zip", "cache"]
+    assert os.listdir("cache")[0].endswith(".zip")
+
+    os.remove("alppb-six.zip")
+    s3_client.head_object.side_effect = AssertionError("S3 was checked")
+    assert restore_cached(s3_resource, s3_client, "bucket", "six", "3.6",
+                          "cache", 10 ** 6, delivery, options)
+    assert os.path.exists("alppb-six.zip")
+
+
+"""
+alppb.alppb.LocalBackend
+"""
+
+
+def test_local_backend_builds_delivers_and_caches(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    runs = []
+
+    def run_build(buildspec, artifact, work_dir, runtime=None, image=None):
+        runs.append((runtime, image))
+        if "broken" in buildspec:
+            return None
+        path = os.path.join(work_dir, artifact)
+        with open(path, "w") as built:
+            built.write(buildspec)
+        return path
+
+    monkeypatch.setattr(local, "run_build", run_build)
+    results = LocalBackend("docker").build(["six", "broken"], "3.7", 2,
+                                           cache_dir="cache")
+
+    assert results == {"six": True, "broken": False}
+    assert runs == [("docker", "irlrobot/alppb-python37")] * 2
+    assert os.path.isfile("alppb-six.zip")
+    assert len(os.listdir("cache")) == 1
+
+
+def test_local_process_backend_has_its_own_cache_key():
+    assert LocalBackend("process").image("3.6") != \
+        LocalBackend("docker").image("3.6")
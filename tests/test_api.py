@@ -0,0 +1,147 @@
+import asyncio
+import os
+from unittest.mock import MagicMock
+import pytest
+from alppb import alppb
+from alppb import api
+from alppb import codebuild
+from alppb import errors
+from alppb import iam
+from tests.fakes import FakeCodeBuild
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    fakes = {"iam": MagicMock(), "codebuild": FakeCodeBuild(),
+             "s3": MagicMock(), "s3_resource": MagicMock(), "lambda": None}
+    calls = []
+    monkeypatch.setattr(api, "create_clients",
+                        lambda region, layer=False: fakes)
+    monkeypatch.setattr(alppb, "validate_region", lambda region: None)
+    monkeypatch.setattr(alppb, "check_for_boto_credentials", lambda: None)
+    monkeypatch.setattr(alppb, "check_bucket_region",
+                        lambda *args: calls.append("check_bucket_region"))
+    monkeypatch.setattr(iam, "create_role", lambda client, bucket: (
+        calls.append("create_role") or ("arn", True)))
+    monkeypatch.setattr(iam, "delete_role_if_exists",
+                        lambda client: calls.append("delete_role"))
+    monkeypatch.setattr(codebuild, "create_build_project",
+                        lambda *args: calls.append("create_project") or True)
+    monkeypatch.setattr(codebuild, "project_in_use", lambda client: False)
+    monkeypatch.setattr(codebuild, "delete_build_project",
+                        lambda client: calls.append("delete_project"))
+    fakes["calls"] = calls
+    return fakes
+
+
+"""
+alppb.api.build()
+"""
+
+
+def test_build_returns_a_result_for_one_package(aws):
+    result = api.build("requests", "bucket", use_cache=False,
+                       min_delay=0, max_delay=0)
+
+    assert result.succeeded
+    assert result.build_id == "alppbBuilder:requests"
+    assert result.artifact == os.path.abspath("alppb-requests.zip")
+    assert result.seconds >= 0
+    assert aws["calls"] == ["check_bucket_region", "create_role",
+                            "create_project", "delete_project", "delete_role"]
+
+
+def test_build_raises_typed_errors(aws, monkeypatch):
+    def missing_bucket(*args):
+        raise errors.BucketError("The bucket does not exist")
+
+    monkeypatch.setattr(alppb, "check_bucket_region", missing_bucket)
+    with pytest.raises(errors.BucketError):
+        api.build("requests", "bucket", use_cache=False)
+
+
+def test_build_raises_build_error_with_every_result(aws):
+    aws["codebuild"].failing = ("b",)
+    with pytest.raises(errors.BuildError) as raised:
+        api.build(["a", "b"], "bucket", use_cache=False, min_delay=0,
+                  max_delay=0)
+
+    assert raised.value.failed == ["b"]
+    assert raised.value.results["a"].succeeded
+    assert raised.value.results["b"].error == "Build status is FAILED"
+
+    results = api.build(["a", "b"], "bucket", use_cache=False, min_delay=0,
+                        max_delay=0, raise_on_failure=False)
+    assert [result.succeeded for result in results.values()] == [True, False]
+
+
+def test_build_deletes_the_role_when_project_setup_fails(aws, monkeypatch):
+    def failing_project(*args):
+        raise errors.AlppbError("Could not create the project")
+
+    monkeypatch.setattr(codebuild, "create_build_project", failing_project)
+    with pytest.raises(errors.AlppbError):
+        api.build("requests", "bucket", use_cache=False)
+
+    assert aws["calls"] == ["check_bucket_region", "create_role",
+                            "delete_role"]
+
+
+def test_build_keeps_resources_it_did_not_create(aws, monkeypatch):
+    monkeypatch.setattr(iam, "create_role", lambda client, bucket: (
+        aws["calls"].append("create_role") or ("arn", False)))
+    monkeypatch.setattr(codebuild, "create_build_project", lambda *args: (
+        aws["calls"].append("create_project") or False))
+    api.build("requests", "bucket", use_cache=False, min_delay=0,
+              max_delay=0)
+
+    assert aws["calls"] == ["check_bucket_region", "create_role",
+                            "create_project"]
+
+
+def test_build_keeps_resources_other_builds_use(aws, monkeypatch):
+    monkeypatch.setattr(codebuild, "project_in_use", lambda client: True)
+    api.build("requests", "bucket", use_cache=False, min_delay=0,
+              max_delay=0)
+
+    assert aws["calls"] == ["check_bucket_region", "create_role",
+                            "create_project"]
+
+
+def test_build_shares_cache_keys_with_the_cli():
+    assert alppb.artifact_cache_key("requests", "3.6") == \
+        alppb.artifact_cache_key("requests", None)
+
+
+"""
+alppb.api.abuild()
+"""
+
+
+def test_abuild_shares_the_project_between_calls_on_one_loop(aws):
+    async def main():
+        return await asyncio.gather(
+            api.abuild("a", "bucket", use_cache=False, min_delay=0,
+                       max_delay=0),
+            api.abuild(["b", "c"], "bucket", use_cache=False, min_delay=0,
+                       max_delay=0))
+
+    single, several = asyncio.new_event_loop().run_until_complete(main())
+
+    assert single.succeeded
+    assert sorted(several) == ["b", "c"]
+    assert sorted(aws["codebuild"].started) == ["a", "b", "c"]
+    assert aws["calls"].count("create_project") == 1
+    assert aws["calls"][-2:] == ["delete_project", "delete_role"]
+
+
+def test_abuild_returns_cached_artifacts_without_building(aws, monkeypatch):
+    monkeypatch.setattr(alppb, "restore_from_cache",
+                        lambda *args: {"requests": True})
+    result = api.build("requests", "bucket")
+
+    assert result.cached
+    assert result.build_id is None
+    assert aws["codebuild"].started == []
+    assert "create_role" not in aws["calls"]
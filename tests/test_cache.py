@@ -0,0 +1,84 @@
+import os
+import boto3
+from botocore.stub import Stubber
+from alppb import cache
+
+
+"""
+alppb.cache.cache_key()
+"""
+
+
+def test_cache_key_is_stable():
+    assert cache.cache_key("lxml", "3.6", "image", "spec") == \
+        cache.cache_key("lxml", "3.6", "image", "spec")
+
+
+def test_cache_key_changes_with_inputs():
+    key = cache.cache_key("lxml", "3.6", "image", "spec")
+    assert key != cache.cache_key("lxml", "3.7", "image", "spec")
+    assert key != cache.cache_key("lxml", "3.6", "image", "other spec")
+
+
+"""
+alppb.cache local tier
+"""
+
+
+def write_artifact(path, size):
+    with open(str(path), "wb") as artifact:
+        artifact.write(b"x" * size)
+    return str(path)
+
+
+def test_lookup_local_miss(tmp_path):
+    assert cache.lookup_local(str(tmp_path), "missing") is None
+
+
+def test_store_and_lookup_local(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    artifact = write_artifact(tmp_path / "alppb-lxml.zip", 10)
+    cache.store_local(cache_dir, "abc", artifact)
+
+    assert cache.lookup_local(cache_dir, "abc") == \
+        os.path.join(cache_dir, "abc.zip")
+    assert os.listdir(cache_dir) == ["abc.zip"]
+
+
+def test_store_local_evicts_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    artifact = write_artifact(tmp_path / "alppb-lxml.zip", 10)
+    cache.store_local(cache_dir, "old", artifact, max_bytes=25)
+    cache.store_local(cache_dir, "used", artifact, max_bytes=25)
+    os.utime(os.path.join(cache_dir, "old.zip"), (1, 1))
+    os.utime(os.path.join(cache_dir, "used.zip"), (2, 2))
+    cache.store_local(cache_dir, "new", artifact, max_bytes=25)
+
+    assert sorted(os.listdir(cache_dir)) == ["new.zip", "used.zip"]
+
+
+"""
+alppb.cache S3 tier
+"""
+
+
+def s3_client():
+    return boto3.client("s3", region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+def test_lookup_s3_hit():
+    client = s3_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("head_object", {},
+                             {"Bucket": "bucket",
+                              "Key": "alppbCache/abc.zip"})
+        assert cache.lookup_s3(client, "bucket", "abc")
+
+
+def test_lookup_s3_miss():
+    client = s3_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("head_object", "404")
+        assert not cache.lookup_s3(client, "bucket", "abc")
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+import pytest
+from alppb.cli import main
+from alppb.cli import parse_args
+
+
+"""
+alppb.cli.parse_args()
+"""
+
+
+def test_parse_args_build():
+    args = parse_args(["numpy", "lxml", "bucket", "--warm"])
+    assert args.command == "build"
+    assert args.package == ["numpy", "lxml"]
+    assert args.bucket == "bucket"
+    assert args.warm
+
+
+def test_parse_args_compute_type():
+    args = parse_args(["lxml", "bucket", "--compute-type", "auto",
+                       "--compute-override", "lxml=BUILD_GENERAL1_LARGE"])
+    assert args.compute_type == "auto"
+    assert args.compute_policy == "time"
+    assert args.compute_override == [("lxml", "BUILD_GENERAL1_LARGE")]
+
+
+def test_parse_args_rejects_bad_compute_override():
+    with pytest.raises(SystemExit):
+        parse_args(["lxml", "bucket", "--compute-override", "lxml=HUGE"])
+
+
+def test_parse_args_python_versions():
+    assert parse_args(["lxml", "bucket"]).python is None
+    assert parse_args(["lxml", "bucket", "--python",
+                       "3.6, 3.7,3.6"]).python == ["3.6", "3.7"]
+    with pytest.raises(SystemExit):
+        parse_args(["lxml", "bucket", "--python", "3.6,3.8"])
+
+
+def test_parse_args_layer_needs_zip():
+    assert not parse_args(["lxml", "bucket", "--layer",
+                           "--no-download"]).download
+    with pytest.raises(SystemExit):
+        parse_args(["lxml", "bucket", "--layer", "--format", "tar.xz"])
+    with pytest.raises(SystemExit):
+        parse_args(["lxml", "bucket", "--no-download"])
+
+
+def test_parse_args_local_backend_is_local_only():
+    assert parse_args(["six", "bucket", "-b", "process"]).backend == \
+        "process"
+    with pytest.raises(SystemExit):
+        parse_args(["six", "bucket", "-b", "docker", "--wheelhouse"])
+    with pytest.raises(SystemExit):
+        parse_args(["six", "bucket", "-b", "docker", "--batch-size", "4"])
+
+
+def test_parse_args_serve():
+    args = parse_args(["serve", "bucket", "--socket", "/tmp/alppb.sock"])
+    assert args.command == "serve"
+    assert args.bucket == "bucket"
+    assert args.socket == "/tmp/alppb.sock"
+    assert args.port == 8080
+
+
+def test_parse_args_teardown():
+    args = parse_args(["teardown", "--region", "us-west-2"])
+    assert args.command == "teardown"
+    assert args.region == "us-west-2"
+
+
+"""
+alppb.cli.main()
+"""
+
+
+def test_main_prints_version(capsys):
+    with patch.object(sys, "argv", ["alppb", "--version"]):
+        with pytest.raises(SystemExit) as pytest_wrapped_e:
+            main()
+
+    assert pytest_wrapped_e.value.code == 0
+    assert capsys.readouterr().out.startswith("alppb ")
+
+
+def test_help_and_version_do_not_import_boto3():
+    """ Runs in a fresh interpreter so other tests can't import boto3 """
+    code = ("import sys\n"
+            "from alppb.cli import main\n"
+            "for flag in ('--help', '--version'):\n"
+            "    sys.argv = ['alppb', flag]\n"
+            "    try:\n"
+            "        main()\n"
+            "    except SystemExit:\n"
+            "        pass\n"
+            "sys.stderr.write(str(sorted(m for m in sys.modules\n"
+            "    if m.split('.')[0] in ('boto3', 'botocore', 'yaml'))))\n")
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd=os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+
+    assert result.stderr == "[]"
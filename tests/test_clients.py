@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+from alppb import clients
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    clients.reset()
+    yield
+    clients.reset()
+
+
+"""
+alppb.clients.get_client()
+"""
+
+
+def test_get_client_is_cached_per_service_and_region():
+    client = clients.get_client("s3", "us-east-1")
+    assert clients.get_client("s3", "us-east-1") is client
+    assert clients.get_client("s3", "us-west-2") is not client
+    assert clients.get_client("codebuild", "us-east-1") is not client
+
+
+def test_get_client_uses_tuned_config():
+    config = clients.get_client("s3", "us-east-1").meta.config
+    assert config.max_pool_connections == 32
+    assert config.retries["mode"] == "adaptive"
+    assert config.connect_timeout == 10
+
+
+def test_configure_recreates_clients():
+    client = clients.get_client("s3", "us-east-1")
+    clients.configure(max_pool_connections=64)
+    new_client = clients.get_client("s3", "us-east-1")
+
+    assert new_client is not client
+    assert new_client.meta.config.max_pool_connections == 64
+
+
+def test_get_client_creates_clients_concurrently(monkeypatch):
+    # The first client of a session is created alone.
+    clients.get_client("codebuild", "us-east-1")
+    session = clients.get_session()
+    create = session.client
+    # Both creations have to be under way at once to pass the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def client(*args, **kwargs):
+        barrier.wait()
+        return create(*args, **kwargs)
+
+    monkeypatch.setattr(session, "client", client)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        created = list(pool.map(
+            lambda service: clients.get_client(service, "us-east-1"),
+            ["s3", "iam"]))
+
+    assert created == [clients.get_client("s3", "us-east-1"),
+                       clients.get_client("iam", "us-east-1")]
+
+
+def test_get_client_sets_up_the_session_once(monkeypatch):
+    session = clients.get_session()
+    create = session.client
+    creating = threading.Event()
+
+    def client(*args, **kwargs):
+        # The other thread must not start while the session is set up.
+        assert not creating.is_set()
+        creating.set()
+        try:
+            # Gives the other thread time to get here too.
+            threading.Event().wait(0.1)
+            return create(*args, **kwargs)
+        finally:
+            creating.clear()
+
+    monkeypatch.setattr(session, "client", client)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(
+            lambda service: clients.get_client(service, "us-east-1"),
+            ["s3", "iam"]))
+
+
+"""
+alppb.clients.get_resource()
+"""
+
+
+def test_get_resource_shares_the_client():
+    resource = clients.get_resource("s3", "us-east-1")
+    assert resource.meta.client is clients.get_client("s3", "us-east-1")
+    assert clients.get_resource("s3", "us-east-1") is resource
@@ -1,5 +1,30 @@
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+import boto3
+import os
+import shutil
+import subprocess
+import pytest
+import yaml
+from alppb.codebuild import BuildPoller
+from alppb.codebuild import artifact_prefix
+from alppb.codebuild import artifacts_override
+from alppb.codebuild import archive_command
+from alppb.codebuild import artifact_name
+from alppb.codebuild import create_build_project
 from alppb.codebuild import determine_image
+from alppb.codebuild import generate_batch_buildspec
+from alppb.codebuild import generate_buildspec
+from alppb.codebuild import phase_durations
 from alppb.codebuild import pip_to_use
+from alppb.codebuild import project_cache
+from alppb.codebuild import project_in_use
+from alppb.codebuild import project_matches
+from alppb.codebuild import prune_rules
+from alppb.codebuild import retry_until_role_ready
+from alppb.codebuild import start_build
+from alppb.codebuild import wait_for_builds
+from alppb.codebuild import wheelhouse_uri
 
 
 """
@@ -64,3 +89,483 @@ def test_pip_to_use_none():
 def test_pip_to_use_invalid():
     """ Fallback to pip-3.6 """
     assert pip_to_use("blah") == "pip-3.6"
+
+
+"""
+alppb.codebuild.artifact_name()
+"""
+
+
+def test_artifact_name():
+    assert artifact_name("requests") == "alppb-requests.zip"
+
+
+def test_artifact_name_with_version_specifier():
+    assert artifact_name("requests==2.20.1") == "alppb-requests_2.20.1.zip"
+
+
+def test_artifact_name_with_suffix():
+    assert artifact_name("requests", "tar.gz", "-py3.7") == \
+        "alppb-requests-py3.7.tar.gz"
+
+
+"""
+alppb.codebuild.generate_buildspec()
+"""
+
+
+def test_generate_buildspec_artifact():
+    buildspec = yaml.safe_load(
+        generate_buildspec("lxml", "3.6", "alppb-lxml.zip"))
+    assert buildspec["artifacts"]["files"] == ["alppb-lxml.zip"]
+    assert "zip -r ../alppb-lxml.zip *" in \
+        buildspec["phases"]["build"]["commands"]
+
+
+"""
+alppb.codebuild.BuildPoller
+"""
+
+
+class FakeClient(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def batch_get_builds(self, ids):
+        self.calls.append(ids)
+        return {"builds": [dict(self.responses.pop(0), id=build_id)
+                           for build_id in ids]}
+
+
+def test_poller_backs_off_and_reports_changes():
+    client = FakeClient([
+        {"buildStatus": "IN_PROGRESS", "currentPhase": "BUILD"},
+        {"buildStatus": "IN_PROGRESS", "currentPhase": "BUILD"},
+        {"buildStatus": "IN_PROGRESS", "currentPhase": "BUILD"},
+        {"buildStatus": "SUCCEEDED", "currentPhase": "COMPLETED"},
+    ])
+    delays = []
+    poller = BuildPoller(client, min_delay=2, max_delay=30,
+                         sleep=delays.append, jitter=lambda low, high: high)
+    poller.track("build:1")
+    changes = [build["buildStatus"] for build in poller.changes()]
+
+    assert changes == ["IN_PROGRESS", "SUCCEEDED"]
+    assert delays == [2, 4, 8]
+
+
+def test_poller_polls_eagerly_in_late_phases():
+    client = FakeClient([
+        {"buildStatus": "IN_PROGRESS", "currentPhase": "UPLOAD_ARTIFACTS"},
+        {"buildStatus": "IN_PROGRESS", "currentPhase": "UPLOAD_ARTIFACTS"},
+        {"buildStatus": "SUCCEEDED", "currentPhase": "COMPLETED"},
+    ])
+    delays = []
+    poller = BuildPoller(client, min_delay=2, sleep=delays.append,
+                         jitter=lambda low, high: high)
+    poller.track("build:1")
+    list(poller.changes())
+
+    assert delays == [2, 2]
+
+
+def test_poller_backs_off_again_after_the_expected_duration():
+    client = FakeClient([{"buildStatus": "IN_PROGRESS",
+                          "currentPhase": "BUILD"}] * 4 +
+                        [{"buildStatus": "SUCCEEDED",
+                          "currentPhase": "COMPLETED"}])
+    now = [0]
+    delays = []
+
+    def sleep(delay):
+        delays.append(delay)
+        now[0] += delay
+
+    poller = BuildPoller(client, min_delay=2, max_delay=30, sleep=sleep,
+                         clock=lambda: now[0], jitter=lambda low, high: high)
+    poller.track("build:1", expected_duration=5)
+    list(poller.changes())
+
+    assert delays == [2, 3, 8, 16]
+
+
+def test_poller_fails_builds_codebuild_does_not_return():
+    client = FakeClient([{"buildStatus": "SUCCEEDED"}])
+    client.batch_get_builds = lambda ids: {
+        "builds": [{"id": "build:1", "buildStatus": "SUCCEEDED"}],
+        "buildsNotFound": ["build:2"]}
+    statuses = wait_for_builds(client, ["build:1", "build:2"],
+                               sleep=lambda delay: None)
+
+    assert statuses == {"build:1": "SUCCEEDED", "build:2": "FAILED"}
+
+
+def test_poller_batches_build_ids():
+    client = FakeClient([{"buildStatus": "SUCCEEDED"}] * 2)
+    statuses = wait_for_builds(client, ["build:1", "build:2"],
+                               sleep=lambda delay: None)
+
+    assert client.calls == [["build:1", "build:2"]]
+    assert statuses == {"build:1": "SUCCEEDED", "build:2": "SUCCEEDED"}
+
+
+"""
+alppb.codebuild.project_matches()
+"""
+
+
+PROJECT = {
+    "serviceRole": "arn:aws:iam::123456789012:role/alppbBuilderRole",
+    "artifacts": {"type": "S3", "location": "bucket"},
+    "environment": {"image": "irlrobot/alppb-python36"},
+}
+
+
+def test_project_matches():
+    assert project_matches(PROJECT, PROJECT["serviceRole"])
+
+
+def test_project_matches_ignores_what_builds_override():
+    assert project_matches(dict(PROJECT, artifacts={"type": "NO_ARTIFACTS"},
+                                environment={"image": "other"}),
+                           PROJECT["serviceRole"])
+
+
+def test_project_matches_other_role():
+    assert not project_matches(PROJECT, "arn:aws:iam::1:role/other")
+
+
+"""
+alppb.codebuild.retry_until_role_ready()
+"""
+
+
+def role_error(code="InvalidInputException"):
+    return ClientError({"Error": {
+        "Code": code,
+        "Message": "CodeBuild is not authorized to perform: sts:AssumeRole "
+                   "on arn:aws:iam::123456789012:role/alppbBuilderRole"}},
+        "StartBuild")
+
+
+def test_retry_until_role_ready_retries_with_backoff():
+    responses = [role_error(), role_error(), {"build": {"id": "build:1"}}]
+
+    def call(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    delays = []
+    response = retry_until_role_ready(call, sleep=delays.append,
+                                      projectName="alppbBuilder")
+
+    assert response == {"build": {"id": "build:1"}}
+    assert delays == [1.0, 2.0]
+
+
+def test_retry_until_role_ready_raises_other_errors():
+    def call(**kwargs):
+        raise role_error("AccessDeniedException")
+
+    with pytest.raises(ClientError):
+        retry_until_role_ready(call, sleep=lambda delay: None)
+
+
+"""
+alppb.codebuild.wheelhouse_uri()
+"""
+
+
+def test_wheelhouse_uri_is_per_python_version():
+    uri = wheelhouse_uri("bucket", "3.6")
+    assert uri.startswith("s3://bucket/alppbWheelhouse/")
+    assert uri.endswith("/")
+    assert uri == wheelhouse_uri("bucket", "3.6")
+    assert uri != wheelhouse_uri("bucket", "3.7")
+
+
+def test_generate_buildspec_with_wheelhouse():
+    wheelhouse = "s3://bucket/alppbWheelhouse/abc/"
+    commands = yaml.safe_load(generate_buildspec(
+        "lxml", "3.6", "alppb-lxml.zip", wheelhouse=wheelhouse)
+    )["phases"]["build"]["commands"]
+
+    assert "aws s3 sync {} wheelhouse/ --only-show-errors".format(
+        wheelhouse) in commands
+    assert "pip-3.6 wheel lxml -w wheelhouse --find-links wheelhouse" in \
+        commands
+    assert "pip-3.6 install lxml -t alppb --no-index --find-links " \
+        "wheelhouse" in commands
+    assert commands.index("aws s3 sync wheelhouse/ {} --only-show-errors"
+                          .format(wheelhouse)) < commands.index("cd alppb/")
+
+
+"""
+alppb.codebuild.project_cache()
+"""
+
+
+def test_project_cache_s3():
+    assert project_cache("s3", "bucket") == {
+        "type": "S3", "location": "bucket/alppbBuildCache"}
+
+
+def test_project_cache_local():
+    assert project_cache("local", "bucket") == {
+        "type": "LOCAL", "modes": ["LOCAL_CUSTOM_CACHE"]}
+
+
+def test_project_cache_none():
+    assert project_cache(None, "bucket") == {"type": "NO_CACHE"}
+
+
+def test_project_matches_other_cache():
+    assert project_matches(PROJECT, PROJECT["serviceRole"])
+    assert not project_matches(PROJECT, PROJECT["serviceRole"],
+                               project_cache("s3", "bucket"))
+
+
+def test_generate_buildspec_with_pip_cache():
+    buildspec = yaml.safe_load(
+        generate_buildspec("lxml", "3.6", "alppb-lxml.zip", pip_cache=True))
+    assert buildspec["cache"]["paths"] == ["/root/.cache/pip/**/*"]
+    assert buildspec["env"]["variables"]["PIP_CACHE_DIR"] == \
+        "/root/.cache/pip"
+
+
+def test_generate_buildspec_as_layer():
+    commands = yaml.safe_load(generate_buildspec("lxml", "3.7", layer=True)
+                              )["phases"]["build"]["commands"]
+
+    assert commands[-5:-2] == [
+        "mkdir -p layer/python/lib/python3.7",
+        "mv alppb layer/python/lib/python3.7/site-packages",
+        "mv layer alppb"]
+
+
+"""
+alppb.codebuild.generate_batch_buildspec()
+"""
+
+
+def test_generate_batch_buildspec_uploads_every_artifact():
+    buildspec = yaml.safe_load(generate_batch_buildspec(
+        ["six", "idna"], "3.6", ["alppb-six.zip", "alppb-idna.zip"],
+        pip_cache=True))
+    commands = "\n".join(buildspec["phases"]["build"]["commands"])
+
+    assert buildspec["artifacts"] == {"files": ["alppb-batch/out/*"],
+                                      "discard-paths": "yes"}
+    assert buildspec["cache"]["paths"] == ["/root/.cache/pip/**/*"]
+    assert "pip-3.6 install six -t alppb" in commands
+    assert "pip-3.6 install idna -t alppb" in commands
+    assert 'echo "alppb batch failed: "idna' in commands
+
+
+@pytest.mark.skipif(shutil.which("zip") is None, reason="needs zip")
+def test_generate_batch_buildspec_isolates_failures(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    pip = bin_dir / "pip-3.6"
+    pip.write_text('#!/bin/sh\n[ "$2" = bad ] && exit 1\n'
+                   'mkdir -p "$4/$2" && touch "$4/$2/__init__.py"\n')
+    pip.chmod(0o755)
+    spec = yaml.safe_load(generate_batch_buildspec(
+        ["six", "bad", "idna"], "3.6", ["a.zip", "b.zip", "c.zip"]))
+    result = subprocess.run(
+        ["sh", "-c", "set -e\n" + "\n".join(
+            spec["phases"]["build"]["commands"])],
+        cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=dict(os.environ, PATH="{}:{}".format(bin_dir,
+                                                 os.environ["PATH"])))
+
+    assert result.returncode == 0
+    assert b"alppb batch failed: bad" in result.stdout
+    assert sorted(os.listdir(str(tmp_path / "alppb-batch" / "out"))) == \
+        ["a.zip", "c.zip"]
+
+
+"""
+alppb.codebuild.archive_command()
+"""
+
+
+def test_archive_command_formats_and_levels():
+    assert archive_command("a.zip") == "zip -r ../a.zip *"
+    assert archive_command("a.zip", "zip", 0) == "zip -r -0 ../a.zip *"
+    assert archive_command("a.tar.gz", "tar.gz", 1) == \
+        "tar -cf - * | gzip -1 > ../a.tar.gz"
+    assert archive_command("a.tar.xz", "tar.xz") == \
+        "tar -cf - * | xz -T0 -6 > ../a.tar.xz"
+    with pytest.raises(ValueError):
+        archive_command("a.7z", "7z")
+
+
+def test_artifact_name_with_archive_format():
+    assert artifact_name("zope.interface", "tar.xz") == \
+        "alppb-zope.interface.tar.xz"
+
+
+"""
+alppb.codebuild.prune_commands()
+"""
+
+
+def test_generate_buildspec_prunes_before_zipping():
+    commands = yaml.safe_load(generate_buildspec(
+        "numpy", "3.7", prune=prune_rules(precompile=True))
+    )["phases"]["build"]["commands"]
+
+    prune = commands[1:commands.index("cd alppb/")]
+    assert prune[0] == "ALPPB_SIZE=$(du -sb alppb | cut -f1)"
+    assert any(command.startswith("find alppb -name '*.so*'")
+               for command in prune)
+    assert "python3.7 -m compileall -q alppb || true" in prune
+    assert prune[-1].startswith('echo "alppb pruned')
+
+
+def test_prune_commands_respect_include_rules(tmp_path):
+    for path in ("pkg/__init__.py", "pkg/tests/test_pkg.py", "pkg/x.h",
+                 "pkg/include/y.h", "pkg/__pycache__/x.pyc"):
+        os.makedirs(os.path.dirname(str(tmp_path / "alppb" / path)),
+                    exist_ok=True)
+        (tmp_path / "alppb" / path).write_text("x" * 100)
+    rules = prune_rules(include=["*/pkg/include*"], strip=False)
+    buildspec = yaml.safe_load(generate_buildspec("pkg", "3.6", prune=rules))
+    commands = buildspec["phases"]["build"]["commands"]
+    script = "\n".join(commands[1:commands.index("cd alppb/")])
+    output = subprocess.run(["sh", "-c", script], cwd=str(tmp_path),
+                            stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+
+    remaining = sorted(os.path.relpath(os.path.join(root, name),
+                                       str(tmp_path / "alppb"))
+                       for root, _, names in os.walk(str(tmp_path / "alppb"))
+                       for name in names)
+    assert remaining == ["pkg/__init__.py", "pkg/include/y.h"]
+    assert output.startswith("alppb pruned ")
+
+
+"""
+alppb.codebuild.phase_durations()
+"""
+
+
+def test_phase_durations_skips_unfinished_phases():
+    build = {"phases": [
+        {"phaseType": "SUBMITTED", "durationInSeconds": 0},
+        {"phaseType": "PROVISIONING", "durationInSeconds": 25},
+        {"phaseType": "BUILD"},
+    ]}
+    assert phase_durations(build) == {"SUBMITTED": 0, "PROVISIONING": 25}
+
+
+def codebuild_client():
+    return boto3.client("codebuild", region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+"""
+alppb.codebuild.create_build_project()
+"""
+
+
+def test_create_build_project_is_generic():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("create_project", {})
+        assert create_build_project(client, PROJECT["serviceRole"])
+        stubber.assert_no_pending_responses()
+
+
+def test_create_build_project_overwrites_existing_project():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_project",
+                                 "ResourceAlreadyExistsException")
+        stubber.add_response("update_project", {})
+        assert not create_build_project(client, PROJECT["serviceRole"])
+        stubber.assert_no_pending_responses()
+
+
+def test_create_build_project_accepts_every_cache():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        # botocore validates the cache against its model before the stub
+        # answers, and only knows the LOCAL type from 1.13.
+        for mode in ("s3", "local", None):
+            stubber.add_response("create_project", {})
+            create_build_project(client, PROJECT["serviceRole"],
+                                 project_cache(mode, "bucket"))
+        stubber.assert_no_pending_responses()
+
+
+"""
+alppb.codebuild.project_in_use()
+"""
+
+
+def test_project_in_use_finds_running_builds():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("list_builds_for_project",
+                             {"ids": ["alppb:2", "alppb:1"]},
+                             {"projectName": "alppbBuilder",
+                              "sortOrder": "DESCENDING"})
+        stubber.add_response("batch_get_builds", {"builds": [
+            {"id": "alppb:2", "buildStatus": "IN_PROGRESS"},
+            {"id": "alppb:1", "buildStatus": "SUCCEEDED"},
+        ]}, {"ids": ["alppb:2", "alppb:1"]})
+        assert project_in_use(client)
+        stubber.assert_no_pending_responses()
+
+
+def test_project_in_use_without_project():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("list_builds_for_project",
+                                 "ResourceNotFoundException")
+        assert not project_in_use(client)
+        stubber.assert_no_pending_responses()
+
+
+"""
+alppb.codebuild.artifact_prefix()
+"""
+
+
+def test_artifact_prefix_from_the_build_location():
+    build = {"id": "alppbBuilder:1234", "artifacts": {
+        "location": "arn:aws:s3:::bucket/1234/alppbBuilder"}}
+    assert artifact_prefix(build) == "1234/alppbBuilder"
+
+
+def test_artifact_prefix_from_the_build_id():
+    assert artifact_prefix({"id": "alppbBuilder:1234"}) == \
+        "1234/alppbBuilder"
+
+
+"""
+alppb.codebuild.start_build()
+"""
+
+
+def test_start_build_overrides_everything_per_build():
+    client = codebuild_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("start_build", {"build": {"id": "alppb:1"}}, {
+            "projectName": "alppbBuilder",
+            "buildspecOverride": "version: 0.2",
+            "computeTypeOverride": "BUILD_GENERAL1_LARGE",
+            "imageOverride": "irlrobot/alppb-python37",
+            "artifactsOverride": artifacts_override("bucket"),
+        })
+        build_id = start_build(client, "version: 0.2",
+                               "BUILD_GENERAL1_LARGE",
+                               "irlrobot/alppb-python37", "bucket")
+
+    assert build_id == "alppb:1"
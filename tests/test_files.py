@@ -0,0 +1,51 @@
+import json
+import os
+import pytest
+from alppb import files
+
+
+"""
+alppb.files.default_path()
+"""
+
+
+def test_default_path_respects_xdg(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    assert files.default_path("cache", "metadata.json") == \
+        str(tmp_path / "cache" / "alppb" / "metadata.json")
+    assert files.default_path("data", "history.json") == \
+        str(tmp_path / "data" / "alppb" / "history.json")
+
+
+def test_default_path_falls_back_to_home(monkeypatch, tmp_path):
+    monkeypatch.delenv("XDG_DATA_HOME", raising=False)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert files.default_path("data", "history.json") == os.path.join(
+        str(tmp_path), ".local", "share", "alppb", "history.json")
+
+
+"""
+alppb.files.write_json()
+"""
+
+
+def test_write_json_replaces_the_file(tmp_path):
+    path = str(tmp_path / "alppb" / "data.json")
+    files.write_json(path, {"a": 1})
+    files.write_json(path, {"b": 2})
+
+    with open(path) as json_file:
+        assert json.load(json_file) == {"b": 2}
+    assert os.listdir(str(tmp_path / "alppb")) == ["data.json"]
+
+
+def test_write_json_keeps_the_old_file_on_failure(tmp_path):
+    path = str(tmp_path / "data.json")
+    files.write_json(path, {"a": 1})
+    with pytest.raises(TypeError):
+        files.write_json(path, {"a": object()})
+
+    with open(path) as json_file:
+        assert json.load(json_file) == {"a": 1}
+    assert os.listdir(str(tmp_path)) == ["data.json"]
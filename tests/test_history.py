@@ -0,0 +1,113 @@
+from alppb import history
+
+
+def succeeded(compute_type, build_seconds, overhead=50):
+    return {"computeType": compute_type, "status": "SUCCEEDED",
+            "duration": build_seconds + overhead,
+            "phases": {"BUILD": build_seconds}}
+
+
+"""
+alppb.history.load() and alppb.history.save()
+"""
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "alppb" / "history.json")
+    history.save(path, {"3.6/numpy": [succeeded("BUILD_GENERAL1_SMALL", 60)]})
+
+    assert history.load(path) == {
+        "3.6/numpy": [succeeded("BUILD_GENERAL1_SMALL", 60)]}
+
+
+def test_load_missing_or_corrupt_file(tmp_path):
+    path = tmp_path / "history.json"
+    assert history.load(str(path)) == {}
+    path.write_text("{not json")
+    assert history.load(str(path)) == {}
+
+
+"""
+alppb.history.record()
+"""
+
+
+def test_record_keeps_recent_builds():
+    data = {}
+    build = {"buildStatus": "SUCCEEDED",
+             "environment": {"computeType": "BUILD_GENERAL1_MEDIUM"},
+             "phases": [{"phaseType": "INSTALL", "durationInSeconds": 20},
+                        {"phaseType": "BUILD", "durationInSeconds": 100},
+                        {"phaseType": "COMPLETED"}]}
+    for _ in range(history.RECORDS_PER_PACKAGE + 2):
+        entry = history.record(data, "lxml", "3.7", build)
+
+    assert len(data["3.7/lxml"]) == history.RECORDS_PER_PACKAGE
+    assert entry["computeType"] == "BUILD_GENERAL1_MEDIUM"
+    assert entry["duration"] == 120
+    assert entry["phases"] == {"INSTALL": 20, "BUILD": 100}
+
+
+"""
+alppb.history.estimate_duration()
+"""
+
+
+def test_estimate_duration_uses_median_on_same_compute_type():
+    data = {"3.6/numpy": [succeeded("BUILD_GENERAL1_LARGE", 100),
+                          succeeded("BUILD_GENERAL1_LARGE", 300),
+                          succeeded("BUILD_GENERAL1_LARGE", 200),
+                          dict(succeeded("BUILD_GENERAL1_LARGE", 1),
+                               status="FAILED")]}
+
+    assert history.estimate_duration(
+        data, "numpy", "3.6", "BUILD_GENERAL1_LARGE") == 250
+
+
+def test_estimate_duration_scales_only_long_build_phases():
+    data = {"3.6/numpy": [succeeded("BUILD_GENERAL1_SMALL", 500)],
+            "3.6/six": [succeeded("BUILD_GENERAL1_SMALL", 10)]}
+
+    assert history.estimate_duration(
+        data, "numpy", "3.6", "BUILD_GENERAL1_LARGE") == 250
+    assert history.estimate_duration(
+        data, "six", "3.6", "BUILD_GENERAL1_LARGE") == 60
+    assert history.estimate_duration(
+        data, "lxml", "3.6", "BUILD_GENERAL1_LARGE") is None
+
+
+"""
+alppb.history.choose_compute_type()
+"""
+
+
+def test_choose_compute_type_without_history():
+    assert history.choose_compute_type({}, "numpy", "3.6") == \
+        ("BUILD_GENERAL1_SMALL", None)
+
+
+def test_choose_compute_type_keeps_light_packages_small():
+    data = {"3.6/six": [succeeded("BUILD_GENERAL1_SMALL", 10)]}
+
+    assert history.choose_compute_type(data, "six", "3.6") == \
+        ("BUILD_GENERAL1_SMALL", 60)
+
+
+def test_choose_compute_type_time_and_cost_policies():
+    data = {"3.6/scipy": [succeeded("BUILD_GENERAL1_SMALL", 1200)]}
+
+    assert history.choose_compute_type(data, "scipy", "3.6", "time")[0] == \
+        "BUILD_GENERAL1_LARGE"
+    # 21 minutes on SMALL is cheaper than 9 on LARGE or 13 on MEDIUM.
+    assert history.choose_compute_type(data, "scipy", "3.6", "cost")[0] == \
+        "BUILD_GENERAL1_SMALL"
+
+
+"""
+alppb.history.cost()
+"""
+
+
+def test_cost_bills_started_minutes():
+    assert history.cost("BUILD_GENERAL1_SMALL", 1) == 0.005
+    assert history.cost("BUILD_GENERAL1_LARGE", 61) == 0.04
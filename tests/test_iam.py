@@ -0,0 +1,174 @@
+import json
+import types
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+import pytest
+from alppb import iam
+from alppb.iam import create_role
+from alppb.iam import ensure_role
+from alppb.iam import generate_role_policy
+
+
+def iam_client():
+    return boto3.client("iam", region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+ROLE = {
+    "Role": {
+        "Path": "/",
+        "RoleName": "alppbBuilderRole",
+        "RoleId": "AROAEXAMPLEEXAMPLE",
+        "Arn": "arn:aws:iam::123456789012:role/alppbBuilderRole",
+        "CreateDate": "2018-01-01T00:00:00Z",
+    }
+}
+
+
+"""
+alppb.iam.ensure_role()
+"""
+
+
+def test_ensure_role_reuses_matching_role():
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("get_role", ROLE,
+                             {"RoleName": "alppbBuilderRole"})
+        stubber.add_response("get_role_policy", {
+            "RoleName": "alppbBuilderRole",
+            "PolicyName": "alppbBuilderPolicy",
+            "PolicyDocument": generate_role_policy("bucket"),
+        })
+        arn = ensure_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+    assert arn == "arn:aws:iam::123456789012:role/alppbBuilderRole"
+
+
+def policy_response(bucket):
+    return {
+        "RoleName": "alppbBuilderRole",
+        "PolicyName": "alppbBuilderPolicy",
+        "PolicyDocument": generate_role_policy(bucket),
+    }
+
+
+def test_ensure_role_updates_policy_for_other_bucket(monkeypatch):
+    delays = []
+    monkeypatch.setattr(iam, "time", types.SimpleNamespace(
+        sleep=delays.append))
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("get_role", ROLE)
+        stubber.add_response("get_role_policy", policy_response("other"))
+        stubber.add_client_error("create_role", "EntityAlreadyExists")
+        stubber.add_response("get_role", ROLE)
+        stubber.add_response("get_role_policy", policy_response("other"))
+        # Runs for the other bucket keep using the role.
+        stubber.add_response("put_role_policy", {}, {
+            "RoleName": "alppbBuilderRole",
+            "PolicyName": "alppbBuilderPolicy",
+            "PolicyDocument": generate_role_policy(["bucket", "other"]),
+        })
+        # IAM still returns the old policy once before the new one.
+        stubber.add_response("get_role_policy", policy_response("other"))
+        stubber.add_response("get_role_policy",
+                             policy_response(["bucket", "other"]))
+        ensure_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+    assert delays == [1.0, iam.POLICY_SETTLE_DELAY]
+
+
+"""
+alppb.iam.create_role()
+"""
+
+
+def test_create_role_checks_new_role_policy():
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("create_role", ROLE)
+        stubber.add_response("put_role_policy", {})
+        stubber.add_response("get_role_policy", policy_response("bucket"))
+        arn, created = create_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+    assert created
+
+
+def test_create_role_adds_bucket_again_after_concurrent_update(monkeypatch):
+    delays = []
+    monkeypatch.setattr(iam, "time", types.SimpleNamespace(
+        sleep=delays.append))
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_role", "EntityAlreadyExists")
+        stubber.add_response("get_role", ROLE)
+        stubber.add_response("get_role_policy", policy_response("other"))
+        stubber.add_response("put_role_policy", {})
+        # A run for "third" read the policy before our put and wrote after.
+        stubber.add_response("get_role_policy", policy_response("third"))
+        stubber.add_response("put_role_policy", {}, {
+            "RoleName": "alppbBuilderRole",
+            "PolicyName": "alppbBuilderPolicy",
+            "PolicyDocument": generate_role_policy(["bucket", "third"]),
+        })
+        stubber.add_response("get_role_policy",
+                             policy_response(["bucket", "third"]))
+        create_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+    assert delays == [1.0, iam.POLICY_SETTLE_DELAY]
+
+
+def test_create_role_skips_unchanged_policy():
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_role", "EntityAlreadyExists")
+        stubber.add_response("get_role", ROLE)
+        stubber.add_response("get_role_policy", policy_response("bucket"))
+        arn, created = create_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+    assert arn == "arn:aws:iam::123456789012:role/alppbBuilderRole"
+    assert not created
+
+
+def test_create_role_skips_bucket_granted_with_others():
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_role", "EntityAlreadyExists")
+        stubber.add_response("get_role", ROLE)
+        stubber.add_response("get_role_policy",
+                             policy_response(["bucket", "other"]))
+        create_role(client, "other")
+        stubber.assert_no_pending_responses()
+
+
+def test_create_role_deletes_new_role_when_policy_fails():
+    client = iam_client()
+    with Stubber(client) as stubber:
+        stubber.add_response("create_role", ROLE)
+        stubber.add_client_error("put_role_policy", "MalformedPolicyDocument")
+        stubber.add_response("delete_role_policy", {})
+        stubber.add_response("delete_role", {})
+        with pytest.raises(ClientError):
+            create_role(client, "bucket")
+        stubber.assert_no_pending_responses()
+
+
+def test_generate_role_policy_scopes_bucket():
+    policy = json.loads(generate_role_policy("bucket"))
+    assert policy["Statement"][2]["Resource"] == ["arn:aws:s3:::bucket/*"]
+
+
+def test_generate_role_policy_grants_every_bucket():
+    policy = json.loads(generate_role_policy(["a", "b"]))
+    assert policy["Statement"][1]["Resource"] == ["arn:aws:s3:::a",
+                                                  "arn:aws:s3:::b"]
+    assert policy["Statement"][2]["Resource"] == ["arn:aws:s3:::a/*",
+                                                  "arn:aws:s3:::b/*"]
@@ -0,0 +1,58 @@
+import boto3
+from botocore.stub import Stubber
+from alppb.layers import layer_name
+from alppb.layers import publish_layer
+from alppb.layers import site_packages
+
+
+def lambda_client():
+    return boto3.client("lambda", region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+"""
+alppb.layers.site_packages()
+"""
+
+
+def test_site_packages():
+    assert site_packages("2.7") == "python/lib/python2.7/site-packages"
+    assert site_packages(None) == "python/lib/python3.6/site-packages"
+
+
+"""
+alppb.layers.layer_name()
+"""
+
+
+def test_layer_name_is_valid_for_lambda():
+    assert layer_name("requests", "3.7") == "alppb-requests-py37"
+    assert layer_name("zope.interface==4.5", None) == \
+        "alppb-zope_interface_4_5-py36"
+    assert len(layer_name("x" * 100, "3.6")) == 64
+
+
+"""
+alppb.layers.publish_layer()
+"""
+
+
+def test_lambda_client_can_publish_layers():
+    # Layers need botocore 1.12.56, the pinned version must have them.
+    assert hasattr(lambda_client(), "publish_layer_version")
+
+
+def test_publish_layer_from_s3():
+    client = lambda_client()
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:alppb-lxml-py36:3"
+    with Stubber(client) as stubber:
+        stubber.add_response("publish_layer_version", {
+            "LayerVersionArn": arn, "Version": 3}, {
+            "LayerName": "alppb-lxml-py36",
+            "Description": "lxml built by alppb",
+            "Content": {"S3Bucket": "bucket",
+                        "S3Key": "alppbBuilder/alppb-lxml.zip"},
+            "CompatibleRuntimes": ["python3.6"]})
+        assert publish_layer(client, "bucket", "alppbBuilder/alppb-lxml.zip",
+                             "lxml", "3.6") == arn
@@ -0,0 +1,92 @@
+import os
+import shutil
+import stat
+import zipfile
+import pytest
+import yaml
+from alppb.local import buildspec_script
+from alppb.local import deliver_file
+from alppb.local import read_log
+from alppb.local import run_build
+
+
+def buildspec(*commands, **variables):
+    spec = {"version": 0.2, "phases": {"build": {"commands": list(commands)}}}
+    if variables:
+        spec["env"] = {"variables": variables}
+    return yaml.dump(spec)
+
+
+"""
+alppb.local.buildspec_script()
+"""
+
+
+def test_buildspec_script_exports_variables_and_orders_phases():
+    spec = yaml.dump({
+        "env": {"variables": {"PIP_CACHE_DIR": "/root/.cache/pip"}},
+        "phases": {"build": {"commands": ["b"]},
+                   "install": {"commands": ["a"]}}})
+
+    assert buildspec_script(spec).splitlines() == [
+        "set -e", "export PIP_CACHE_DIR=/root/.cache/pip", "a", "b"]
+
+
+"""
+alppb.local.run_build()
+"""
+
+
+@pytest.mark.skipif(shutil.which("zip") is None, reason="needs zip")
+def test_run_build_as_process(tmp_path):
+    spec = buildspec("mkdir alppb", "python3.6 -c 'print(1)' > alppb/one.txt",
+                     "echo $GREETING > alppb/hello.txt", "cd alppb/",
+                     "zip -r ../a.zip *", GREETING="hi")
+    path = run_build(spec, "a.zip", str(tmp_path))
+
+    with zipfile.ZipFile(path) as archive:
+        assert archive.read("one.txt") == b"1\n"
+        assert archive.read("hello.txt") == b"hi\n"
+
+
+def test_run_build_failure(tmp_path):
+    spec = buildspec("echo building", "false", "echo not reached")
+
+    assert run_build(spec, "a.zip", str(tmp_path)) is None
+    assert read_log(str(tmp_path)) == ["building"]
+
+
+def test_run_build_in_container(tmp_path):
+    runtime = tmp_path / "fake-docker"
+    runtime.write_text(
+        "#!/bin/sh\n"
+        "echo \"$1\" >> {calls}\n"
+        "if [ \"$1\" = cp ]; then echo zip > \"$3/a.zip\"; fi\n".format(
+            calls=tmp_path / "calls"))
+    runtime.chmod(runtime.stat().st_mode | stat.S_IXUSR)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    path = run_build(buildspec("true"), "a.zip", str(work_dir), str(runtime),
+                     "irlrobot/alppb-python36")
+
+    assert path == str(work_dir / "a.zip")
+    assert (tmp_path / "calls").read_text().split() == ["run", "cp", "rm"]
+
+
+"""
+alppb.local.deliver_file()
+"""
+
+
+def test_deliver_file_moves_or_extracts(tmp_path):
+    built = tmp_path / "built.zip"
+    with zipfile.ZipFile(str(built), "w") as archive:
+        archive.writestr("six.py", "")
+    target = str(tmp_path / "alppb-six.zip")
+
+    assert deliver_file(str(built), target, progress=True) == target
+    assert not built.exists()
+    assert deliver_file(target, None, str(tmp_path / "out")) == \
+        str(tmp_path / "out")
+    assert os.listdir(str(tmp_path / "out")) == ["six.py"]
+    assert deliver_file(target, None, download=False) is None
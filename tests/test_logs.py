@@ -0,0 +1,144 @@
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+import pytest
+from alppb.logs import LogTailer
+from alppb.logs import PIP_CACHE_COUNTERS
+from alppb.logs import PRUNE_CAPTURES
+
+
+def logs_client():
+    return boto3.client("logs", region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+BUILD = {
+    "id": "alppbBuilder:1",
+    "buildStatus": "IN_PROGRESS",
+    "logs": {"groupName": "/aws/codebuild/alppbBuilder", "streamName": "1"},
+}
+
+
+def events(*messages):
+    return [{"timestamp": 0, "message": message, "ingestionTime": 0}
+            for message in messages]
+
+
+"""
+alppb.logs.LogTailer
+"""
+
+
+def test_fetch_follows_the_stream():
+    client = logs_client()
+    tailer = LogTailer(client)
+    with Stubber(client) as stubber:
+        stubber.add_response("get_log_events", {
+            "events": events("Collecting lxml\n"),
+            "nextForwardToken": "f/1"}, {
+            "logGroupName": "/aws/codebuild/alppbBuilder",
+            "logStreamName": "1", "startFromHead": True})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/1"})
+        assert tailer.fetch(BUILD) == ["Collecting lxml"]
+
+        stubber.add_response("get_log_events", {
+            "events": events("Building wheel"),
+            "nextForwardToken": "f/2"}, {
+            "logGroupName": "/aws/codebuild/alppbBuilder",
+            "logStreamName": "1", "startFromHead": True,
+            "nextToken": "f/1"})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/2"})
+        assert tailer.fetch(BUILD) == ["Building wheel"]
+
+    assert tailer.recent("alppbBuilder:1") == ["Collecting lxml",
+                                               "Building wheel"]
+
+
+def test_check_finds_fatal_errors():
+    client = logs_client()
+    tailer = LogTailer(client)
+    with Stubber(client) as stubber:
+        stubber.add_response("get_log_events", {
+            "events": events(
+                "Collecting nosuchpackage",
+                "Could not find a version that satisfies the requirement "
+                "nosuchpackage (from versions: )"),
+            "nextForwardToken": "f/1"})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/1"})
+        line = tailer.check(BUILD)
+
+    assert line.startswith("Could not find a version")
+
+
+def test_check_uses_custom_patterns():
+    client = logs_client()
+    tailer = LogTailer(client, patterns=[r"^boom$"])
+    with Stubber(client) as stubber:
+        stubber.add_response("get_log_events", {
+            "events": events("No matching distribution found for x", "boom"),
+            "nextForwardToken": "f/1"})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/1"})
+        assert tailer.check(BUILD) == "boom"
+
+
+def test_fetch_before_the_stream_exists():
+    client = logs_client()
+    tailer = LogTailer(client)
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_log_events",
+                                 "ResourceNotFoundException")
+        assert tailer.fetch(BUILD) == []
+
+    assert tailer.fetch({"id": "alppbBuilder:2"}) == []
+
+
+def test_fetch_stops_once_access_is_denied():
+    client = logs_client()
+    tailer = LogTailer(client)
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_log_events", "AccessDeniedException")
+        with pytest.raises(ClientError):
+            tailer.fetch(BUILD)
+        # No more calls, so no more errors for this or other builds.
+        assert tailer.fetch(BUILD) == []
+        assert tailer.check(dict(BUILD, id="alppbBuilder:2")) is None
+        stubber.assert_no_pending_responses()
+
+
+def test_counts_pip_cache_lines():
+    client = logs_client()
+    tailer = LogTailer(client, counters=PIP_CACHE_COUNTERS)
+    with Stubber(client) as stubber:
+        stubber.add_response("get_log_events", {
+            "events": events(
+                "  Using cached https://files/six-1.11.0-py2.py3-none-any.whl",
+                "Building wheel for lxml (setup.py): started",
+                "  Using cached https://files/lxml-4.2.5.tar.gz"),
+            "nextForwardToken": "f/1"})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/1"})
+        tailer.fetch(BUILD)
+
+    assert tailer.counts("alppbBuilder:1") == {"cached": 2, "compiled": 1}
+
+
+def test_captures_bytes_pruned():
+    client = logs_client()
+    tailer = LogTailer(client, captures=PRUNE_CAPTURES)
+    with Stubber(client) as stubber:
+        stubber.add_response("get_log_events", {
+            "events": events(
+                "[Container] Running command echo \"alppb pruned $((...\"",
+                "alppb pruned 4096 of 10240 bytes"),
+            "nextForwardToken": "f/1"})
+        stubber.add_response("get_log_events", {
+            "events": [], "nextForwardToken": "f/1"})
+        tailer.fetch(BUILD)
+
+    assert tailer.captured("alppbBuilder:1") == {"pruned": ("4096", "10240")}
+    assert tailer.captured("alppbBuilder:2") == {}
@@ -0,0 +1,112 @@
+import json
+import boto3
+from botocore.stub import Stubber
+import pytest
+from alppb import clients
+from alppb import metadata
+from alppb.codebuild import ensure_build_project
+from alppb.iam import ensure_role
+from alppb.iam import generate_role_policy
+from alppb.s3 import bucket_region
+
+ARN = "arn:aws:iam::123456789012:role/alppbBuilderRole"
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    clients.reset()
+    path = tmp_path / "metadata.json"
+    metadata.enable(str(path))
+    yield path
+    metadata.reset()
+    clients.reset()
+
+
+def client(service):
+    return boto3.client(service, region_name="us-east-1",
+                        aws_access_key_id="testing",
+                        aws_secret_access_key="testing")
+
+
+"""
+alppb.metadata.lookup()
+"""
+
+
+def test_lookup_is_off_until_enabled():
+    metadata.store("bucket_region", "bucket", "us-west-2")
+    assert metadata.lookup("bucket_region", "bucket") is None
+
+
+def test_lookup_survives_a_new_run(cache_file):
+    metadata.store("bucket_region", "bucket", "us-west-2")
+    metadata.enable(str(cache_file))
+    assert metadata.lookup("bucket_region", "bucket") == "us-west-2"
+
+
+def test_lookup_ignores_expired_entries(cache_file, monkeypatch):
+    metadata.store("role", "bucket", ARN)
+    monkeypatch.setitem(metadata.TTLS, "project", -1)
+    metadata.store("project", "us-east-1", "hash")
+
+    assert metadata.lookup("role", "bucket") == ARN
+    assert metadata.lookup("project", "us-east-1") is None
+
+
+def test_lookup_scopes_account_entries_by_credentials(cache_file,
+                                                      monkeypatch):
+    metadata.store("role", "bucket", ARN)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "other")
+    clients.reset()
+
+    assert metadata.lookup("role", "bucket") is None
+    assert "testing" not in cache_file.read_text()
+
+
+"""
+alppb.metadata.forget()
+"""
+
+
+def test_forget_drops_one_kind(cache_file):
+    metadata.store("bucket_region", "bucket", "us-west-2")
+    metadata.store("role", "bucket", ARN)
+    metadata.forget("role")
+
+    assert metadata.lookup("role", "bucket") is None
+    assert list(json.loads(cache_file.read_text())) == \
+        ["bucket_region/bucket"]
+
+
+"""
+Cached lookups
+"""
+
+
+def test_cached_lookups_skip_their_calls(cache_file):
+    s3_client, iam_client = client("s3"), client("iam")
+    codebuild_client = client("codebuild")
+    with Stubber(s3_client) as s3_stub, Stubber(iam_client) as iam_stub, \
+            Stubber(codebuild_client) as codebuild_stub:
+        s3_stub.add_response("get_bucket_location",
+                             {"LocationConstraint": "us-west-2"})
+        iam_stub.add_response("get_role", {"Role": {
+            "Path": "/", "RoleName": "alppbBuilderRole",
+            "RoleId": "AROAEXAMPLEEXAMPLE", "Arn": ARN,
+            "CreateDate": "2018-01-01T00:00:00Z"}})
+        iam_stub.add_response("get_role_policy", {
+            "RoleName": "alppbBuilderRole",
+            "PolicyName": "alppbBuilderPolicy",
+            "PolicyDocument": generate_role_policy("bucket")})
+        codebuild_stub.add_response("batch_get_projects", {"projects": [{
+            "name": "alppbBuilder", "serviceRole": ARN}]})
+
+        for _ in range(2):
+            assert bucket_region(s3_client, "bucket") == "us-west-2"
+            assert ensure_role(iam_client, "bucket") == ARN
+            assert ensure_build_project(codebuild_client, ARN)
+
+        for stub in (s3_stub, iam_stub, codebuild_stub):
+            stub.assert_no_pending_responses()
@@ -0,0 +1,179 @@
+import io
+import os
+import tarfile
+import zipfile
+import pytest
+from alppb.s3 import Progress
+from alppb.s3 import S3ObjectReader
+from alppb.s3 import convert_to_zip
+from alppb.s3 import detect_format
+from alppb.s3 import extract_artifact
+from alppb.s3 import transfer_config
+
+
+class FakeS3(object):
+    """ Serves one object from memory and records the ranges requested """
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = Range[len("bytes="):].split("-")
+        self.ranges.append((int(start), int(end)))
+        return {"Body": io.BytesIO(self.data[int(start):int(end) + 1])}
+
+
+def make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def make_tar(files, mode="w:xz"):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o755 if name.endswith(".so") else 0o644
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+"""
+alppb.s3.transfer_config()
+"""
+
+
+def test_transfer_config():
+    config = transfer_config(part_size=16, threads=4)
+    assert config.multipart_chunksize == 16 * 1024 ** 2
+    assert config.max_concurrency == 4
+
+
+"""
+alppb.s3.S3ObjectReader
+"""
+
+
+def test_reader_reads_in_bounded_blocks():
+    data = bytes(range(256)) * 40
+    client = FakeS3(data)
+    reader = S3ObjectReader(client, "bucket", "key", block_size=1000)
+
+    assert reader.read() == data
+    assert all(end - start < 1000 for start, end in client.ranges)
+
+
+def test_reader_seeks():
+    client = FakeS3(b"0123456789")
+    reader = S3ObjectReader(client, "bucket", "key", block_size=4)
+    reader.seek(-3, io.SEEK_END)
+    assert reader.read(3) == b"789"
+    reader.seek(2)
+    assert reader.read(2) == b"23"
+
+
+"""
+alppb.s3.extract_artifact()
+"""
+
+
+def test_extract_artifact(tmp_path):
+    files = {"lxml/__init__.py": b"", "lxml/etree.so": b"x" * 5000,
+             "lxml-4.2.5.dist-info/METADATA": b"Name: lxml"}
+    client = FakeS3(make_zip(files))
+    count = extract_artifact(client, "bucket", "alppb.zip", str(tmp_path),
+                             threads=2, block_size=1024)
+
+    assert count == 3
+    for name, content in files.items():
+        with open(os.path.join(str(tmp_path), name), "rb") as extracted:
+            assert extracted.read() == content
+
+
+def test_extract_artifact_fetches_each_block_about_once(tmp_path):
+    files = {"pkg/mod{}.so".format(index): os.urandom(10000)
+             for index in range(40)}
+    data = make_zip(files)
+    client = FakeS3(data)
+    extract_artifact(client, "bucket", "alppb.zip", str(tmp_path),
+                     threads=10, block_size=16 * 1024)
+
+    fetched = sum(end - start + 1 for start, end in client.ranges)
+    assert fetched < len(data) * 1.1
+    for name, content in files.items():
+        with open(os.path.join(str(tmp_path), name), "rb") as extracted:
+            assert extracted.read() == content
+
+
+def test_extract_artifact_streams_tars(tmp_path):
+    files = {"six.py": b"x" * 3000, "six-1.11.0.dist-info/METADATA": b"six"}
+    client = FakeS3(make_tar(files, "w:gz"))
+    count = extract_artifact(client, "bucket", "alppb.tar.gz", str(tmp_path),
+                             block_size=512)
+
+    assert count == 2
+    with open(os.path.join(str(tmp_path), "six.py"), "rb") as extracted:
+        assert extracted.read() == files["six.py"]
+
+
+def test_extract_artifact_skips_members_outside_target(tmp_path):
+    client = FakeS3(make_tar({"../evil.py": b"x", "ok.py": b"y"}))
+    target = tmp_path / "target"
+    count = extract_artifact(client, "bucket", "alppb.tar.xz", str(target))
+
+    assert count == 1
+    assert not (tmp_path / "evil.py").exists()
+
+
+"""
+alppb.s3.detect_format()
+"""
+
+
+def test_detect_format():
+    assert detect_format(make_zip({"a": b""})[:6]) == "zip"
+    assert detect_format(make_tar({"a": b""}, "w:gz")[:6]) == "tar.gz"
+    assert detect_format(make_tar({"a": b""}, "w:xz")[:6]) == "tar.xz"
+    with pytest.raises(ValueError):
+        detect_format(b"plain!")
+
+
+"""
+alppb.s3.convert_to_zip()
+"""
+
+
+def test_convert_to_zip_keeps_contents_and_permissions(tmp_path):
+    files = {"lxml/__init__.py": b"", "lxml/etree.so": b"x" * 5000}
+    path = tmp_path / "alppb-lxml.tar.xz"
+    path.write_bytes(make_tar(files))
+    target = convert_to_zip(str(path))
+
+    assert target == str(tmp_path / "alppb-lxml.zip")
+    with zipfile.ZipFile(target) as archive:
+        assert {name: archive.read(name) for name in archive.namelist()} == \
+            files
+        assert archive.getinfo("lxml/etree.so").external_attr >> 16 & 0o777 \
+            == 0o755
+
+
+"""
+alppb.s3.Progress
+"""
+
+
+def test_progress_prints_every_step(capsys):
+    progress = Progress("alppb.zip", 100, step=50)
+    for _ in range(10):
+        progress(10)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[1] for line in lines] == ["50%", "100%"]
@@ -0,0 +1,159 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import threading
+import pytest
+from alppb.serve import BuildService
+from alppb.serve import create_server
+from alppb.serve import make_handler
+from alppb.serve import stop_on_sigterm
+
+
+class SlowBuild(object):
+    """ Blocks every build until released and counts the builds """
+
+    def __init__(self, fail=False):
+        self.release = threading.Event()
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, package):
+        self.calls.append(package)
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("boom")
+        return {"package": package, "status": "SUCCEEDED",
+                "artifact": "/cache/{}.zip".format(package)}
+
+
+def resolve(body):
+    if "package" not in body:
+        raise ValueError("no package")
+    return body["package"], body["package"]
+
+
+"""
+alppb.serve.BuildService
+"""
+
+
+def test_identical_requests_share_one_build():
+    build = SlowBuild()
+    service = BuildService(build, max_workers=2)
+    submitted = [service.submit("key", "lxml") for _ in range(5)]
+    other, _ = service.submit("other", "six")
+    assert service.in_flight == 2
+    build.release.set()
+
+    assert [shared for _, shared in submitted] == \
+        [False, True, True, True, True]
+    assert len(set(future for future, _ in submitted)) == 1
+    assert submitted[0][0].result()["artifact"] == "/cache/lxml.zip"
+    other.result()
+    assert sorted(build.calls) == ["lxml", "six"]
+    service.shutdown()
+    assert service.in_flight == 0
+
+
+def test_failed_builds_are_not_remembered():
+    build = SlowBuild(fail=True)
+    build.release.set()
+    service = BuildService(build)
+
+    assert service.request("key", "lxml")["error"] == "boom"
+    assert service.request("key", "lxml")["status"] == "FAILED"
+    assert build.calls == ["lxml", "lxml"]
+    service.shutdown()
+
+
+"""
+alppb.serve.make_handler()
+"""
+
+
+def test_http_api():
+    build = SlowBuild()
+    build.release.set()
+    service = BuildService(build)
+    server = create_server(make_handler(service, resolve), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request("POST", "/build", json.dumps({"package": "six"}))
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read().decode("utf-8"))["artifact"] == \
+            "/cache/six.zip"
+
+        connection.request("POST", "/build", "{}")
+        response = connection.getresponse()
+        assert response.status == 400
+        assert json.loads(response.read().decode("utf-8")) == \
+            {"error": "no package"}
+
+        connection.request("GET", "/health")
+        assert json.loads(connection.getresponse().read().decode("utf-8")) \
+            == {"ok": True, "in_flight": 0}
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+
+def test_unix_socket(tmp_path):
+    build = SlowBuild()
+    build.release.set()
+    service = BuildService(build)
+    path = str(tmp_path / "alppb.sock")
+    server = create_server(make_handler(service, resolve), socket_path=path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        body = json.dumps({"package": "six"}).encode("utf-8")
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b"POST /build HTTP/1.0\r\nContent-Length: " +
+                       str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+        response = b""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+    assert response.startswith(b"HTTP/1.0 200")
+    assert json.loads(response.split(b"\r\n\r\n", 1)[1].decode("utf-8"))[
+        "package"] == "six"
+
+
+def test_unix_socket_keeps_other_files(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("keep me")
+    service = BuildService(SlowBuild())
+    with pytest.raises(OSError):
+        create_server(make_handler(service, resolve), socket_path=str(path))
+    service.shutdown()
+
+    assert path.read_text() == "keep me"
+
+
+"""
+alppb.serve.stop_on_sigterm()
+"""
+
+
+def test_sigterm_interrupts_like_ctrl_c():
+    previous = stop_on_sigterm()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            os.kill(os.getpid(), signal.SIGTERM)
+            # The handler runs between two bytecodes of the main thread.
+            threading.Event().wait(1)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
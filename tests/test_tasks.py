@@ -0,0 +1,64 @@
+import threading
+import pytest
+from alppb.tasks import run_tasks
+
+
+"""
+alppb.tasks.run_tasks()
+"""
+
+
+def test_run_tasks_passes_dependency_results():
+    results = {}
+    run_tasks("Test", {
+        "a": (lambda done: 1, []),
+        "b": (lambda done: done["a"] + 1, ["a"]),
+        "c": (lambda done: done["a"] + done["b"], ["a", "b"]),
+    }, results)
+
+    assert results == {"a": 1, "b": 2, "c": 3}
+
+
+def test_run_tasks_overlaps_independent_tasks():
+    barrier = threading.Barrier(2, timeout=5)
+    results = {}
+    run_tasks("Test", {
+        "a": (lambda done: barrier.wait(), []),
+        "b": (lambda done: barrier.wait(), []),
+    }, results)
+
+    assert sorted(results) == ["a", "b"]
+
+
+def test_run_tasks_raises_and_keeps_partial_results():
+    def fail(done):
+        raise RuntimeError("boom")
+
+    results = {}
+    with pytest.raises(RuntimeError):
+        run_tasks("Test", {
+            "a": (lambda done: 1, []),
+            "b": (fail, ["a"]),
+            "c": (lambda done: 3, ["b"]),
+        }, results)
+
+    assert results == {"a": 1}
+
+
+def test_run_tasks_keep_going_runs_independent_tasks():
+    def fail(done):
+        raise RuntimeError("boom")
+
+    results = {}
+    run_tasks("Test", {
+        "a": (fail, []),
+        "b": (lambda done: 2, []),
+        "c": (lambda done: 3, ["a"]),
+    }, results, keep_going=True)
+
+    assert results == {"b": 2}
+
+
+def test_run_tasks_rejects_unknown_dependencies():
+    with pytest.raises(ValueError):
+        run_tasks("Test", {"a": (lambda done: 1, ["missing"])}, {})
@@ -0,0 +1,132 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import json
+from botocore.stub import Stubber
+import pytest
+from alppb import clients
+from alppb import iam
+from alppb import timing
+from alppb.tasks import run_tasks
+
+
+@pytest.fixture(autouse=True)
+def fresh_timing(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    timing.reset()
+    clients.reset()
+    yield
+    timing.reset()
+    clients.reset()
+
+
+def spans(name=None):
+    return [event for event in timing.trace()["traceEvents"]
+            if event["ph"] == "X" and name in (None, event["name"])]
+
+
+"""
+alppb.timing.span()
+"""
+
+
+def test_span_records_nothing_until_enabled():
+    with timing.span("quiet"):
+        pass
+    assert spans() == []
+
+
+def test_span_records_duration_and_details():
+    timing.enable()
+    with timing.span("step", package="six"):
+        pass
+
+    [event] = spans("step")
+    assert event["dur"] >= 0
+    assert event["args"] == {"package": "six"}
+
+
+"""
+alppb.timing.traced()
+"""
+
+
+def test_traced_names_spans_after_module_and_function():
+    def build(package):
+        return package.upper()
+
+    traced = timing.traced(build)
+    assert traced("six") == "SIX"
+    timing.enable()
+    assert traced("six") == "SIX"
+
+    assert traced.__name__ == "build"
+    assert len(spans("test_timing.{}".format(build.__qualname__))) == 1
+    assert iam.create_role.__name__ == "create_role"
+
+
+"""
+alppb.timing.count_api_call()
+"""
+
+
+def test_api_calls_are_counted_per_phase():
+    timing.enable()
+    client = clients.get_client("codebuild", "us-east-1")
+    with Stubber(client) as stubber:
+        stubber.add_response("delete_project", {})
+        stubber.add_response("delete_project", {})
+        run_tasks("Cleanup", {
+            "delete": (lambda done: client.delete_project(name="a"), []),
+        }, {})
+        client.delete_project(name="b")
+
+    assert timing.api_calls() == {
+        "Cleanup": {"codebuild.DeleteProject": 1},
+        "Other": {"codebuild.DeleteProject": 1},
+    }
+    assert [event["name"] for event in spans()] == ["delete", "Cleanup"]
+
+
+"""
+alppb.timing.add_build()
+"""
+
+
+def test_add_build_records_codebuild_phases():
+    timing.enable()
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    timing.add_build({"id": "alppbBuilder:1", "phases": [
+        {"phaseType": "QUEUED", "startTime": start,
+         "endTime": start + timedelta(seconds=3)},
+        {"phaseType": "BUILD", "startTime": start + timedelta(seconds=3)},
+    ]}, "six")
+
+    [event] = spans("QUEUED")
+    assert event["pid"] == timing.CODEBUILD_PID
+    assert event["ts"] == int(start.timestamp() * 1e6)
+    assert event["dur"] == 3000000
+    assert spans("BUILD") == []
+    assert {"name": "thread_name", "ph": "M", "pid": timing.CODEBUILD_PID,
+            "tid": event["tid"], "args": {"name": "six"}} in \
+        timing.trace()["traceEvents"]
+
+
+"""
+alppb.timing.write()
+"""
+
+
+def test_write_creates_a_chrome_trace(tmp_path):
+    timing.enable()
+    with timing.phase("Setup"):
+        timing.count_api_call(
+            event_name="before-parameter-build.s3.HeadBucket")
+    path = tmp_path / "profile" / "trace.json"
+    timing.write(str(path))
+
+    trace = json.loads(path.read_text())
+    assert [event["name"] for event in trace["traceEvents"]
+            if event["ph"] == "X"] == ["Setup"]
+    assert trace["otherData"]["apiCalls"] == {"Setup": {"s3.HeadBucket": 1}}